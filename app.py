@@ -1,19 +1,55 @@
+import os
+
+# SERVER=gevent runs under gevent's WSGI server. The stdlib has to be patched
+# before anything else imports it, so sockets (requests), locks, queues and
+# the scheduler threads all yield to the event loop instead of blocking it.
+SERVER_MODE = os.environ.get("SERVER", "threaded")
+if SERVER_MODE == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
 import json
 import re
-import os
 import base64
 import requests
+from requests.adapters import HTTPAdapter
 from io import BytesIO
-from PIL import Image
-from flask import Flask, request, session, redirect, url_for, jsonify, render_template_string, Response
+from PIL import Image, ImageSequence
+try:
+    import brotli
+except ImportError:  # optional: assets are then served gzip-only
+    brotli = None
+from flask import Flask, request, session, redirect, url_for, jsonify, Response, send_file, abort
 from datetime import datetime, timedelta
 from collections import deque, defaultdict, OrderedDict
-from functools import wraps
+from functools import wraps, lru_cache
+from werkzeug.wsgi import ClosingIterator
 import time
+import math
 import hashlib
 import html
 from urllib.parse import urlparse
 import random
+import gzip
+import zlib
+import tempfile
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import csv
+import mmap
+import struct
+import ipaddress
+import pickle
+import sqlite3
+import signal
+import socket
+import select
+import subprocess
+import sys
+import itertools
+from array import array
+from bisect import bisect_left, bisect_right, insort
 
 app = Flask(__name__)
 app.secret_key = "change-this-secret-key-in-production"
@@ -35,6 +71,281 @@ ACTIVE_USERS = {}  # username -> {"last_seen": datetime, "ip": "x.x.x.x", "room"
 # GIF and media storage
 UPLOADED_GIFS = {}  # gif_id -> {"url": "...", "uploader": "username", "timestamp": datetime}
 MESSAGE_METADATA = {}  # message_id -> {"gif_url": "...", "deleted": False}
+MEDIA_ORIGINS = {}  # proxied media cache name -> GIF URL it was fetched from
+
+class Channel:
+    """Bounded message feed that readers follow with a sequence-number cursor"""
+
+    def __init__(self, maxlen):
+        self.entries = deque(maxlen=maxlen)  # (seq, message), oldest first
+        self.seq = 0  # seq of the newest message ever posted
+
+    def post(self, message):
+        # Seqs follow the message's epoch ms, so a channel that is dropped
+        # and recreated still moves past cursors readers already hold
+        if self.entries:
+            keep_ts_order(message, self.entries[-1][1]["ts"])
+        self.seq = max(self.seq + 1, message["ts"])
+        self.entries.append((self.seq, message))
+
+    def read(self, cursor=None, since_ms=0):
+        """Messages after cursor, or (no cursor yet) from since_ms on, and the new cursor"""
+        entries = list(self.entries)
+        if cursor is None:
+            start = bisect_left(entries, since_ms, key=lambda entry: entry[1]["ts"])
+        else:
+            start = bisect_right(entries, cursor, key=lambda entry: entry[0])
+        new = entries[start:]
+        return [message for _, message in new], new[-1][0] if new else max(cursor or 0, self.seq)
+
+    def state(self):
+        return self.seq, list(self.entries)
+
+    def load(self, state):
+        self.seq, entries = state
+        self.entries.clear()
+        self.entries.extend(entries)
+
+# Message ids per author and room, in room order, so moderation can find a
+# user's messages without scanning every room. Kept in step with MESSAGES by
+# append_message/clear_room; a rotated-out message is always the oldest
+# entry for its author in that room.
+USER_MESSAGES = {}  # username -> {room_id: deque of message ids}
+USER_MESSAGES_LOCK = threading.Lock()
+
+def index_user_message(room, message, evicted=None):
+    """Record a message appended to room (and forget the one it rotated out)"""
+    with USER_MESSAGES_LOCK:
+        USER_MESSAGES.setdefault(message.get("user"), {}).setdefault(room, deque()).append(message.get("id"))
+        if evicted is not None:
+            unindex_user_messages(room, evicted.get("user"), 1)
+
+def unindex_user_messages(room, username, count=None):
+    """Drop a user's oldest count (default all) ids in room; caller holds USER_MESSAGES_LOCK"""
+    rooms = USER_MESSAGES.get(username, {})
+    ids = rooms.get(room)
+    if ids is None:
+        return
+    for _ in range(len(ids) if count is None else min(count, len(ids))):
+        ids.popleft()
+    if not ids:
+        del rooms[room]
+        if not rooms:
+            del USER_MESSAGES[username]
+
+def rebuild_user_message_index():
+    with USER_MESSAGES_LOCK:
+        USER_MESSAGES.clear()
+        for room, messages in list(MESSAGES.items()):
+            for message in list(messages):
+                USER_MESSAGES.setdefault(message.get("user"), {}).setdefault(room, deque()).append(message.get("id"))
+
+def user_message_ids(username, room=None):
+    """Ids of a user's messages still held in room (default: every room)"""
+    with USER_MESSAGES_LOCK:
+        rooms = USER_MESSAGES.get(username, {})
+        if room is not None:
+            return list(rooms.get(room, ()))
+        return [message_id for ids in rooms.values() for message_id in ids]
+
+# Admin announcements live outside the rooms: every room's poll merges in
+# BROADCASTS, and each user's own polls merge in their INBOXES entry, so
+# posting is one append instead of one per room
+BROADCAST_MAXLEN = 100
+INBOX_MAXLEN = 50
+INBOX_TTL = timedelta(hours=1)  # inboxes with nothing newer are dropped
+BROADCASTS = Channel(BROADCAST_MAXLEN)
+INBOXES = {}  # username -> Channel of admin messages to that user
+CHANNEL_LOCK = threading.Lock()
+
+class RateCounter:
+    """Events per second over a sliding window, kept in one-second buckets"""
+
+    def __init__(self, window=300):
+        self.window = window
+        self.counts = [0] * window
+        self.seconds = [0] * window  # which epoch second each bucket holds
+
+    def add(self, when, n=1):
+        second = int(when)
+        i = second % self.window
+        if self.seconds[i] != second:
+            self.seconds[i] = second
+            self.counts[i] = 0
+        self.counts[i] += n
+
+    def rate(self, span, now=None):
+        """Average per second over the last `span` seconds (span <= window)"""
+        now = int(now if now is not None else time.time())
+        total = sum(count for count, second in zip(self.counts, self.seconds) if now - span < second <= now)
+        return total / span
+
+# Running totals, updated by the ops that change them so admin stats never
+# walk the message history. Per-room sizes are just len(MESSAGES[room]).
+STATS = {
+    "messages": 0,  # currently held across all rooms
+    "messages_sent": 0,  # ever appended, including ones rotated out since
+    "gifs_sent": 0
+}
+ROOM_SENDS = defaultdict(int)  # room_id -> messages ever sent to it
+SEND_RATE = RateCounter()  # bucketed by each message's own "ts", so every worker agrees
+STATS_LOCK = threading.Lock()
+
+# Handlers run on many threads. Readers never iterate the live dicts above:
+# list(d.items()) / list(deque) copy in a single C call under the GIL, so they
+# get a consistent snapshot without taking a lock. Writers that check and then
+# modify take the lock for the structure they touch.
+ACTIVE_USERS_LOCK = threading.Lock()
+MODERATION_LOCK = threading.Lock()  # BLACKLIST, USER_EFFECTS, BANNED_IPS, BANNED_USERS
+ROOM_LOCKS = {}  # room_id -> lock serialising writes to MESSAGES[room_id]
+
+class ActiveUserIndex:
+    """Sorted views of ACTIVE_USERS, kept up to date by the ops that change it"""
+
+    FIELDS = ("last_seen", "room", "country", "username", "ip")
+    SORTS = ("last_seen", "room", "country", "username")
+
+    def __init__(self):
+        self.keys = {}  # username -> indexed values, in FIELDS order
+        self.lists = {field: [] for field in self.FIELDS}  # field -> sorted [(value, username)]
+
+    @staticmethod
+    def _keys_for(username, data):
+        # One type per list (datetime, then str) so no insert can fail to compare
+        last_seen = data.get("last_seen")
+        return (last_seen if isinstance(last_seen, datetime) else datetime.min,
+                str(data.get("room") or "general"), str((data.get("geo") or {}).get("country") or ""),
+                str(username), str(data.get("ip") or ""))
+
+    def update(self, username, data):
+        """Index (or re-index) one user; only the lists whose value changed move"""
+        keys = self._keys_for(username, data)
+        old = self.keys.get(username)
+        if old == keys:
+            return
+        moved = [i for i in range(len(self.FIELDS)) if old is None or old[i] != keys[i]]
+        for i in moved:
+            entries = self.lists[self.FIELDS[i]]
+            if old is not None:
+                del entries[bisect_left(entries, (old[i], username))]
+            insort(entries, (keys[i], username))
+        self.keys[username] = keys
+
+    def remove(self, username):
+        old = self.keys.pop(username, None)
+        if old is not None:
+            for field, value in zip(self.FIELDS, old):
+                entries = self.lists[field]
+                del entries[bisect_left(entries, (value, username))]
+
+    def rebuild(self, users):
+        self.keys = {username: self._keys_for(username, data) for username, data in users.items()}
+        for i, field in enumerate(self.FIELDS):
+            self.lists[field] = sorted((keys[i], username) for username, keys in self.keys.items())
+
+    def seen_before(self, threshold):
+        """Usernames last seen before threshold, oldest first"""
+        entries = self.lists["last_seen"]
+        return [username for _, username in entries[:bisect_left(entries, (threshold,))]]
+
+    def any_seen_before(self, threshold, keep=None):
+        """Whether anyone but keep was last seen before threshold"""
+        entries = self.lists["last_seen"]
+        stale = entries[:min(bisect_left(entries, (threshold,)), 2)]
+        return any(username != keep for _, username in stale)
+
+    def prefix_match(self, field, prefix):
+        """Usernames whose username or ip starts with prefix"""
+        entries = self.lists[field]
+        lo = bisect_left(entries, (prefix,))
+        hi = bisect_left(entries, (prefix + "\uffff",), lo)
+        return [username for _, username in entries[lo:hi]]
+
+    def page(self, sort, descending, offset, limit, only=None):
+        """One page of usernames in sort order, optionally restricted to the set only"""
+        entries = self.lists[sort]
+        if only is None:
+            if descending:
+                end = max(len(entries) - offset, 0)
+                chosen = entries[max(end - limit, 0):end][::-1]
+            else:
+                chosen = entries[offset:offset + limit]
+        elif len(only) * 8 < len(entries):
+            # Narrow filter: order just the matches by their indexed value
+            i = self.FIELDS.index(sort)
+            chosen = sorted(((self.keys[username][i], username) for username in only), reverse=descending)
+            chosen = chosen[offset:offset + limit]
+        else:
+            # Broad filter: walk the index, at least 1 in 8 entries match
+            walk = reversed(entries) if descending else iter(entries)
+            chosen = list(itertools.islice((e for e in walk if e[1] in only), offset, offset + limit))
+        return [username for _, username in chosen]
+
+ACTIVE_USER_INDEX = ActiveUserIndex()
+ACTIVE_USERS_PAGE = 50  # default page size for /admin/active-users
+ACTIVE_USERS_PAGE_MAX = 500
+
+BULK_MODERATION_MAX_ITEMS = int(os.environ.get("BULK_MODERATION_MAX_ITEMS", 10000))
+BULK_MODERATION_ACTIONS = ("ban", "unban", "effect", "clear-effect", "delete-messages")
+
+# Moderation epoch, bumped on every ban/effect change and sent on each response
+# so clients only call /check-effects when something actually changed.
+# Seeded from the clock so a restart never repeats an epoch a client has seen.
+MODERATION_EPOCH = int(time.time() * 1000)
+MODERATION_EPOCH_LOCK = threading.Lock()
+
+# Minimum client poll interval in seconds, sent as X-Poll-Interval on every
+# response. Admins can raise it at runtime to slow every client down.
+POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", 1.0))
+POLL_INTERVAL_MIN = 0.5
+POLL_INTERVAL_MAX = 60.0
+
+# Node id (0-1023) baked into message ids; give each server process its own
+# so ids stay unique when several run side by side
+NODE_ID = int(os.environ.get("NODE_ID", 0))
+
+# Offline GeoIP range database (CSV: start_ip,end_ip,country,city,isp[,lat,lon])
+GEOIP_DB_PATH = os.environ.get("GEOIP_DB_PATH", "")
+# Remote ip-api.com lookup, only used when the local database has no answer
+GEOIP_HTTP_FALLBACK = os.environ.get("GEOIP_HTTP_FALLBACK", "1") == "1"
+
+# Optional GIF proxy: fetch each GIF once and serve it from a local,
+# content-addressed disk cache instead of letting every viewer hotlink it
+MEDIA_PROXY_ENABLED = os.environ.get("GIF_PROXY", "0") == "1"
+MEDIA_CACHE_DIR = os.environ.get("MEDIA_CACHE_DIR", "media_cache")
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get("MEDIA_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# Uploaded images have no origin to fetch them from again, so they are kept
+# for good in their own content-addressed directory, outside the cache budget
+MEDIA_STORE_DIR = os.environ.get("MEDIA_STORE_DIR", "media_store")
+# Let the front proxy (nginx X-Accel / Apache X-Sendfile) stream cached files
+app.config['USE_X_SENDFILE'] = os.environ.get("MEDIA_X_SENDFILE", "0") == "1"
+
+# Rate limits per route and per key (logged-in user, client IP), as
+# (burst, sustained requests per second). RATE_LIMITS takes a JSON object
+# in the same shape to override routes, e.g. {"send": {"ip": [60, 5]}};
+# null (for a route or one scope) or a burst of 0 turns a limit off.
+RATE_LIMITS = {
+    "send": {"user": (10, 1.0), "ip": (30, 3.0)},
+    "send-gif": {"user": (3, 0.2), "ip": (10, 0.5)},
+    "typing": {"user": (5, 1.0), "ip": (20, 5.0)},
+    "upload": {"user": (3, 0.05), "ip": (10, 0.2)}
+}
+for _route, _limits in json.loads(os.environ.get("RATE_LIMITS", "{}")).items():
+    if _limits is None:  # the whole route
+        RATE_LIMITS[_route] = {}
+        continue
+    if not isinstance(_limits, dict):
+        raise ValueError(f"RATE_LIMITS {_route}: expected an object of scopes or null, got {_limits}")
+    for _scope, _limit in _limits.items():
+        if _limit is not None and _limit[0]:
+            if not (len(_limit) == 2 and _limit[0] > 0 and _limit[1] > 0):
+                raise ValueError(f"RATE_LIMITS {_route}/{_scope}: expected [burst, rate] with both > 0, got {_limit}")
+        RATE_LIMITS.setdefault(_route, {})[_scope] = _limit
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", 100000))  # per route and scope, ~100 bytes each
+# Proxies whose X-Forwarded-For the IP rate limits believe (comma-separated IPs or CIDRs);
+# any other client can put whatever it likes in that header
+TRUSTED_PROXIES = [ipaddress.ip_network(net.strip(), strict=False)
+                   for net in os.environ.get("TRUSTED_PROXIES", "").split(",") if net.strip()]
 
 # Admin credentials
 ADMIN_USER = "adminof67"
@@ -60,6 +371,230 @@ LAYOUTS = {
     "minimal": {"message_spacing": "5px", "font_size": "13px", "padding": "5px"}
 }
 
+# ====================
+# SHARED STATE STORE
+# ====================
+
+# In prefork mode (WORKERS=N) every worker process keeps its own copy of the
+# structures above. Each mutation is a named op (@shared_op) appended to a
+# SQLite log, and every worker replays that log in id order, so all copies
+# go through the same sequence of states. Reads, including the /messages poll
+# path, stay in local memory. Single-process mode has no store and the ops
+# simply run in place.
+SHARED_STORE_PATH = os.environ.get("SHARED_STORE_PATH", "chat_state.db")
+SHARED_STORE_COMPACT_EVERY = int(os.environ.get("SHARED_STORE_COMPACT_EVERY", 5000))  # events between snapshots
+SHARED_OPS = {}  # op name -> function that applies it to local state
+SHARED_STORE = None  # SharedStore in prefork workers
+
+def shared_op(fn):
+    """Mark a function as a mutation of shared chat state"""
+    SHARED_OPS[fn.__name__] = fn
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if SHARED_STORE is None:
+            return fn(*args, **kwargs)
+        return SHARED_STORE.commit(fn.__name__, args, kwargs)
+    return wrapper
+
+def dump_shared_state():
+    """Everything the ops mutate, as a picklable dict"""
+    return {
+        "messages": {room: list(messages) for room, messages in list(MESSAGES.items())},
+        "rooms": ROOMS,
+        "blacklist": BLACKLIST,
+        "banned_ips": BANNED_IPS,
+        "banned_users": BANNED_USERS,
+        "user_effects": USER_EFFECTS,
+        "user_profiles": USER_PROFILES,
+        "active_users": ACTIVE_USERS,
+        "uploaded_gifs": UPLOADED_GIFS,
+        "message_metadata": MESSAGE_METADATA,
+        "media_origins": MEDIA_ORIGINS,
+        "moderation_epoch": MODERATION_EPOCH,
+        "poll_interval": POLL_INTERVAL,
+        "stats": STATS,
+        "room_sends": dict(ROOM_SENDS),
+        "send_rate": (SEND_RATE.counts, SEND_RATE.seconds),
+        "broadcasts": BROADCASTS.state(),
+        "inboxes": {username: inbox.state() for username, inbox in list(INBOXES.items())}
+    }
+
+def load_shared_state(state):
+    """Replace local state with a snapshot, keeping the global objects"""
+    global MODERATION_EPOCH, POLL_INTERVAL
+    MESSAGES.clear()
+    for room, messages in state["messages"].items():
+        MESSAGES[room].extend(messages)
+    for target, key in ((ROOMS, "rooms"), (BLACKLIST, "blacklist"), (BANNED_IPS, "banned_ips"),
+                        (BANNED_USERS, "banned_users"), (USER_EFFECTS, "user_effects"),
+                        (USER_PROFILES, "user_profiles"), (ACTIVE_USERS, "active_users"),
+                        (UPLOADED_GIFS, "uploaded_gifs"), (MESSAGE_METADATA, "message_metadata"),
+                        (MEDIA_ORIGINS, "media_origins"),
+                        (STATS, "stats"), (ROOM_SENDS, "room_sends")):
+        target.clear()
+        target.update(state[key])
+    SEND_RATE.counts, SEND_RATE.seconds = state["send_rate"]
+    rebuild_user_message_index()
+    ACTIVE_USER_INDEX.rebuild(ACTIVE_USERS)
+    BROADCASTS.load(state["broadcasts"])
+    INBOXES.clear()
+    for username, inbox in state["inboxes"].items():
+        INBOXES[username] = Channel(INBOX_MAXLEN)
+        INBOXES[username].load(inbox)
+    MODERATION_EPOCH = state["moderation_epoch"]
+    POLL_INTERVAL = state["poll_interval"]
+
+class StoreDiverged(Exception):
+    """Local state no longer matches what the op log says it should be"""
+
+
+class SharedStore:
+    """SQLite-backed op log that keeps worker processes' state in lockstep"""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL, args BLOB NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS snapshot (id INTEGER PRIMARY KEY CHECK (id = 0), through INTEGER NOT NULL, state BLOB NOT NULL)")
+        self.lock = threading.RLock()
+        self.cursor = 0  # id of the last event applied locally
+        self.snapshot_through = 0
+        self.data_version = None
+        # State before any op, the same in every worker, to rebuild from if ours diverges
+        self.baseline = pickle.dumps(dump_shared_state())
+
+    @classmethod
+    def reset(cls, path):
+        """Start from an empty log (the supervisor does this once at startup)"""
+        for suffix in ("", "-wal", "-shm"):
+            _remove_quietly(path + suffix)
+        return cls(path)
+
+    def append(self, op, *args, **kwargs):
+        """Log an op without applying it locally"""
+        with self.lock:
+            self.db.execute("INSERT INTO events (op, args) VALUES (?, ?)", (op, pickle.dumps((args, kwargs))))
+
+    def sync(self):
+        """Apply ops other workers have committed since the last call"""
+        with self.lock:
+            # data_version only moves when another connection commits
+            version = self.db.execute("PRAGMA data_version").fetchone()[0]
+            if version == self.data_version:
+                return
+            self.db.execute("BEGIN")
+            try:
+                self._catch_up()
+            except StoreDiverged as e:
+                print(f"[STORE] {e}")
+                self._rebuild()
+            finally:
+                self.db.execute("COMMIT")
+            self.data_version = version
+
+    def commit(self, op, args, kwargs):
+        """Append an op to the log and apply it, after everything before it"""
+        blob = pickle.dumps((args, kwargs))
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            applying = False
+            try:
+                try:
+                    self._catch_up()
+                except StoreDiverged as e:
+                    print(f"[STORE] {e}")
+                    self._rebuild()
+                event_id = self.db.execute("INSERT INTO events (op, args) VALUES (?, ?)", (op, blob)).lastrowid
+                args, kwargs = pickle.loads(blob)  # apply the same copy the other workers will
+                applying = True
+                result = SHARED_OPS[op](*args, **kwargs)
+                applying = False
+                self.cursor = event_id
+                if self.cursor - self.snapshot_through >= SHARED_STORE_COMPACT_EVERY:
+                    self._compact()
+                self.db.execute("COMMIT")
+            except BaseException as e:
+                self.db.execute("ROLLBACK")
+                if applying:
+                    # The op is gone from the log but may have half-applied here:
+                    # rebuild rather than carry on out of step with the other workers
+                    print(f"[STORE] {op} failed partway: {e!r}")
+                    self.db.execute("BEGIN")
+                    try:
+                        self._rebuild()
+                    finally:
+                        self.db.execute("COMMIT")
+                raise
+            return result
+
+    def close(self):
+        """Checkpoint the WAL into the database file and close the connection"""
+        with self.lock:
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.db.close()
+
+    def compact(self):
+        """Snapshot now if anything was logged since the last snapshot"""
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                try:
+                    self._catch_up()
+                except StoreDiverged as e:
+                    print(f"[STORE] {e}")
+                    self._rebuild()
+                row = self.db.execute("SELECT through FROM snapshot").fetchone()
+                compacted = self.cursor > (row[0] if row else 0)
+                if compacted:
+                    self._compact()
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            return compacted
+
+    def _catch_up(self):
+        row = self.db.execute("SELECT through, state FROM snapshot WHERE through > ?", (self.cursor,)).fetchone()
+        if row:
+            # The events we were missing were compacted away: restart from the snapshot
+            load_shared_state(pickle.loads(row[1]))
+            self.cursor = self.snapshot_through = row[0]
+        for event_id, op, blob in self.db.execute("SELECT id, op, args FROM events WHERE id > ? ORDER BY id", (self.cursor,)).fetchall():
+            args, kwargs = pickle.loads(blob)
+            try:
+                SHARED_OPS[op](*args, **kwargs)
+            except Exception as e:
+                # Its committer applied it cleanly, so our state must be off
+                raise StoreDiverged(f"Replaying {op} #{event_id} failed: {e!r}") from e
+            self.cursor = event_id
+
+    def _rebuild(self):
+        """Reset local state to the baseline and replay the snapshot and log (in a transaction)"""
+        print("[STORE] Rebuilding local state from the log")
+        load_shared_state(pickle.loads(self.baseline))
+        self.cursor = self.snapshot_through = 0
+        try:
+            self._catch_up()
+        except StoreDiverged as e:
+            # Can't get back in step here: exit and let the supervisor start a fresh worker
+            print(f"[STORE] Rebuild failed ({e}), exiting")
+            sys.stdout.flush()
+            os._exit(1)
+
+    def _compact(self):
+        self.db.execute("INSERT OR REPLACE INTO snapshot (id, through, state) VALUES (0, ?, ?)",
+                        (self.cursor, pickle.dumps(dump_shared_state())))
+        self.db.execute("DELETE FROM events WHERE id <= ?", (self.cursor,))
+        self.snapshot_through = self.cursor
+
+@app.before_request
+def sync_shared_state():
+    if SHARED_STORE is not None:
+        SHARED_STORE.sync()
+
 # ====================
 # HELPER FUNCTIONS
 # ====================
@@ -70,26 +605,490 @@ def get_client_ip():
         return request.headers.get('X-Forwarded-For').split(',')[0].strip()
     return request.remote_addr
 
-def get_geolocation(ip):
-    """Get approximate geolocation from IP"""
+def _is_trusted_proxy(ip):
     try:
-        # Using ip-api.com (free tier)
-        if ip.startswith('127.') or ip.startswith('192.168.') or ip.startswith('10.'):
-            return {"country": "Local", "city": "Local Network", "isp": "Private"}
-        
-        response = requests.get(f'http://ip-api.com/json/{ip}', timeout=3)
-        data = response.json()
-        if data['status'] == 'success':
-            return {
-                "country": data.get('country', 'Unknown'),
-                "city": data.get('city', 'Unknown'),
-                "isp": data.get('isp', 'Unknown'),
-                "lat": data.get('lat'),
-                "lon": data.get('lon')
-            }
-    except:
-        pass
-    return {"country": "Unknown", "city": "Unknown", "isp": "Unknown"}
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return any(address in net for net in TRUSTED_PROXIES)
+
+def rate_limit_ip():
+    """Client IP for rate limiting: the peer address, or the hop a trusted proxy saw"""
+    ip = request.remote_addr
+    if _is_trusted_proxy(ip):
+        # Walk back through our own proxies; the first hop they didn't add is the client
+        for hop in reversed(request.headers.get('X-Forwarded-For', '').split(',')):
+            if hop.strip():
+                ip = hop.strip()
+                if not _is_trusted_proxy(ip):
+                    break
+    return ip
+
+def request_room(data):
+    """The "room" field of a request body, or None if it is not a string"""
+    room = data.get("room", "general")
+    return room if isinstance(room, str) else None
+
+class GeoIPDatabase:
+    """IPv4 range table held in sorted compact arrays and searched by bisection.
+
+    The CSV source is compiled once into a binary sidecar file (``<csv>.bin``)
+    that later startups memory-map instead of re-parsing.
+    """
+
+    MAGIC = b"GEOIPv1\0"
+    HEADER = struct.Struct("<8sII")  # magic, range count, locations blob size
+
+    def __init__(self, starts, ends, loc_ids, locations, backing=None):
+        self.starts = starts
+        self.ends = ends
+        self.loc_ids = loc_ids
+        self.locations = locations
+        self._backing = backing  # keeps the mmap alive while views exist
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def load(cls, csv_path):
+        """Load the database, compiling the CSV into the binary cache if stale"""
+        bin_path = csv_path + ".bin"
+        try:
+            fresh = os.path.getmtime(bin_path) >= os.path.getmtime(csv_path)
+        except OSError:
+            fresh = False
+        if not fresh:
+            cls.compile(csv_path, bin_path)
+        return cls.open_compiled(bin_path)
+
+    @classmethod
+    def compile(cls, csv_path, bin_path):
+        """Parse the CSV and write sorted range arrays to ``bin_path``"""
+        rows = []
+        locations = []
+        location_ids = {}
+        with open(csv_path, newline="", encoding="utf-8") as f:
+            for row in csv.reader(f):
+                if len(row) < 3:
+                    continue
+                try:
+                    start = _ipv4_to_int(row[0].strip())
+                    end = _ipv4_to_int(row[1].strip())
+                except ValueError:
+                    continue  # header line or IPv6 range
+                location = (
+                    row[2].strip() or "Unknown",
+                    row[3].strip() if len(row) > 3 and row[3].strip() else "Unknown",
+                    row[4].strip() if len(row) > 4 and row[4].strip() else "Unknown",
+                    _float_or_none(row[5]) if len(row) > 5 else None,
+                    _float_or_none(row[6]) if len(row) > 6 else None,
+                )
+                if location not in location_ids:
+                    location_ids[location] = len(locations)
+                    locations.append(location)
+                rows.append((start, end, location_ids[location]))
+        rows.sort()
+
+        starts = array("I", (r[0] for r in rows))
+        ends = array("I", (r[1] for r in rows))
+        loc_ids = array("I", (r[2] for r in rows))
+        blob = json.dumps(locations).encode()
+
+        tmp_path = bin_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(rows), len(blob)))
+            starts.tofile(f)
+            ends.tofile(f)
+            loc_ids.tofile(f)
+            f.write(blob)
+        os.replace(tmp_path, bin_path)
+
+    @classmethod
+    def open_compiled(cls, bin_path):
+        """Memory-map a compiled database without copying the range arrays"""
+        with open(bin_path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, blob_size = cls.HEADER.unpack_from(mm, 0)
+        if magic != cls.MAGIC:
+            mm.close()
+            raise ValueError(f"{bin_path} is not a compiled GeoIP database")
+
+        view = memoryview(mm)
+        width = count * 4
+        offset = cls.HEADER.size
+        starts = view[offset:offset + width].cast("I")
+        ends = view[offset + width:offset + 2 * width].cast("I")
+        loc_ids = view[offset + 2 * width:offset + 3 * width].cast("I")
+        blob_offset = offset + 3 * width
+        locations = [tuple(loc) for loc in json.loads(bytes(view[blob_offset:blob_offset + blob_size]))]
+        return cls(starts, ends, loc_ids, locations, backing=mm)
+
+    def lookup(self, ip):
+        """Return the geo dict for ``ip`` or None if no range covers it"""
+        try:
+            value = _ipv4_to_int(ip)
+        except ValueError:
+            return None
+        i = bisect_right(self.starts, value) - 1
+        if i < 0 or value > self.ends[i]:
+            return None
+        country, city, isp, lat, lon = self.locations[self.loc_ids[i]]
+        return {"country": country, "city": city, "isp": isp, "lat": lat, "lon": lon}
+
+
+def _ipv4_to_int(value):
+    """Parse a dotted or integer IPv4 address, raising ValueError otherwise"""
+    if value.isdigit():
+        number = int(value)
+        if number > 0xFFFFFFFF:
+            raise ValueError(value)
+        return number
+    return int(ipaddress.IPv4Address(value))
+
+def _float_or_none(value):
+    """Parse an optional coordinate column"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def load_geoip_database(path):
+    """Load the offline GeoIP database if one is configured"""
+    if not path:
+        return None
+    try:
+        db = GeoIPDatabase.load(path)
+    except (OSError, ValueError) as e:
+        print(f"[GEOIP] Could not load {path}: {e}")
+        return None
+    print(f"[GEOIP] Loaded {len(db)} ranges from {path}")
+    return db
+
+GEOIP_DB = load_geoip_database(GEOIP_DB_PATH)
+
+# Shared outbound HTTP client. Every call to a third party (ip-api.com, GIF
+# CDNs) goes through OUTBOUND so connections are kept alive and reused, the
+# number of calls in flight per host is capped, and a host that keeps failing
+# is short-circuited for a while instead of tying up threads on timeouts.
+
+class OutboundUnavailable(requests.RequestException):
+    """Call refused locally: the host's circuit is open or its slots are busy"""
+
+
+class _OutboundHost:
+    """Per-host session, concurrency slots, circuit state and latency stats"""
+
+    def __init__(self, pool_size, max_in_flight):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=256)  # seconds, most recent calls
+
+
+class OutboundClient:
+    """Pooled, bounded HTTP client with per-host circuit breakers"""
+
+    def __init__(self, max_in_flight_per_host=8, pool_size=8, failure_threshold=5,
+                 reset_timeout=30.0, acquire_timeout=2.0, max_hosts=256):
+        self.max_in_flight_per_host = max_in_flight_per_host
+        self.pool_size = pool_size
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.acquire_timeout = acquire_timeout
+        self.max_hosts = max_hosts
+        self._hosts = OrderedDict()  # netloc -> _OutboundHost, least recently used first
+        self._lock = threading.Lock()
+
+    def _host(self, url):
+        # Netlocs come from user-submitted GIF URLs, so the table is an LRU:
+        # idle hosts past max_hosts are dropped and their pooled sockets closed
+        key = urlparse(url).netloc.lower()
+        evicted = []
+        with self._lock:
+            host = self._hosts.get(key)
+            if host is not None:
+                self._hosts.move_to_end(key)
+                return host
+            host = self._hosts[key] = _OutboundHost(self.pool_size, self.max_in_flight_per_host)
+            for old_key in list(self._hosts)[:max(0, len(self._hosts) - self.max_hosts)]:
+                if self._hosts[old_key].in_flight == 0:
+                    evicted.append(self._hosts.pop(old_key))
+        for old in evicted:
+            old.session.close()
+        return host
+
+    def _admit(self, host, url):
+        """Apply the circuit breaker; only one probe passes while half-open"""
+        with host.lock:
+            if host.consecutive_failures < self.failure_threshold:
+                return
+            if time.monotonic() >= host.open_until and not host.probing:
+                host.probing = True
+                return
+            host.rejected += 1
+        raise OutboundUnavailable(f"Circuit open for {urlparse(url).netloc}")
+
+    def _record(self, host, elapsed, ok):
+        with host.lock:
+            host.requests += 1
+            host.latencies.append(elapsed)
+            host.probing = False
+            if ok:
+                host.consecutive_failures = 0
+            else:
+                host.failures += 1
+                host.consecutive_failures += 1
+                if host.consecutive_failures >= self.failure_threshold:
+                    host.open_until = time.monotonic() + self.reset_timeout
+
+    def request(self, method, url, **kwargs):
+        """Send a request; raises OutboundUnavailable instead of waiting on a bad host"""
+        host = self._host(url)
+        self._admit(host, url)
+        if not host.slots.acquire(timeout=self.acquire_timeout):
+            with host.lock:
+                host.rejected += 1
+                host.probing = False
+            raise OutboundUnavailable(f"Too many requests in flight to {urlparse(url).netloc}")
+
+        with host.lock:
+            host.in_flight += 1
+        release = self._releaser(host)
+        start = time.monotonic()
+        try:
+            response = host.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self._record(host, time.monotonic() - start, ok=False)
+            release()
+            raise
+        except BaseException:
+            release()
+            raise
+        self._record(host, time.monotonic() - start, ok=response.status_code < 500)
+        if kwargs.get("stream"):
+            # The body is still to be downloaded: keep the slot until the caller closes the response
+            close = response.close
+
+            def close_and_release():
+                try:
+                    close()
+                finally:
+                    release()
+            response.close = close_and_release
+        else:
+            release()
+        return response
+
+    def _releaser(self, host):
+        """A callable that gives back one slot of host, however many times it is called"""
+        released = False
+
+        def release():
+            nonlocal released
+            with host.lock:
+                if released:
+                    return
+                released = True
+                host.in_flight -= 1
+            host.slots.release()
+        return release
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def metrics(self):
+        """Per-host counters and latency percentiles (milliseconds)"""
+        now = time.monotonic()
+        stats = {}
+        for key, host in list(self._hosts.items()):
+            with host.lock:
+                latencies = sorted(host.latencies)
+                circuit = "closed"
+                if host.consecutive_failures >= self.failure_threshold:
+                    circuit = "open" if now < host.open_until else "half-open"
+                stats[key] = {
+                    "requests": host.requests,
+                    "failures": host.failures,
+                    "rejected": host.rejected,
+                    "in_flight": host.in_flight,
+                    "circuit": circuit,
+                    "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+                    "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 1) if latencies else None,
+                    "max_ms": round(latencies[-1] * 1000, 1) if latencies else None
+                }
+        return stats
+
+
+OUTBOUND = OutboundClient()
+
+UNKNOWN_GEO = {"country": "Unknown", "city": "Unknown", "isp": "Unknown"}
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after a per-entry TTL"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def trim(self):
+        """Drop expired entries, returning how many were removed"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [k for k, (expires_at, _) in self._data.items() if expires_at < now]
+            for key in expired:
+                del self._data[key]
+        return len(expired)
+
+
+# Geolocation is resolved off the request path: lookups that the local
+# database can't answer are queued for a background worker that batches them
+# to ip-api.com and fills ACTIVE_USERS[...]["geo"] once the result arrives.
+GEO_CACHE = TTLCache(maxsize=50000)  # ip -> geo dict, or None for a failed lookup
+GEO_CACHE_TTL = 6 * 3600
+GEO_NEGATIVE_TTL = 5 * 60
+GEO_BATCH_SIZE = 100  # ip-api.com batch endpoint limit
+GEO_WORKERS = 2
+GEO_QUEUE = queue.Queue(maxsize=1000)
+GEO_PENDING = {}  # ip -> set of usernames waiting for that ip's result
+GEO_LOCK = threading.Lock()
+_geo_threads = []
+
+def lookup_geolocation_local(ip):
+    """Resolve an IP without any network I/O, or return None"""
+    if ip.startswith('127.') or ip.startswith('192.168.') or ip.startswith('10.'):
+        return {"country": "Local", "city": "Local Network", "isp": "Private"}
+    if GEOIP_DB is not None:
+        return GEOIP_DB.lookup(ip)
+    return None
+
+def fetch_geolocation_batch(ips):
+    """Look up several IPs with one ip-api.com batch call: ip -> geo or None"""
+    results = dict.fromkeys(ips)
+    try:
+        response = OUTBOUND.post(
+            'http://ip-api.com/batch?fields=status,country,city,isp,lat,lon,query',
+            json=list(ips),
+            timeout=3
+        )
+        for data in response.json():
+            if data.get('status') == 'success' and data.get('query') in results:
+                results[data['query']] = {
+                    "country": data.get('country', 'Unknown'),
+                    "city": data.get('city', 'Unknown'),
+                    "isp": data.get('isp', 'Unknown'),
+                    "lat": data.get('lat'),
+                    "lon": data.get('lon')
+                }
+    except Exception as e:
+        print(f"[GEOIP] Batch lookup of {len(ips)} IPs failed: {e}")
+    return results
+
+def resolve_geolocation(ip, username=None):
+    """Return the best geolocation known right now without blocking.
+
+    Cache misses are queued for the background workers; ``username`` (if given)
+    has its ACTIVE_USERS entry updated when the lookup completes.
+    """
+    geo = lookup_geolocation_local(ip)
+    if geo is not None:
+        return geo
+
+    _missing = object()
+    cached = GEO_CACHE.get(ip, _missing)
+    if cached is not _missing:
+        return dict(cached) if cached else dict(UNKNOWN_GEO)
+
+    if not GEOIP_HTTP_FALLBACK:
+        return dict(UNKNOWN_GEO)
+
+    with GEO_LOCK:
+        waiters = GEO_PENDING.get(ip)
+        if waiters is None:
+            # First request for this IP: enqueue it; later ones just wait on it
+            try:
+                GEO_QUEUE.put_nowait(ip)
+            except queue.Full:
+                return dict(UNKNOWN_GEO)
+            waiters = GEO_PENDING[ip] = set()
+        if username:
+            waiters.add(username)
+    _ensure_geo_workers()
+    return dict(UNKNOWN_GEO)
+
+def catch_up_user_geo(username, ip, geo):
+    """Apply a lookup that finished while the user's ACTIVE_USERS entry was being added.
+
+    resolve_geolocation registers the waiter before that entry exists, so a
+    quick result is dropped by set_user_geo; it is in GEO_CACHE by then.
+    """
+    if geo == UNKNOWN_GEO:
+        cached = GEO_CACHE.get(ip)
+        if cached:
+            set_user_geo(username, ip, dict(cached))
+
+def _ensure_geo_workers():
+    with GEO_LOCK:
+        if _geo_threads:
+            return
+        for i in range(GEO_WORKERS):
+            thread = threading.Thread(target=_geo_worker, name=f"geo-worker-{i}", daemon=True)
+            thread.start()
+            _geo_threads.append(thread)
+
+def _geo_worker():
+    while True:
+        batch = [GEO_QUEUE.get()]
+        while len(batch) < GEO_BATCH_SIZE:
+            try:
+                batch.append(GEO_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+
+        results = fetch_geolocation_batch(batch)
+        for ip, geo in results.items():
+            GEO_CACHE.set(ip, geo, GEO_CACHE_TTL if geo else GEO_NEGATIVE_TTL)
+            with GEO_LOCK:
+                waiters = GEO_PENDING.pop(ip, ())
+            for username in waiters:
+                set_user_geo(username, ip, dict(geo or UNKNOWN_GEO))
 
 def validate_gif_url(url):
     """Validate and sanitize GIF URL"""
@@ -101,7 +1100,7 @@ def validate_gif_url(url):
             return False
         
         # Check if it's a GIF
-        response = requests.head(url, timeout=5)
+        response = OUTBOUND.head(url, timeout=5)
         content_type = response.headers.get('content-type', '')
         if 'image/gif' in content_type or url.lower().endswith('.gif'):
             return True
@@ -109,6 +1108,249 @@ def validate_gif_url(url):
     except:
         return False
 
+def normalize_gif_url(url):
+    """Canonical form of a GIF URL for caching, or None if it can't be valid"""
+    try:
+        parsed = urlparse(url)
+        if parsed.scheme.lower() not in ('http', 'https') or not parsed.hostname:
+            return None
+        scheme = parsed.scheme.lower()
+        netloc = parsed.hostname.lower()
+        if parsed.port and parsed.port != {'http': 80, 'https': 443}[scheme]:
+            netloc = f"{netloc}:{parsed.port}"
+        return parsed._replace(scheme=scheme, netloc=netloc, fragment='').geturl()
+    except ValueError:
+        return None
+
+
+# GIF URLs are checked in the background so /send-gif never waits on a remote
+# CDN: the message is posted as "pending" and flips to "valid" or "invalid"
+# once the HEAD request completes. Results are cached per normalized URL.
+# Checks against one host are spaced GIF_HOST_MIN_INTERVAL apart by holding
+# the extra ones in a per-host queue that a timer feeds to the executor, so a
+# burst on one CDN waits there instead of putting every worker to sleep.
+GIF_VALIDATION_CACHE = TTLCache(maxsize=10000)  # normalized url -> True/False
+GIF_VALID_TTL = 60 * 60
+GIF_INVALID_TTL = 10 * 60
+GIF_VALIDATION_WORKERS = 4  # max outbound checks in flight
+GIF_VALIDATION_MAX_PENDING = 1000  # URLs queued or being checked before /send-gif is refused
+GIF_HOST_MIN_INTERVAL = 0.2  # seconds between checks against the same host
+GIF_VALIDATION_EXECUTOR = ThreadPoolExecutor(max_workers=GIF_VALIDATION_WORKERS, thread_name_prefix="gif-validate")
+GIF_VALIDATION_PENDING = {}  # normalized url -> [(room, message id) waiting on it]
+GIF_VALIDATION_LOCK = threading.Lock()
+_gif_host_queues = {}  # host -> deque of URLs waiting for its next slot, while a timer is set
+_gif_host_next_slot = {}  # host -> monotonic time of the next allowed check
+
+def request_gif_validation(url, waiter=None):
+    """Return "valid", "invalid", "pending" or "busy" for a normalized GIF URL.
+
+    On a cache miss a background check is scheduled (once per URL) and the
+    ``(room, message_id)`` in ``waiter`` gets its ``gif_status`` updated when
+    it finishes. Without a waiter, a new check is refused ("busy") once
+    GIF_VALIDATION_MAX_PENDING URLs are outstanding; /send-gif asks that way
+    before posting, so a message it has already posted is always followed up.
+    """
+    # An evicted proxy copy counts as a miss, so the check re-fetches it
+    cached = cached_gif_display_url(url)
+    if cached is not None:
+        return "valid" if cached else "invalid"
+
+    with GIF_VALIDATION_LOCK:
+        waiters = GIF_VALIDATION_PENDING.get(url)
+        if waiters is None:
+            if waiter is None and len(GIF_VALIDATION_PENDING) >= GIF_VALIDATION_MAX_PENDING:
+                return "busy"
+            waiters = GIF_VALIDATION_PENDING[url] = []
+            _schedule_gif_check(url)
+        if waiter is not None:
+            waiters.append(waiter)
+    return "pending"
+
+def _schedule_gif_check(url):
+    """Submit a check now if its host is free, else queue it for the host's next slot (holding GIF_VALIDATION_LOCK)"""
+    host = urlparse(url).hostname
+    waiting = _gif_host_queues.get(host)
+    if waiting is not None:
+        waiting.append(url)  # the host's timer will get to it
+        return
+    now = time.monotonic()
+    if len(_gif_host_next_slot) > GIF_VALIDATION_MAX_PENDING:
+        for stale in [h for h, slot in _gif_host_next_slot.items() if slot <= now]:
+            del _gif_host_next_slot[stale]
+    slot = _gif_host_next_slot.get(host, 0)
+    if slot <= now:
+        _gif_host_next_slot[host] = now + GIF_HOST_MIN_INTERVAL
+        GIF_VALIDATION_EXECUTOR.submit(_run_gif_validation, url)
+    else:
+        _gif_host_queues[host] = deque([url])
+        _start_host_timer(host, slot - now)
+
+def _start_host_timer(host, delay):
+    timer = threading.Timer(delay, _release_host_slot, args=(host,))
+    timer.daemon = True
+    timer.start()
+
+def _release_host_slot(host):
+    """Hand the next queued check for a host to the executor"""
+    with GIF_VALIDATION_LOCK:
+        waiting = _gif_host_queues[host]
+        url = waiting.popleft()
+        if waiting:
+            _start_host_timer(host, GIF_HOST_MIN_INTERVAL)
+        else:
+            del _gif_host_queues[host]
+        _gif_host_next_slot[host] = time.monotonic() + GIF_HOST_MIN_INTERVAL
+        try:
+            GIF_VALIDATION_EXECUTOR.submit(_run_gif_validation, url)
+        except RuntimeError:
+            pass  # shutting down
+
+def cached_gif_display_url(url):
+    """URL clients should load for a normalized GIF URL.
+
+    Returns None if the URL hasn't been checked yet (or its proxied copy was
+    evicted) and False if it was found to be invalid.
+    """
+    display_url = GIF_VALIDATION_CACHE.get(url)
+    if display_url and display_url.startswith("/media/") and not media_cache_has(display_url[len("/media/"):]):
+        return None
+    return display_url
+
+def _run_gif_validation(url):
+    display_url = False
+    try:
+        display_url = url if validate_gif_url(url) else False
+        if display_url and MEDIA_PROXY_ENABLED:
+            name = fetch_gif_to_cache(url)
+            if name:
+                display_url = f"/media/{name}"
+                if MEDIA_ORIGINS.get(name) != url:
+                    record_media_origin(name, url)
+        GIF_VALIDATION_CACHE.set(url, display_url, GIF_VALID_TTL if display_url else GIF_INVALID_TTL)
+    except Exception as e:
+        # Not cached, so the next send retries; the messages waiting now show as invalid
+        print(f"[MEDIA] GIF check for {url} failed: {e}")
+        display_url = False
+    finally:
+        # Always clear the entry, or the URL and everything waiting on it stay pending
+        with GIF_VALIDATION_LOCK:
+            waiters = GIF_VALIDATION_PENDING.pop(url, [])
+        if waiters:
+            resolve_gif_messages(waiters, "valid" if display_url else "invalid", display_url)
+
+
+# Content-addressed media cache: files live in MEDIA_CACHE_DIR as
+# "<sha256>.<ext>", so identical GIFs from different URLs share one copy.
+# MEDIA_INDEX keeps them in LRU order for eviction past MEDIA_CACHE_MAX_BYTES.
+MEDIA_INDEX = OrderedDict()  # name -> size in bytes
+MEDIA_CACHE_BYTES = 0
+MEDIA_LOCK = threading.Lock()
+MEDIA_NAME_RE = re.compile(r'^[0-9a-f]{64}\.(gif|png|jpg|webp)$')
+MEDIA_MIMETYPES = {"gif": "image/gif", "png": "image/png", "jpg": "image/jpeg", "webp": "image/webp"}
+
+def _load_media_cache():
+    """Index files already on disk, least recently used first"""
+    global MEDIA_CACHE_BYTES
+    if not os.path.isdir(MEDIA_CACHE_DIR):
+        return
+    entries = []
+    for entry in os.scandir(MEDIA_CACHE_DIR):
+        if MEDIA_NAME_RE.match(entry.name):
+            stat = entry.stat()
+            entries.append((stat.st_atime, entry.name, stat.st_size))
+    for _, name, size in sorted(entries):
+        MEDIA_INDEX[name] = size
+        MEDIA_CACHE_BYTES += size
+    _evict_media()
+
+def _evict_media():
+    """Drop least recently used files until the cache fits its budget"""
+    global MEDIA_CACHE_BYTES
+    with MEDIA_LOCK:
+        victims = []
+        while MEDIA_CACHE_BYTES > MEDIA_CACHE_MAX_BYTES and len(MEDIA_INDEX) > 1:
+            name, size = MEDIA_INDEX.popitem(last=False)
+            MEDIA_CACHE_BYTES -= size
+            victims.append(name)
+    for name in victims:
+        try:
+            os.remove(os.path.join(MEDIA_CACHE_DIR, name))
+        except OSError:
+            pass
+
+def media_cache_has(name):
+    """Whether a cache name is currently stored on disk"""
+    global MEDIA_CACHE_BYTES
+    if name in MEDIA_INDEX:
+        return True
+    # Another worker process may have written it since we indexed the directory
+    try:
+        size = os.path.getsize(os.path.join(MEDIA_CACHE_DIR, name))
+    except OSError:
+        return False
+    with MEDIA_LOCK:
+        if name not in MEDIA_INDEX:
+            MEDIA_INDEX[name] = size
+            MEDIA_CACHE_BYTES += size
+    return True
+
+def _write_media_file(directory, name, data):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def media_store_put(data, ext):
+    """Keep uploaded bytes for good under their content hash and return the name"""
+    name = f"{hashlib.sha256(data).hexdigest()}.{ext}"
+    if not media_store_has(name):
+        _write_media_file(MEDIA_STORE_DIR, name, data)
+    return name
+
+def media_store_has(name):
+    return os.path.isfile(os.path.join(MEDIA_STORE_DIR, name))
+
+def media_cache_put(data, ext):
+    """Store bytes under their content hash and return the cache name"""
+    global MEDIA_CACHE_BYTES
+    name = f"{hashlib.sha256(data).hexdigest()}.{ext}"
+    with MEDIA_LOCK:
+        if name in MEDIA_INDEX:
+            MEDIA_INDEX.move_to_end(name)
+            return name
+    _write_media_file(MEDIA_CACHE_DIR, name, data)
+    with MEDIA_LOCK:
+        if name not in MEDIA_INDEX:
+            MEDIA_INDEX[name] = len(data)
+            MEDIA_CACHE_BYTES += len(data)
+    _evict_media()
+    return name
+
+def fetch_gif_to_cache(url):
+    """Download a GIF into the media cache, returning its name or None"""
+    try:
+        with OUTBOUND.get(url, timeout=10, stream=True) as response:
+            if response.status_code != 200:
+                return None
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(64 * 1024):
+                size += len(chunk)
+                if size > app.config['MAX_CONTENT_LENGTH']:
+                    return None
+                chunks.append(chunk)
+        data = b"".join(chunks)
+        if not data.startswith((b"GIF87a", b"GIF89a")):
+            return None
+        return media_cache_put(data, "gif")
+    except (requests.RequestException, OSError) as e:
+        print(f"[MEDIA] Could not cache {url}: {e}")
+        return None
+
+_load_media_cache()
+
 def compress_gif_data(gif_data):
     """Compress GIF data while maintaining quality"""
     try:
@@ -120,6 +1362,249 @@ def compress_gif_data(gif_data):
     except:
         return gif_data
 
+# Direct GIF/image uploads are re-encoded in a process pool so Pillow never
+# holds the GIL of a request thread. Each upload yields the optimized image,
+# a static first-frame poster and a downscaled preview, all kept in the
+# media store. Frame and pixel budgets keep one upload from hogging the pool,
+# and the per-user cap keeps one client from filling the queue.
+MEDIA_POOL_WORKERS = int(os.environ.get("MEDIA_POOL_WORKERS", 2))
+MEDIA_MAX_PENDING_JOBS = 8
+MEDIA_MAX_PENDING_PER_USER = 2
+MEDIA_MAX_FRAMES = 300
+MEDIA_MAX_FRAME_PIXELS = 2048 * 2048
+MEDIA_MAX_TOTAL_PIXELS = 60 * 1000 * 1000  # frames * width * height
+MEDIA_PREVIEW_SIZE = (320, 320)
+UPLOAD_JOBS = TTLCache(maxsize=1000)  # upload_id -> {"status": ..., "message_id"/"error": ...}
+UPLOAD_JOB_TTL = 60 * 60
+UPLOAD_LOCK = threading.Lock()
+_media_pool = None
+_media_pending_jobs = 0
+_media_pending_by_user = defaultdict(int)  # username -> uploads queued or transcoding
+
+def check_image_budget(width, height, frames=1):
+    """Raise ValueError if an image exceeds the transcoding budgets"""
+    if width * height > MEDIA_MAX_FRAME_PIXELS:
+        raise ValueError(f"Image too large ({width}x{height})")
+    if frames > MEDIA_MAX_FRAMES:
+        raise ValueError(f"Too many frames ({frames} > {MEDIA_MAX_FRAMES})")
+    if frames * width * height > MEDIA_MAX_TOTAL_PIXELS:
+        raise ValueError("Animation too large")
+
+def transcode_image(path):
+    """Produce the optimized image, poster and preview for an uploaded file.
+
+    Runs inside the media process pool, so it must stay a top-level function.
+    It takes a path rather than bytes so the upload is never pickled across.
+    """
+    Image.MAX_IMAGE_PIXELS = MEDIA_MAX_FRAME_PIXELS
+    with open(path, "rb") as f:
+        data = f.read()
+    img = Image.open(BytesIO(data))
+    width, height = img.size
+    check_image_budget(width, height)
+    frames = getattr(img, "n_frames", 1)
+    check_image_budget(width, height, frames)
+
+    if img.format == "GIF":
+        main, main_ext = compress_gif_data(data), "gif"
+        if len(main) >= len(data):
+            main = data
+    else:
+        output = BytesIO()
+        if img.format == "JPEG":
+            img.convert("RGB").save(output, format="JPEG", optimize=True, quality=85)
+            main_ext = "jpg"
+        else:
+            img.convert("RGBA").save(output, format="PNG", optimize=True)
+            main_ext = "png"
+        main = output.getvalue()
+
+    img.seek(0)
+    first_frame = img.convert("RGBA")
+    output = BytesIO()
+    first_frame.save(output, format="PNG", optimize=True)
+    poster = output.getvalue()
+
+    output = BytesIO()
+    if frames > 1:
+        thumbs = []
+        durations = []
+        for frame in ImageSequence.Iterator(img):
+            durations.append(frame.info.get("duration", 100))
+            thumb = frame.convert("RGBA")
+            thumb.thumbnail(MEDIA_PREVIEW_SIZE)
+            thumbs.append(thumb)
+        thumbs[0].save(output, format="GIF", save_all=True, append_images=thumbs[1:],
+                       duration=durations, loop=0, optimize=True, disposal=2)
+        preview_ext = "gif"
+    else:
+        first_frame.thumbnail(MEDIA_PREVIEW_SIZE)
+        first_frame.save(output, format="PNG", optimize=True)
+        preview_ext = "png"
+
+    return {
+        "main": main, "main_ext": main_ext,
+        "poster": poster,
+        "preview": output.getvalue(), "preview_ext": preview_ext,
+        "width": width, "height": height, "frames": frames
+    }
+
+def get_media_pool():
+    """Process pool for transcoding, started on first use"""
+    global _media_pool
+    with UPLOAD_LOCK:
+        if _media_pool is None:
+            _media_pool = ProcessPoolExecutor(max_workers=MEDIA_POOL_WORKERS)
+        return _media_pool
+
+def submit_media_upload(path, digest, username, room):
+    """Queue an uploaded file for transcoding; returns its upload id or None if busy"""
+    global _media_pending_jobs
+    with UPLOAD_LOCK:
+        if _media_pending_jobs >= MEDIA_MAX_PENDING_JOBS or _media_pending_by_user[username] >= MEDIA_MAX_PENDING_PER_USER:
+            return None
+        _media_pending_jobs += 1
+        _media_pending_by_user[username] += 1
+    upload_id = generate_message_id()
+    set_upload_job(upload_id, {"status": "processing"})
+    future = get_media_pool().submit(transcode_image, path)
+    future.add_done_callback(lambda f: _finish_media_upload(f, upload_id, path, digest, username, room))
+    return upload_id
+
+def _finish_media_upload(future, upload_id, path, digest, username, room):
+    global _media_pending_jobs
+    try:
+        _post_media_upload(future, upload_id, path, digest, username, room)
+    finally:
+        # Only now, so a draining shutdown waits for the message to be posted
+        with UPLOAD_LOCK:
+            _media_pending_jobs -= 1
+            _media_pending_by_user[username] -= 1
+            if not _media_pending_by_user[username]:
+                del _media_pending_by_user[username]
+
+def _post_media_upload(future, upload_id, path, digest, username, room):
+    try:
+        result = future.result()
+    except ValueError as e:
+        set_upload_job(upload_id, {"status": "failed", "error": str(e)})
+        return
+    except Exception as e:
+        print(f"[MEDIA] Upload {upload_id} from {username} failed: {e}")
+        set_upload_job(upload_id, {"status": "failed", "error": "Could not process image"})
+        return
+    finally:
+        _remove_quietly(path)
+
+    urls = {
+        "gif_url": "/media/" + media_store_put(result["main"], result["main_ext"]),
+        "poster_url": "/media/" + media_store_put(result["poster"], "png"),
+        "preview_url": "/media/" + media_store_put(result["preview"], result["preview_ext"])
+    }
+    UPLOAD_SOURCES.set(digest, urls, UPLOAD_SOURCE_TTL)
+    message_id = post_uploaded_gif(username, room, urls)
+    set_upload_job(upload_id, {"status": "done", "message_id": message_id})
+
+def post_uploaded_gif(username, room, urls):
+    """Append a message for a transcoded upload and return its id"""
+    message = new_message(
+        username,
+        f"[GIF uploaded by {username}]",
+        gif_url=urls["gif_url"],
+        poster_url=urls["poster_url"],
+        preview_url=urls["preview_url"],
+        gif_status="valid"
+    )
+    append_message(room, message, {"gif_url": urls["gif_url"], "gif_status": "valid", "deleted": False})
+    return message["id"]
+
+
+# Upload bodies are streamed to a temp file in fixed-size chunks and hashed on
+# the way, so concurrent uploads cost one chunk of memory each. The hash lets a
+# re-upload of the same bytes reuse the earlier transcode.
+MEDIA_UPLOAD_CHUNK = 64 * 1024
+MEDIA_UPLOAD_MAX_BYTES = app.config['MAX_CONTENT_LENGTH']
+MEDIA_UPLOAD_DIR = os.path.join(MEDIA_CACHE_DIR, "incoming")
+UPLOAD_SOURCES = TTLCache(maxsize=10000)  # sha256 of uploaded bytes -> media urls
+UPLOAD_SOURCE_TTL = 24 * 3600
+MEDIA_TEMP_MAX_AGE = 3600  # seconds before a leftover .upload/.tmp file counts as abandoned
+
+class UploadRejected(Exception):
+    """Upload refused before it was fully read; carries the HTTP status"""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+def sniff_image_type(head):
+    """Image type from the first 12 bytes of a file, or None"""
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "gif"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+def stream_upload_to_file(stream, content_length):
+    """Copy an upload body to a temp file; returns (path, sha256 hex digest)"""
+    if content_length and content_length > MEDIA_UPLOAD_MAX_BYTES:
+        raise UploadRejected("File too large", 413)
+
+    os.makedirs(MEDIA_UPLOAD_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=MEDIA_UPLOAD_DIR, suffix=".upload")
+    digest = hashlib.sha256()
+    head = b""
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = stream.read(MEDIA_UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                if len(head) < 12:
+                    head += chunk[:12 - len(head)]
+                    if len(head) == 12 and sniff_image_type(head) is None:
+                        raise UploadRejected("Unsupported image", 415)
+                size += len(chunk)
+                if size > MEDIA_UPLOAD_MAX_BYTES:
+                    raise UploadRejected("File too large", 413)
+                digest.update(chunk)
+                f.write(chunk)
+        if sniff_image_type(head) is None:
+            raise UploadRejected("Unsupported image", 415)
+    except BaseException:
+        _remove_quietly(path)
+        raise
+    return path, digest.hexdigest()
+
+def sweep_media_temp_files():
+    """Delete partial uploads and writes left behind by a crash; returns how many"""
+    cutoff = time.time() - MEDIA_TEMP_MAX_AGE
+    removed = 0
+    for directory, suffix in ((MEDIA_UPLOAD_DIR, ".upload"), (MEDIA_CACHE_DIR, ".tmp"), (MEDIA_STORE_DIR, ".tmp")):
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                # By age, as other workers may be writing theirs right now
+                if entry.name.endswith(suffix) and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
 def admin_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -128,9 +1613,461 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated
 
+class RateLimiter:
+    """Token buckets for many keys, stored as one float per key.
+
+    A bucket with capacity ``burst`` refilling at ``rate`` tokens a second is
+    fully described by the time at which it will be full again (GCRA), so
+    refill is computed on access and a bucket that is already full can be
+    deleted: recreating it later gives the same answer.
+    """
+
+    def __init__(self, limits, max_keys):
+        self.limits = limits
+        self.max_keys = max_keys
+        self.buckets = {}  # (route, scope) -> {key: monotonic time the bucket is full again}
+        self.limited = defaultdict(int)  # (route, scope) -> requests refused
+        self.lock = threading.Lock()
+
+    def hit(self, route, keys):
+        """Take a token from every bucket in `keys` ({scope: key}), or from none.
+
+        Returns 0 if the request may proceed, otherwise the seconds until it would.
+        """
+        now = time.monotonic()
+        with self.lock:
+            updates = []
+            retry_after = 0.0
+            for scope, key in keys.items():
+                limit = self.limits.get(route, {}).get(scope)
+                if not limit or not limit[0] or key is None:
+                    continue
+                burst, rate = limit
+                interval = 1.0 / rate
+                table = self.buckets.setdefault((route, scope), {})
+                full_at = max(table.get(key, now), now) + interval
+                wait = full_at - now - burst * interval
+                if wait > 0:
+                    self.limited[(route, scope)] += 1
+                    retry_after = max(retry_after, wait)
+                updates.append((table, key, full_at))
+            if retry_after:
+                return retry_after
+            for table, key, full_at in updates:
+                table[key] = full_at
+                if len(table) > self.max_keys:
+                    # Forget the oldest-inserted key; at worst it gets a fresh bucket
+                    del table[next(iter(table))]
+            return 0
+
+    def gc(self):
+        """Drop buckets that have refilled completely; returns how many"""
+        removed = 0
+        for table in list(self.buckets.values()):
+            keys = list(table)
+            # In slices, so a sweep over millions of keys never holds the lock for long
+            for start in range(0, len(keys), 10000):
+                now = time.monotonic()
+                with self.lock:
+                    for key in keys[start:start + 10000]:
+                        full_at = table.get(key)
+                        if full_at is not None and full_at <= now:
+                            del table[key]
+                            removed += 1
+        return removed
+
+    def metrics(self):
+        return {
+            f"{route}/{scope}": {"keys": len(table), "limited": self.limited[(route, scope)]}
+            for (route, scope), table in list(self.buckets.items())
+        }
+
+
+RATE_LIMITER = RateLimiter(RATE_LIMITS, RATE_LIMIT_MAX_KEYS)
+
+def _ip_key(ip):
+    """IPs as ints where possible: smaller keys than strings"""
+    try:
+        return int(ipaddress.ip_address(ip))
+    except ValueError:
+        return ip
+
+def rate_limited(route):
+    """Refuse the request with 429 once the user's or the IP's bucket for `route` is empty"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            retry_after = RATE_LIMITER.hit(route, {
+                "user": session.get("username"),
+                "ip": _ip_key(rate_limit_ip() or "")
+            })
+            if retry_after:
+                return "Too many requests, slow down", 429, {"Retry-After": str(math.ceil(retry_after))}
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+def room_lock(room):
+    """Per-room write lock, created on first use"""
+    lock = ROOM_LOCKS.get(room)
+    if lock is None:
+        lock = ROOM_LOCKS.setdefault(room, threading.Lock())
+    return lock
+
+# Mutations of shared chat state. Each one is replayed verbatim by every
+# prefork worker, so it must only depend on its arguments and the state it
+# changes (no clocks, no ids, no I/O).
+
+@shared_op
+def append_message(room, message, metadata=None):
+    """Append to a room's history under its lock"""
+    with room_lock(room):
+        messages = MESSAGES[room]
+        if messages:
+            keep_ts_order(message, messages[-1]["ts"])
+        rotated = len(messages) == messages.maxlen
+        evicted = messages[0] if rotated else None
+        messages.append(message)
+        index_user_message(room, message, evicted)
+    with STATS_LOCK:
+        STATS["messages"] += not rotated
+        STATS["messages_sent"] += 1
+        STATS["gifs_sent"] += "gif_url" in message
+        ROOM_SENDS[room] += 1
+        SEND_RATE.add(message["ts"] / 1000)
+    # After the append, so gc_message_metadata never sees metadata for a
+    # message it can't find yet
+    if metadata is not None:
+        MESSAGE_METADATA[message["id"]] = metadata
+
+@shared_op
+def clear_room(room):
+    with room_lock(room):
+        cleared = len(MESSAGES[room])
+        authors = {message.get("user") for message in MESSAGES[room]}
+        MESSAGES[room].clear()
+        with USER_MESSAGES_LOCK:
+            for username in authors:
+                unindex_user_messages(room, username)
+    with STATS_LOCK:
+        STATS["messages"] -= cleared
+
+@shared_op
+def post_broadcast(message):
+    with CHANNEL_LOCK:
+        BROADCASTS.post(message)
+
+@shared_op
+def post_to_inbox(username, message):
+    with CHANNEL_LOCK:
+        inbox = INBOXES.get(username)
+        if inbox is None:
+            inbox = INBOXES[username] = Channel(INBOX_MAXLEN)
+        inbox.post(message)
+
+@shared_op
+def expire_inboxes(threshold_ms):
+    """Drop inboxes whose newest message is older than threshold_ms"""
+    with CHANNEL_LOCK:
+        for username, inbox in list(INBOXES.items()):
+            if not inbox.entries or inbox.entries[-1][1]["ts"] < threshold_ms:
+                del INBOXES[username]
+
+@shared_op
+def mark_messages_deleted(message_ids):
+    for message_id in message_ids:
+        MESSAGE_METADATA[message_id] = {"deleted": True}
+
+@shared_op
+def gc_message_metadata():
+    """Forget metadata (and media origins) for messages that have rotated out of every room"""
+    candidates = list(MESSAGE_METADATA)
+    origins = list(MEDIA_ORIGINS)
+    live = set()
+    shown = set()  # gif_urls still on a message
+    for room, messages in list(MESSAGES.items()):
+        with room_lock(room):
+            live.update(message.get("id") for message in messages)
+            shown.update(message["gif_url"] for message in messages if message.get("gif_url"))
+    stale = [message_id for message_id in candidates if message_id not in live]
+    for message_id in stale:
+        MESSAGE_METADATA.pop(message_id, None)
+    for name in origins:
+        if f"/media/{name}" not in shown:
+            MEDIA_ORIGINS.pop(name, None)
+    return len(stale)
+
+@shared_op
+def record_media_origin(name, url):
+    MEDIA_ORIGINS[name] = url
+
+@shared_op
+def resolve_gif_messages(waiters, status, display_url):
+    """Record a finished GIF check on the (room, message id) pairs waiting for it"""
+    for room, message_id in waiters:
+        metadata = MESSAGE_METADATA.get(message_id)
+        if metadata is not None:
+            metadata["gif_status"] = status
+            if display_url:
+                metadata["gif_url"] = display_url
+        for message in list(MESSAGES.get(room, ())):
+            if message["id"] == message_id:
+                message["gif_status"] = status
+                if display_url:
+                    message["gif_url"] = display_url
+                break
+
+@shared_op
+def add_room(room_id, room_data):
+    ROOMS[room_id] = room_data
+
+@shared_op
+def record_uploaded_gif(gif_id, gif_data):
+    UPLOADED_GIFS[gif_id] = gif_data
+
+@shared_op
+def set_upload_job(upload_id, job):
+    UPLOAD_JOBS.set(upload_id, job, UPLOAD_JOB_TTL)
+
+@shared_op
+def add_active_user(username, user_data, replace=False):
+    """Register a user as online; an existing entry is kept unless replace"""
+    with ACTIVE_USERS_LOCK:
+        if replace or username not in ACTIVE_USERS:
+            ACTIVE_USERS[username] = user_data
+            ACTIVE_USER_INDEX.update(username, user_data)
+
+@shared_op
+def remove_active_user(username):
+    with ACTIVE_USERS_LOCK:
+        ACTIVE_USERS.pop(username, None)
+        ACTIVE_USER_INDEX.remove(username)
+
+@shared_op
+def touch_active_user(username, **fields):
+    """Update an ACTIVE_USERS entry in place if the user is still there"""
+    with ACTIVE_USERS_LOCK:
+        user_data = ACTIVE_USERS.get(username)
+        if user_data is not None:
+            user_data.update(fields)
+            ACTIVE_USER_INDEX.update(username, user_data)
+    return user_data is not None
+
+@shared_op
+def clear_typing(username):
+    user_data = ACTIVE_USERS.get(username)
+    if user_data is not None:
+        user_data.pop("typing", None)
+
+@shared_op
+def set_user_geo(username, ip, geo):
+    """Fill in a user's location if they are still on the ip it was looked up for"""
+    with ACTIVE_USERS_LOCK:
+        user_data = ACTIVE_USERS.get(username)
+        if user_data is not None and user_data.get("ip") == ip:
+            user_data["geo"] = geo
+            ACTIVE_USER_INDEX.update(username, user_data)
+
+@shared_op
+def evict_inactive_users(threshold, keep=None):
+    """Drop users not seen since threshold (except keep)"""
+    with ACTIVE_USERS_LOCK:
+        for user in ACTIVE_USER_INDEX.seen_before(threshold):
+            if user != keep:
+                del ACTIVE_USERS[user]
+                ACTIVE_USER_INDEX.remove(user)
+
+@shared_op
+def init_user_profile(username, profile):
+    USER_PROFILES.setdefault(username, profile)
+
+@shared_op
+def update_user_profile(username, **fields):
+    if username in USER_PROFILES:
+        USER_PROFILES[username].update(fields)
+
+def effect_table(target_type):
+    return BLACKLIST if target_type == "ip" else USER_EFFECTS
+
+@shared_op
+def set_effect(target_type, identifier, effect_data):
+    with MODERATION_LOCK:
+        effect_table(target_type)[identifier] = effect_data
+
+@shared_op
+def set_user_effects(usernames, effect_data):
+    with MODERATION_LOCK:
+        for username in usernames:
+            USER_EFFECTS[username] = dict(effect_data)
+
+@shared_op
+def remove_effect(target_type, identifier):
+    with MODERATION_LOCK:
+        effect_table(target_type).pop(identifier, None)
+
+@shared_op
+def expire_effect(target_type, key, effect_data):
+    """Remove an expired effect unless it was replaced meanwhile"""
+    with MODERATION_LOCK:
+        effects = effect_table(target_type)
+        if effects.get(key) == effect_data:
+            del effects[key]
+
+@shared_op
+def expire_effects(now):
+    with MODERATION_LOCK:
+        for effects in (BLACKLIST, USER_EFFECTS):
+            for key, data in list(effects.items()):
+                if data.get("expires") and data["expires"] < now:
+                    del effects[key]
+
+def _apply_ban(ban_type, identifier, banned):
+    """set_ban without the lock; returns whether the ban list changed"""
+    bans = BANNED_IPS if ban_type == "ip" else BANNED_USERS
+    changed = (identifier in bans) != banned
+    if banned:
+        bans.add(identifier)
+    else:
+        bans.discard(identifier)
+    if ban_type != "ip" or not banned:
+        effect_table(ban_type).pop(identifier, None)
+    return changed
+
+@shared_op
+def set_ban(ban_type, identifier, banned):
+    """Ban or unban an ip/username; either way its screen effect is dropped"""
+    with MODERATION_LOCK:
+        _apply_ban(ban_type, identifier, banned)
+
+@shared_op
+def clear_moderation():
+    with MODERATION_LOCK:
+        BANNED_IPS.clear()
+        BANNED_USERS.clear()
+        BLACKLIST.clear()
+        USER_EFFECTS.clear()
+
+@shared_op
+def apply_moderation_batch(items):
+    """Apply validated bulk items in order as one change with one epoch bump; returns (epoch, results)"""
+    global MODERATION_EPOCH
+    results = []
+    with MODERATION_LOCK:
+        for item in items:
+            action, target_type, identifier = item["action"], item["type"], item["identifier"]
+            if action in ("ban", "unban"):
+                results.append({"changed": _apply_ban(target_type, identifier, action == "ban")})
+            elif action == "effect":
+                effect_table(target_type)[identifier] = dict(item["effect"])
+                results.append({"changed": True})
+            elif action == "clear-effect":
+                results.append({"changed": effect_table(target_type).pop(identifier, None) is not None})
+            elif action == "delete-messages":
+                message_ids = user_message_ids(identifier)
+                for message_id in message_ids:
+                    MESSAGE_METADATA[message_id] = {"deleted": True}
+                results.append({"changed": bool(message_ids), "deleted": len(message_ids)})
+        with MODERATION_EPOCH_LOCK:
+            if any(item["action"] != "delete-messages" for item in items):
+                MODERATION_EPOCH += 1
+            return MODERATION_EPOCH, results
+
+@shared_op
+def bump_moderation_epoch():
+    """Advance the moderation epoch after a ban or effect change"""
+    global MODERATION_EPOCH
+    with MODERATION_EPOCH_LOCK:
+        MODERATION_EPOCH += 1
+        return MODERATION_EPOCH
+
+@shared_op
+def seed_moderation_epoch(epoch):
+    """Start every worker from the same epoch"""
+    global MODERATION_EPOCH
+    MODERATION_EPOCH = epoch
+
+@shared_op
+def update_poll_interval(interval):
+    global POLL_INTERVAL
+    POLL_INTERVAL = interval
+
+class SnowflakeGenerator:
+    """64-bit time-ordered ids: 41 bits ms since EPOCH_MS, 10 bits node, 12 bits sequence"""
+
+    EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+    NODE_BITS = 10
+    SEQUENCE_BITS = 12
+
+    def __init__(self, node_id):
+        if not 0 <= node_id < (1 << self.NODE_BITS):
+            raise ValueError(f"node id must be in [0, {1 << self.NODE_BITS})")
+        self.node_id = node_id
+        self.lock = threading.Lock()
+        self.last_ms = 0
+        self.sequence = 0
+
+    def next_id(self):
+        with self.lock:
+            # Never go backwards, even if the wall clock does
+            now = max(int(time.time() * 1000), self.last_ms)
+            if now == self.last_ms:
+                self.sequence = (self.sequence + 1) & ((1 << self.SEQUENCE_BITS) - 1)
+                if self.sequence == 0:
+                    # 4096 ids in this millisecond: borrow the next one
+                    now += 1
+            else:
+                self.sequence = 0
+            self.last_ms = now
+            return ((now - self.EPOCH_MS) << (self.NODE_BITS + self.SEQUENCE_BITS)) \
+                | (self.node_id << self.SEQUENCE_BITS) | self.sequence
+
+    @classmethod
+    def timestamp_ms(cls, snowflake):
+        """Epoch milliseconds encoded in an id"""
+        return (snowflake >> (cls.NODE_BITS + cls.SEQUENCE_BITS)) + cls.EPOCH_MS
+
+MESSAGE_IDS = SnowflakeGenerator(NODE_ID)
+
 def generate_message_id():
-    """Generate unique message ID"""
-    return hashlib.sha256(f"{time.time()}{random.random()}".encode()).hexdigest()[:16]
+    """Generate unique message ID (fixed-width hex, so string order is time order)"""
+    return f"{MESSAGE_IDS.next_id():016x}"
+
+def new_message(user, text, **fields):
+    """Build a chat message stamped with its id, epoch ms "ts" and display time"""
+    snowflake = MESSAGE_IDS.next_id()
+    ts = SnowflakeGenerator.timestamp_ms(snowflake)
+    message = {
+        "id": f"{snowflake:016x}",
+        "ts": ts,
+        "time": datetime.fromtimestamp(ts / 1000).strftime("%H:%M:%S"),
+        "user": user,
+        "text": text
+    }
+    message.update(fields)
+    return message
+
+def keep_ts_order(message, previous_ts):
+    """Move a message's ts (and display time) up to previous_ts if it is earlier.
+
+    new_message stamps a message before the room or channel lock is taken,
+    so two sends can reach a buffer out of order. Appends call this under
+    that lock (in log order, with prefork) so each buffer stays sorted by ts
+    for messages_since and Channel.read.
+    """
+    if message["ts"] < previous_ts:
+        message["ts"] = previous_ts
+        message["time"] = datetime.fromtimestamp(previous_ts / 1000).strftime("%H:%M:%S")
+
+def parse_since(value):
+    """Epoch ms from either an integer (ms) or an ISO-8601 datetime string"""
+    try:
+        return int(value)
+    except ValueError:
+        return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+def messages_since(messages_list, since_ms):
+    """Index of the first message at or after since_ms (messages are in ts order)"""
+    return bisect_left(messages_list, since_ms, key=lambda msg: msg.get("ts", 0))
 
 def sanitize_html(text):
     """Sanitize HTML to prevent XSS"""
@@ -173,36 +2110,7 @@ def generate_ascii_art():
 # ENHANCED HTML TEMPLATE WITH ALL FEATURES
 # ====================
 
-HTML_PAGE = """
-<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <title>{% if is_admin %}🛡️ Admin {% endif %}Enhanced Chat</title>
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    
-    <!-- Anti-copy/capture meta tags -->
-    <meta name="robots" content="noindex, nofollow">
-    <meta http-equiv="Cache-Control" content="no-store, no-cache, must-revalidate">
-    <meta http-equiv="Pragma" content="no-cache">
-    <meta http-equiv="Expires" content="0">
-    
-    <style>
-        :root {
-            --bg-color: {{ theme_colors.bg }};
-            --primary-color: {{ theme_colors.primary }};
-            --secondary-color: {{ theme_colors.secondary }};
-            --accent-color: {{ theme_colors.accent }};
-            --message-spacing: {{ layout_settings.message_spacing }};
-            --font-size: {{ layout_settings.font_size }};
-            --padding: {{ layout_settings.padding }};
-            {% if layout_settings.get('bubbles') %}
-            --message-radius: 20px;
-            {% else %}
-            --message-radius: 8px;
-            {% endif %}
-        }
-        
+APP_CSS = """
         * { 
             margin: 0; 
             padding: 0; 
@@ -461,25 +2369,6 @@ HTML_PAGE = """
             scroll-behavior: smooth;
         }
         
-        {% if layout_settings.get('bubbles') %}
-        .msg {
-            margin-bottom: var(--message-spacing);
-            padding: 12px 18px;
-            background: var(--accent-color);
-            color: #000;
-            border-radius: 20px 20px 20px 5px;
-            max-width: 80%;
-            position: relative;
-            animation: fadeIn 0.3s ease;
-        }
-        
-        .msg.own {
-            background: #2ecc71;
-            color: white;
-            border-radius: 20px 20px 5px 20px;
-            margin-left: auto;
-        }
-        {% else %}
         .msg {
             margin-bottom: var(--message-spacing);
             padding: 12px 15px;
@@ -488,7 +2377,6 @@ HTML_PAGE = """
             animation: fadeIn 0.3s ease;
             border-left: 4px solid var(--accent-color);
         }
-        {% endif %}
         
         @keyframes fadeIn {
             from { opacity: 0; transform: translateY(10px); }
@@ -553,6 +2441,14 @@ HTML_PAGE = """
             border-radius: 8px;
         }
         
+        .gif-pending {
+            padding: 20px;
+            background: var(--secondary-color);
+            color: #aaa;
+            font-size: 12px;
+            text-align: center;
+        }
+        
         .chat-input {
             display: flex;
             gap: 15px;
@@ -811,280 +2707,38 @@ HTML_PAGE = """
             );
             display: none;
         }
-    </style>
-</head>
-<body>
-    <div class="print-protection" id="printProtection">
-        <div style="text-align: center;">
-            <h1 style="color: red;">⚠️ PRINTING BLOCKED ⚠️</h1>
-            <p>This page is protected against printing.</p>
-            <p>Please close this dialog and refresh the page.</p>
-            <button onclick="closePrintProtection()" style="margin-top: 20px; padding: 10px 20px; background: red; color: white; border: none; border-radius: 5px; cursor: pointer;">
-                Close & Refresh
-            </button>
-        </div>
-    </div>
-    
-    <div class="capture-protection" id="captureProtection"></div>
-    
-    {% if username and not is_admin %}
-    <div class="theme-selector" id="themeSelector">
-        {% for theme_id, theme in themes.items() %}
-        <div class="theme-dot {% if theme_id == user_theme %}active{% endif %}" 
-             style="background: {{ theme.bg }};"
-             onclick="switchTheme('{{ theme_id }}')"
-             title="{{ theme_id|title }}"></div>
-        {% endfor %}
-    </div>
-    {% endif %}
-    
-    {% if username and not is_admin %}
-    <div class="settings-panel" id="settingsPanel">
-        <h3 style="margin-bottom: 15px;">Settings</h3>
-        <div class="form-group">
-            <label>Chat Layout:</label>
-            <select id="layoutSelect" onchange="switchLayout(this.value)">
-                {% for layout_id, layout in layouts.items() %}
-                <option value="{{ layout_id }}" {% if layout_id == user_layout %}selected{% endif %}>
-                    {{ layout_id|title }}
-                </option>
-                {% endfor %}
-            </select>
-        </div>
-        <button onclick="toggleSettings()" class="btn-primary" style="width: 100%; margin-top: 10px;">
-            Close Settings
-        </button>
-    </div>
-    {% endif %}
-    
-    <div class="container">
-        <div class="top-bar">
-            <h1>{% if is_admin %}🛡️ {% endif %}Enhanced Chat {% if is_admin %} - ADMIN MODE{% endif %}</h1>
-            {% if username %}
-            <div class="user-info">
-                {% if is_admin %}
-                    <div class="ascii-art">
-{{ admin_ascii_art }}
-                    </div>
-                    <span class="badge admin-badge">SUPER ADMIN</span>
-                    {% if admin_undercover %}
-                    <span class="badge" style="background: #ff9800;">UNDERCOVER</span>
-                    {% endif %}
-                {% endif %}
-                {% if geo_data %}
-                <span class="geo-badge" title="{{ geo_data.city }}, {{ geo_data.country }}">
-                    🌍 {{ geo_data.country|upper }}
-                </span>
-                {% endif %}
-                <span>{{ username }}</span>
-                {% if is_admin %}
-                <button onclick="toggleUndercover()" class="btn-warning">
-                    {{ 'Exit Undercover' if admin_undercover else 'Go Undercover' }}
-                </button>
-                {% endif %}
-                <button onclick="toggleSettings()" class="btn-primary">
-                    ⚙️ Settings
-                </button>
-                <form method="POST" action="{{ url_for('logout') }}" style="display:inline;">
-                    <button type="submit" class="btn-danger">Logout</button>
-                </form>
-            </div>
-            {% endif %}
-        </div>
+"""
 
-        {% if not username %}
-        <div class="login-box">
-            <h2 style="color: var(--accent-color); margin-bottom: 25px; text-align: center;">Join Enhanced Chat</h2>
-            <form method="POST" action="{{ url_for('set_username') }}">
-                <div class="form-group">
-                    <label>Username:</label>
-                    <input type="text" name="username" required maxlength="20" autocomplete="off" placeholder="Enter your username">
-                </div>
-                <div class="form-group">
-                    <label>Avatar URL (optional):</label>
-                    <input type="text" name="avatar" placeholder="https://example.com/avatar.png">
-                </div>
-                <button type="submit" class="btn-primary" style="width: 100%; padding: 15px; font-size: 16px;">
-                    🚀 Enter Chat
-                </button>
-            </form>
-        </div>
-        {% else %}
-        
-        {% if is_admin %}
-        <div class="admin-panel">
-            <div style="display: flex; justify-content: space-between; align-items: center; margin-bottom: 25px;">
-                <h3 style="color: var(--accent-color);">🛡️ Admin Control Panel</h3>
-                <div style="display: flex; gap: 10px;">
-                    <button onclick="refreshAll()" class="btn-primary">🔄 Refresh All</button>
-                    <button onclick="exportData()" class="btn-success">📊 Export Data</button>
-                </div>
-            </div>
-            
-            <div class="stats-grid">
-                <div class="stat-box">
-                    <div class="stat-value">{{ stats.active_users }}</div>
-                    <div class="stat-label">Active Users</div>
-                </div>
-                <div class="stat-box">
-                    <div class="stat-value">{{ stats.total_messages }}</div>
-                    <div class="stat-label">Total Messages</div>
-                </div>
-                <div class="stat-box">
-                    <div class="stat-value">{{ stats.banned_count }}</div>
-                    <div class="stat-label">Banned Users</div>
-                </div>
-                <div class="stat-box">
-                    <div class="stat-value">{{ stats.rooms_count }}</div>
-                    <div class="stat-label">Rooms</div>
-                </div>
-            </div>
-            
-            <div class="admin-controls">
-                <div class="control-box">
-                    <h4>Room Management</h4>
-                    <input type="text" id="new-room-name" placeholder="Room name" maxlength="30" style="margin-bottom: 10px;">
-                    <select id="room-privacy">
-                        <option value="public">Public</option>
-                        <option value="private">Private</option>
-                        <option value="hidden">Hidden</option>
-                    </select>
-                    <button onclick="createRoom()" class="btn-success" style="width: 100%; margin-top: 10px;">Create Room</button>
-                    
-                    <div style="margin-top: 15px;">
-                        <h5 style="color: #aaa; margin-bottom: 10px;">Existing Rooms</h5>
-                        <div id="rooms-list" class="user-list"></div>
-                    </div>
-                </div>
-                
-                <div class="control-box">
-                    <h4>User Control</h4>
-                    <select id="screen-target-type">
-                        <option value="ip">By IP</option>
-                        <option value="user">By Username</option>
-                    </select>
-                    <select id="screen-action">
-                        <option value="black">Black Screen</option>
-                        <option value="color">Custom Color</option>
-                        <option value="blink">Blinking Screen</option>
-                        <option value="invert">Invert Colors</option>
-                    </select>
-                    <input type="color" id="screen-color" value="#000000" style="margin-bottom: 10px;">
-                    <input type="text" id="target-identifier" placeholder="Target IP or Username" style="margin-bottom: 10px;">
-                    <button onclick="applyScreenEffect()" class="btn-primary" style="width: 100%; margin-bottom: 5px;">Apply Effect</button>
-                    <button onclick="clearScreenEffect()" class="btn-warning" style="width: 100%;">Clear Effect</button>
-                </div>
-                
-                <div class="control-box">
-                    <h4>Ban Management</h4>
-                    <select id="ban-type">
-                        <option value="ip">Ban IP (Tab Close)</option>
-                        <option value="user">Ban Username</option>
-                    </select>
-                    <input type="text" id="ban-identifier" placeholder="IP or Username">
-                    <textarea id="ban-reason" placeholder="Reason for ban" rows="2" style="width: 100%; margin: 10px 0; padding: 8px; border-radius: 4px; background: var(--primary-color); color: #eee; border: 1px solid #444;"></textarea>
-                    <button onclick="banUser()" class="btn-danger" style="width: 100%; margin-top: 5px;">Ban User</button>
-                    <button onclick="unbanUser()" class="btn-success" style="width: 100%; margin-top: 5px;">Unban User</button>
-                    <button onclick="massUnban()" class="btn-warning" style="width: 100%; margin-top: 5px;">Mass Unban All</button>
-                </div>
-                
-                <div class="control-box">
-                    <h4>Active Users & Monitoring</h4>
-                    <div id="active-users" class="user-list"></div>
-                    <div style="margin-top: 10px; display: flex; gap: 10px;">
-                        <button onclick="refreshUsers()" class="btn-primary" style="flex: 1;">Refresh Users</button>
-                        <button onclick="sendGlobalMessage()" class="btn-success" style="flex: 1;">Global Message</button>
-                    </div>
-                    
-                    <div style="margin-top: 15px; padding: 15px; background: var(--primary-color); border-radius: 8px; font-size: 12px;">
-                        <strong style="color: var(--accent-color);">System Status:</strong>
-                        <div id="debug-info" style="margin-top: 8px; line-height: 1.6;"></div>
-                    </div>
-                </div>
-                
-                <div class="control-box">
-                    <h4>Message Management</h4>
-                    <select id="message-action">
-                        <option value="delete">Delete User Messages</option>
-                        <option value="clear">Clear Room Messages</option>
-                        <option value="export">Export Messages</option>
-                    </select>
-                    <input type="text" id="message-target" placeholder="Username or Room ID">
-                    <button onclick="manageMessages()" class="btn-primary" style="width: 100%; margin-top: 10px;">Execute</button>
-                    
-                    <div style="margin-top: 15px;">
-                        <h5 style="color: #aaa; margin-bottom: 10px;">Recent Messages</h5>
-                        <div id="recent-messages" class="user-list" style="max-height: 150px;"></div>
-                    </div>
-                </div>
-                
-                <div class="control-box">
-                    <h4>Security Tools</h4>
-                    <button onclick="enableCaptureProtection()" class="btn-primary" style="width: 100%; margin-bottom: 5px;">
-                        🔒 Enable Screen Protection
-                    </button>
-                    <button onclick="disableCaptureProtection()" class="btn-warning" style="width: 100%; margin-bottom: 5px;">
-                        🔓 Disable Screen Protection
-                    </button>
-                    <button onclick="forceReconnectAll()" class="btn-danger" style="width: 100%;">
-                        🔄 Force All Users Reconnect
-                    </button>
-                    <div style="margin-top: 15px; padding: 10px; background: rgba(255,0,0,0.1); border-radius: 4px;">
-                        <small style="color: #ff6b6b;">⚠️ These actions affect all users immediately</small>
-                    </div>
-                </div>
-            </div>
-        </div>
-        {% endif %}
-        
-        <div class="main-content">
-            <div class="sidebar">
-                <h3>Rooms</h3>
-                <ul class="room-list" id="room-list"></ul>
-                <div style="margin-top: 20px; padding-top: 15px; border-top: 1px solid #444;">
-                    <h4 style="color: #aaa; font-size: 14px; margin-bottom: 10px;">Online Users</h4>
-                    <div id="online-users" class="user-list" style="max-height: 200px;"></div>
-                </div>
-            </div>
-            
-            <div class="chat-area">
-                <div style="display: flex; justify-content: space-between; align-items: center; margin-bottom: 15px;">
-                    <h3 style="color: var(--accent-color);" id="room-title">Select a room</h3>
-                    <div id="room-info" style="color: #aaa; font-size: 12px;"></div>
-                </div>
-                
-                <div id="messages"></div>
-                <div id="typing-indicator" class="message-typing"></div>
-                
-                <div class="chat-input">
-                    <input type="text" id="message-text" placeholder="Type a message or paste GIF URL..." autocomplete="off" required maxlength="500" onkeyup="checkForGif(this.value)" onkeypress="handleTyping(event)">
-                    <button type="button" onclick="toggleGifInput()" class="btn-primary" style="padding: 12px 15px;">GIF</button>
-                    <button type="submit" onclick="sendMessage(event)" class="btn-primary">Send</button>
-                </div>
-                
-                <div class="gif-input" id="gifInput">
-                    <input type="text" id="gif-url" placeholder="Paste GIF URL here..." style="flex: 1;">
-                    <button onclick="sendGif()" class="btn-success">Send GIF</button>
-                    <button onclick="toggleGifInput()" class="btn-danger">Cancel</button>
-                </div>
-            </div>
-        </div>
-        {% endif %}
-    </div>
-</body>
-</html>
-
-<script>
-    const username = "{{ username or '' }}";
-    const isAdmin = {{ 'true' if is_admin else 'false' }};
-    const adminUndercover = {{ 'true' if session.get('admin_undercover') else 'false' }};
+APP_JS = """
+    // Per-user state arrives as a small JSON blob; the rest of the page is a
+    // shared shell rendered once per (logged in, admin) variant.
+    const BOOT = JSON.parse(document.getElementById("bootstrap").textContent);
+    const username = BOOT.username || "";
+    const isAdmin = BOOT.is_admin;
+    const adminUndercover = BOOT.admin_undercover;
     let currentRoom = "general";
     let lastIndex = {};
+    let feedCursors = {};  // broadcast/inbox cursors for the current room's pane
     let typingTimeout = null;
+    let lastTypingSent = 0;
     let captureProtection = false;
-    let userTheme = "{{ user_theme or 'dark' }}";
-    let userLayout = "{{ user_layout or 'modern' }}";
+    let userTheme = BOOT.theme || "dark";
+    let userLayout = BOOT.layout || "modern";
     let activeUsers = [];
+    let moderationEpoch = null;
+    let pendingGifs = {};  // message id -> {msg, el}: GIFs still awaiting validation
+
+    // Only a window of the room's history is kept as DOM nodes. Messages that
+    // scroll out of it stay in roomHistory and their nodes are recycled; they
+    // are rendered again when the user scrolls back to them.
+    const RENDER_WINDOW = 150;
+    const RENDER_PAGE = 50;
+    const HISTORY_LIMIT = 2000;
+    const RECYCLE_LIMIT = 100;
+    let roomHistory = [];  // messages of the current room, oldest first
+    let renderedStart = 0;  // roomHistory[renderedStart, renderedEnd) are in the DOM
+    let renderedEnd = 0;
+    let recycledNodes = [];
 
     // Print protection
     window.addEventListener('beforeprint', (event) => {
@@ -1191,17 +2845,23 @@ HTML_PAGE = """
     function handleTyping(e) {
         if (typingTimeout) clearTimeout(typingTimeout);
         
-        fetch("/typing", {
-            method: "POST",
-            headers: {"Content-Type": "application/json"},
-            body: JSON.stringify({
-                room: currentRoom,
-                username: username,
-                typing: true
-            })
-        });
+        // One "typing" per couple of seconds is enough; the server rate-limits /typing
+        const now = Date.now();
+        if (now - lastTypingSent > 1500) {
+            lastTypingSent = now;
+            fetch("/typing", {
+                method: "POST",
+                headers: {"Content-Type": "application/json"},
+                body: JSON.stringify({
+                    room: currentRoom,
+                    username: username,
+                    typing: true
+                })
+            });
+        }
         
         typingTimeout = setTimeout(() => {
+            lastTypingSent = 0;
             fetch("/typing", {
                 method: "POST",
                 headers: {"Content-Type": "application/json"},
@@ -1234,6 +2894,8 @@ HTML_PAGE = """
                 document.getElementById('gif-url').value = '';
                 document.getElementById('gifInput').classList.remove('show');
                 showNotification('GIF sent successfully!');
+            } else if (res.status === 429) {
+                showNotification(`Slow down! Try again in ${res.headers.get("Retry-After")}s`, 'error');
             } else {
                 showNotification('Failed to send GIF', 'error');
             }
@@ -1254,7 +2916,7 @@ HTML_PAGE = """
         .then(res => {
             if (res.ok) {
                 showNotification('Message deleted');
-                fetchMessages();
+                pollNow();
             }
         });
     }
@@ -1270,27 +2932,140 @@ HTML_PAGE = """
         });
     }
 
-    {% if username %}
+    function applyBootstrap() {
+        if (!username) return;
+        document.getElementById("username-label").textContent = username;
+        if (BOOT.geo && BOOT.geo.country) {
+            const geoBadge = document.getElementById("geo-badge");
+            geoBadge.title = `${BOOT.geo.city}, ${BOOT.geo.country}`;
+            geoBadge.textContent = "🌍 " + BOOT.geo.country.toUpperCase();
+            geoBadge.style.display = "";
+        }
+        document.querySelectorAll(".theme-dot").forEach(dot => {
+            dot.classList.toggle("active", dot.dataset.theme === userTheme);
+        });
+        const layoutSelect = document.getElementById("layoutSelect");
+        if (layoutSelect) layoutSelect.value = userLayout;
+        if (isAdmin) {
+            if (BOOT.ascii_art) {
+                const art = document.getElementById("admin-ascii-art");
+                art.textContent = BOOT.ascii_art;
+                art.style.display = "";
+            }
+            document.getElementById("undercover-badge").style.display = adminUndercover ? "" : "none";
+            document.getElementById("undercover-toggle").textContent = adminUndercover ? "Exit Undercover" : "Go Undercover";
+            Object.entries(BOOT.stats || {}).forEach(([key, value]) => {
+                const box = document.getElementById("stat-" + key.replace(/_/g, "-"));
+                if (box) box.textContent = value;
+            });
+        }
+    }
+    applyBootstrap();
+
     window.onload = () => {
+        if (!username) return;
+        document.getElementById("messages").addEventListener("scroll", onMessagesScroll, {passive: true});
         loadRooms();
         checkForEffects();
-        loadOnlineUsers();
-        fetchMessages();
-        
-        setInterval(() => {
-            if (currentRoom) {
-                fetchMessages();
-                loadOnlineUsers();
-                checkForEffects();
-                checkTyping();
-            }
-        }, 1000);
+        schedulePoll(0);
+        document.addEventListener("visibilitychange", () => {
+            if (!document.hidden) pollNow();
+        });
         
         setInterval(() => {
             updateActiveStatus();
         }, 30000);
     };
 
+    // Poll scheduler: one poll cycle at a time, the next one is only scheduled
+    // after the previous cycle has settled. The delay grows while the room is
+    // quiet, the tab is hidden or requests fail, never drops below the
+    // server's X-Poll-Interval, honours Retry-After, and is jittered so
+    // clients don't synchronise.
+    const POLL_QUIET_MAX = 5000;
+    const POLL_HIDDEN = 15000;
+    const POLL_ERROR_MAX = 60000;
+    const ONLINE_USERS_EVERY = 5000;
+    let pollTimer = null;
+    let pollInFlight = false;
+    let pollAgain = false;
+    let quietPolls = 0;
+    let failedPolls = 0;
+    let serverPollInterval = 1000;
+    let retryAfter = 0;
+    let lastOnlineUsersPoll = 0;
+    let lowPriorityPausedUntil = 0;
+
+    function readPollHints(res) {
+        const interval = parseFloat(res.headers.get("X-Poll-Interval"));
+        if (interval > 0) serverPollInterval = interval * 1000;
+        const wait = parseFloat(res.headers.get("Retry-After"));
+        if (wait > 0) retryAfter = Math.max(retryAfter, wait * 1000);
+        if (!res.ok) throw new Error(`HTTP ${res.status}`);
+        return res;
+    }
+
+    // Typing and online-user polls are what the server sheds first under
+    // load. A 503 pauses just those for its Retry-After instead of slowing
+    // the message poll down with them.
+    function readLowPriorityHints(res) {
+        if (res.status === 503) {
+            lowPriorityPausedUntil = Date.now() + (parseFloat(res.headers.get("Retry-After")) || 5) * 1000;
+            throw new Error("HTTP 503");
+        }
+        return readPollHints(res);
+    }
+
+    function nextPollDelay() {
+        let delay = Math.min(serverPollInterval * Math.pow(1.5, quietPolls), Math.max(POLL_QUIET_MAX, serverPollInterval));
+        if (document.hidden) delay = Math.max(delay, POLL_HIDDEN);
+        if (failedPolls) delay = Math.max(delay, Math.min(serverPollInterval * Math.pow(2, failedPolls), POLL_ERROR_MAX));
+        delay = Math.max(delay, retryAfter);
+        retryAfter = 0;
+        return delay * (0.8 + Math.random() * 0.4);
+    }
+
+    function schedulePoll(delay) {
+        clearTimeout(pollTimer);
+        pollTimer = setTimeout(runPoll, delay);
+    }
+
+    // Poll as soon as possible (after sending, switching rooms, tab refocus)
+    function pollNow() {
+        quietPolls = 0;
+        if (pollInFlight) {
+            pollAgain = true;
+        } else {
+            schedulePoll(0);
+        }
+    }
+
+    function runPoll() {
+        if (!currentRoom) return schedulePoll(nextPollDelay());
+        pollInFlight = true;
+        const polls = [fetchMessages()];
+        if (Date.now() >= lowPriorityPausedUntil) {
+            polls.push(checkTyping());
+            if (Date.now() - lastOnlineUsersPoll >= ONLINE_USERS_EVERY) {
+                lastOnlineUsersPoll = Date.now();
+                polls.push(loadOnlineUsers());
+            }
+        }
+        Promise.allSettled(polls).then(results => {
+            const failed = results[0].status === "rejected";
+            failedPolls = failed ? Math.min(failedPolls + 1, 10) : 0;
+            const gotMessages = results[0].status === "fulfilled" && results[0].value > 0;
+            quietPolls = gotMessages ? 0 : Math.min(quietPolls + 1, 10);
+            pollInFlight = false;
+            if (pollAgain) {
+                pollAgain = false;
+                schedulePoll(0);
+            } else {
+                schedulePoll(nextPollDelay());
+            }
+        });
+    }
+
     function updateActiveStatus() {
         fetch("/update-active", {
             method: "POST",
@@ -1302,13 +3077,28 @@ HTML_PAGE = """
         });
     }
 
+    // Bans and effects change rarely: only ask /check-effects when the
+    // moderation epoch returned on every response has moved.
+    function trackModerationEpoch(res) {
+        const epoch = res.headers.get("X-Moderation-Epoch");
+        if (epoch && moderationEpoch !== null && epoch !== moderationEpoch) {
+            checkForEffects();
+        }
+        if (epoch) moderationEpoch = epoch;
+        return res;
+    }
+
     function checkForEffects() {
         fetch("/check-effects", {
             method: "POST",
             headers: {"Content-Type": "application/json"},
             body: JSON.stringify({username: username})
         })
-            .then(res => res.json())
+            .then(res => {
+                const epoch = res.headers.get("X-Moderation-Epoch");
+                if (epoch) moderationEpoch = epoch;
+                return res.json();
+            })
             .then(data => {
                 if (data.banned) {
                     localStorage.setItem('banned_user', username);
@@ -1398,7 +3188,8 @@ HTML_PAGE = """
     }
 
     function loadOnlineUsers() {
-        fetch("/online-users?room=" + currentRoom)
+        return fetch("/online-users?room=" + currentRoom)
+            .then(readLowPriorityHints)
             .then(res => res.json())
             .then(data => {
                 const container = document.getElementById("online-users");
@@ -1417,7 +3208,8 @@ HTML_PAGE = """
     }
 
     function checkTyping() {
-        fetch("/typing-status?room=" + currentRoom)
+        return fetch("/typing-status?room=" + currentRoom)
+            .then(readLowPriorityHints)
             .then(res => res.json())
             .then(data => {
                 const indicator = document.getElementById("typing-indicator");
@@ -1432,49 +3224,238 @@ HTML_PAGE = """
     function switchRoom(roomId, roomName) {
         currentRoom = roomId;
         document.getElementById("room-title").textContent = roomName;
-        document.getElementById("messages").innerHTML = "";
+        resetMessagePane();
         lastIndex[currentRoom] = 0;
+        feedCursors = {};
+        lastOnlineUsersPoll = 0;
         loadRooms();
-        loadOnlineUsers();
-        fetchMessages();
+        pollNow();
     }
 
+    // Resolves to the number of new messages, rejects on failure
     function fetchMessages() {
-        if (!currentRoom) return;
-        const after = lastIndex[currentRoom] || 0;
-        fetch(`/messages?room=${currentRoom}&after=${after}`)
+        if (!currentRoom) return Promise.resolve(0);
+        const room = currentRoom;
+        const after = lastIndex[room] || 0;
+        const pending = Object.keys(pendingGifs).join(",");
+        const feeds = Object.entries(feedCursors).map(([name, cursor]) => `&${name}=${cursor}`).join("");
+        return fetch(`/messages?room=${room}&after=${after}` + feeds + (pending ? `&pending=${pending}` : ""))
+            .then(readPollHints)
+            .then(trackModerationEpoch)
             .then(res => res.json())
             .then(data => {
-                const messagesDiv = document.getElementById("messages");
-                data.messages.forEach(msg => {
-                    if (msg.deleted) return;
-                    
-                    const div = document.createElement("div");
-                    div.className = "msg" + (msg.user === username ? " own" : "");
-                    
-                    let content = escapeHtml(msg.text);
-                    if (msg.gif_url) {
-                        content = `<div class="gif-container"><img src="${escapeHtml(msg.gif_url)}" alt="GIF" loading="lazy"></div>`;
-                    }
-                    
-                    div.innerHTML = `
-                        <div style="position: relative;">
-                            <span class='time'>[${msg.time}]</span>
-                            <span class='user'>${escapeHtml(msg.user)}:</span>
-                            <span class='text'>${content}</span>
-                            ${msg.user === username ? `
-                                <div class="msg-actions">
-                                    <button class="delete-btn" onclick="deleteMessage('${msg.id}')">Delete</button>
-                                </div>
-                            ` : ''}
-                        </div>
-                    `;
-                    messagesDiv.appendChild(div);
-                    messagesDiv.scrollTop = messagesDiv.scrollHeight;
-                });
-                lastIndex[currentRoom] = data.last_index;
+                if (room !== currentRoom) return 0;  // switched rooms meanwhile
+                appendMessages(data.messages.filter(msg => !msg.deleted));
+                lastIndex[room] = data.last_index;
+                feedCursors = {broadcast: data.broadcast_cursor, inbox: data.inbox_cursor};
+                resolvePendingGifs(data.gif_status || {}, data.gif_urls || {});
+                return data.messages.length;
+            })
+            .catch(err => {
+                console.error(err);
+                throw err;
+            });
+    }
+
+    function messageContent(msg) {
+        if (msg.gif_url && msg.gif_status === 'pending') {
+            return `<div class="gif-container gif-pending" data-gif-url="${escapeHtml(msg.gif_url)}">Loading GIF...</div>`;
+        } else if (msg.gif_url && msg.gif_status === 'invalid') {
+            return `<div class="gif-container gif-pending">GIF unavailable</div>`;
+        } else if (msg.poster_url) {
+            return renderUploadedGif(msg);
+        } else if (msg.gif_url) {
+            return renderGif(msg.gif_url);
+        }
+        return escapeHtml(msg.text);
+    }
+
+    function buildMessageNode(msg) {
+        const div = recycledNodes.pop() || document.createElement("div");
+        div.className = "msg" + (msg.user === username ? " own" : "");
+        div.dataset.id = msg.id;
+        div.innerHTML = `
+            <div style="position: relative;">
+                <span class='time'>[${msg.time}]</span>
+                <span class='user'>${escapeHtml(msg.user)}:</span>
+                <span class='text'>${messageContent(msg)}</span>
+                ${msg.user === username ? `
+                    <div class="msg-actions">
+                        <button class="delete-btn" onclick="deleteMessage('${msg.id}')">Delete</button>
+                    </div>
+                ` : ''}
+            </div>
+        `;
+        if (msg.gif_url && msg.gif_status === 'pending') {
+            pendingGifs[msg.id] = {msg: msg, el: div.querySelector('.gif-pending')};
+        }
+        div.querySelectorAll('img[data-src]').forEach(img => posterObserver.observe(img));
+        return div;
+    }
+
+    function releaseMessageNode(div) {
+        div.querySelectorAll('img[data-src]').forEach(img => posterObserver.unobserve(img));
+        const pending = pendingGifs[div.dataset.id];
+        if (pending) pending.el = null;
+        div.remove();
+        if (recycledNodes.length < RECYCLE_LIMIT) recycledNodes.push(div);
+    }
+
+    function buildFragment(start, end) {
+        const fragment = document.createDocumentFragment();
+        for (let i = start; i < end; i++) {
+            fragment.appendChild(buildMessageNode(roomHistory[i]));
+        }
+        return fragment;
+    }
+
+    // Keep the visible content in place while nodes are added/removed above it
+    function keepScrollAnchor(messagesDiv, mutate) {
+        const before = messagesDiv.scrollHeight;
+        mutate();
+        messagesDiv.scrollTo({top: messagesDiv.scrollTop + messagesDiv.scrollHeight - before, behavior: 'instant'});
+    }
+
+    function appendMessages(messages) {
+        if (!messages.length) return;
+        const messagesDiv = document.getElementById("messages");
+        const atBottom = messagesDiv.scrollHeight - messagesDiv.scrollTop - messagesDiv.clientHeight < 50;
+        const following = renderedEnd === roomHistory.length;
+
+        roomHistory.push(...messages);
+        const overflow = roomHistory.length - HISTORY_LIMIT;
+        if (overflow > 0) {
+            roomHistory.splice(0, overflow);
+            renderedStart = Math.max(0, renderedStart - overflow);
+            renderedEnd = Math.max(renderedStart, renderedEnd - overflow);
+        }
+        if (!following) return;  // reading older history; shown when they scroll back down
+
+        // One fragment insert and one scroll adjustment per batch
+        messagesDiv.appendChild(buildFragment(renderedEnd, roomHistory.length));
+        renderedEnd = roomHistory.length;
+        if (atBottom) {
+            trimRenderedTop(messagesDiv, RENDER_WINDOW);
+            messagesDiv.scrollTo({top: messagesDiv.scrollHeight, behavior: 'instant'});
+        }
+    }
+
+    function trimRenderedTop(messagesDiv, keep) {
+        while (renderedEnd - renderedStart > keep && messagesDiv.firstElementChild) {
+            releaseMessageNode(messagesDiv.firstElementChild);
+            renderedStart++;
+        }
+    }
+
+    function trimRenderedBottom(messagesDiv, keep) {
+        while (renderedEnd - renderedStart > keep && messagesDiv.lastElementChild) {
+            releaseMessageNode(messagesDiv.lastElementChild);
+            renderedEnd--;
+        }
+    }
+
+    function onMessagesScroll() {
+        const messagesDiv = document.getElementById("messages");
+        if (messagesDiv.scrollTop < 100 && renderedStart > 0) {
+            const start = Math.max(0, renderedStart - RENDER_PAGE);
+            keepScrollAnchor(messagesDiv, () => {
+                messagesDiv.insertBefore(buildFragment(start, renderedStart), messagesDiv.firstChild);
+                renderedStart = start;
+            });
+            trimRenderedBottom(messagesDiv, RENDER_WINDOW + RENDER_PAGE);
+        } else if (messagesDiv.scrollHeight - messagesDiv.scrollTop - messagesDiv.clientHeight < 100
+                   && renderedEnd < roomHistory.length) {
+            const end = Math.min(roomHistory.length, renderedEnd + RENDER_PAGE);
+            messagesDiv.appendChild(buildFragment(renderedEnd, end));
+            renderedEnd = end;
+            keepScrollAnchor(messagesDiv, () => trimRenderedTop(messagesDiv, RENDER_WINDOW + RENDER_PAGE));
+        }
+    }
+
+    function resetMessagePane() {
+        const messagesDiv = document.getElementById("messages");
+        while (messagesDiv.firstElementChild) releaseMessageNode(messagesDiv.firstElementChild);
+        roomHistory = [];
+        renderedStart = renderedEnd = 0;
+        pendingGifs = {};
+    }
+
+    function renderGif(url) {
+        return `<div class="gif-container"><img src="${escapeHtml(url)}" alt="GIF" loading="lazy"></div>`;
+    }
+
+    // Uploaded GIFs start as their static poster and only switch to the
+    // animated preview once they scroll into view.
+    const posterObserver = new IntersectionObserver(entries => {
+        entries.forEach(entry => {
+            if (!entry.isIntersecting) return;
+            const img = entry.target;
+            img.src = img.dataset.src;
+            img.removeAttribute('data-src');
+            posterObserver.unobserve(img);
+        });
+    }, {rootMargin: '200px'});
+
+    function renderUploadedGif(msg) {
+        return `<div class="gif-container"><a href="${escapeHtml(msg.gif_url)}" target="_blank" rel="noopener">` +
+            `<img src="${escapeHtml(msg.poster_url)}" data-src="${escapeHtml(msg.preview_url)}" alt="GIF"></a></div>`;
+    }
+
+    function uploadGif() {
+        const fileInput = document.getElementById('gif-file');
+        if (!fileInput.files.length) {
+            showNotification('Choose an image to upload', 'error');
+            return;
+        }
+        const file = fileInput.files[0];
+        fetch("/upload-media?room=" + encodeURIComponent(currentRoom), {
+            method: "POST",
+            headers: {"Content-Type": file.type || "application/octet-stream"},
+            body: file
+        })
+            .then(res => res.ok ? res.json() : res.text().then(msg => Promise.reject(msg)))
+            .then(data => {
+                fileInput.value = '';
+                document.getElementById('gifInput').classList.remove('show');
+                if (data.status === 'done') {
+                    showNotification('GIF uploaded!');
+                } else {
+                    showNotification('Processing upload...');
+                    pollUpload(data.upload_id);
+                }
             })
-            .catch(err => console.error(err));
+            .catch(err => showNotification('Upload failed: ' + err, 'error'));
+    }
+
+    function pollUpload(uploadId) {
+        fetch(`/upload-status/${uploadId}`)
+            .then(res => res.json())
+            .then(job => {
+                if (job.status === 'processing') {
+                    setTimeout(() => pollUpload(uploadId), 1000);
+                } else if (job.status === 'failed') {
+                    showNotification('Upload failed: ' + job.error, 'error');
+                } else {
+                    showNotification('GIF uploaded!');
+                }
+            });
+    }
+
+    function resolvePendingGifs(statuses, urls) {
+        Object.entries(statuses).forEach(([id, status]) => {
+            const pending = pendingGifs[id];
+            if (!pending || status === 'pending') return;
+            pending.msg.gif_status = status;
+            if (urls[id]) pending.msg.gif_url = urls[id];
+            if (pending.el) {
+                if (status === 'valid') {
+                    pending.el.outerHTML = renderGif(pending.msg.gif_url);
+                } else {
+                    pending.el.textContent = 'GIF unavailable';
+                }
+            }
+            delete pendingGifs[id];
+        });
     }
 
     function sendMessage(e) {
@@ -1488,7 +3469,12 @@ HTML_PAGE = """
             headers: {"Content-Type": "application/json"},
             body: JSON.stringify({text: text, room: currentRoom})
         }).then(res => {
-            if (res.ok) input.value = "";
+            if (res.ok) {
+                input.value = "";
+                pollNow();
+            } else if (res.status === 429) {
+                showNotification(`Slow down! Try again in ${res.headers.get("Retry-After")}s`, 'error');
+            }
         });
     }
 
@@ -1502,7 +3488,42 @@ HTML_PAGE = """
             .replace(/'/g, "&#039;");
     }
 
-    {% if is_admin %}
+
+    // Prevent right-click
+    document.addEventListener('contextmenu', (e) => {
+        if (isAdmin && !adminUndercover) return;
+        e.preventDefault();
+        showNotification('Right-click is disabled', 'warning');
+        return false;
+    });
+
+    // Prevent drag-and-drop of images
+    document.addEventListener('dragstart', (e) => {
+        if (e.target.tagName === 'IMG') {
+            e.preventDefault();
+            return false;
+        }
+    });
+
+    // Prevent F12, Ctrl+Shift+I, Ctrl+Shift+J, Ctrl+Shift+C
+    document.addEventListener('keydown', (e) => {
+        if (e.key === 'F12' || 
+            (e.ctrlKey && e.shiftKey && ['I', 'J', 'C'].includes(e.key)) ||
+            (e.metaKey && e.altKey && e.key === 'I')) {
+            e.preventDefault();
+            showNotification('Developer tools are disabled', 'warning');
+            // Apply screen effect
+            document.body.style.filter = 'invert(1)';
+            setTimeout(() => {
+                document.body.style.filter = '';
+            }, 1000);
+            return false;
+        }
+    });
+"""
+
+# Only served to admins
+ADMIN_JS = """
     function createRoom() {
         const name = document.getElementById("new-room-name").value.trim();
         const privacy = document.getElementById("room-privacy").value;
@@ -1590,6 +3611,33 @@ HTML_PAGE = """
         }).catch(err => showNotification("Error: " + err, "error"));
     }
 
+    function bulkModerate() {
+        const identifiers = document.getElementById("bulk-targets").value.split(/[\\s,]+/).filter(Boolean);
+        if (!identifiers.length) return showNotification("Enter targets", "error");
+        fetch("/admin/bulk-moderation", {
+            method: "POST",
+            headers: {"Content-Type": "application/json"},
+            body: JSON.stringify({
+                action: document.getElementById("bulk-action").value,
+                type: document.getElementById("ban-type").value,
+                reason: document.getElementById("ban-reason").value.trim(),
+                items: identifiers
+            })
+        })
+        .then(res => res.headers.get("Content-Type")?.includes("json") ? res.json() : res.text().then(msg => ({error: msg})))
+        .then(data => {
+            if (data.error) return showNotification("Failed: " + data.error, "error");
+            if (data.rejected) {
+                const bad = data.results.filter(r => r.status === "rejected");
+                return showNotification(`Nothing applied, ${data.rejected} invalid: ` +
+                    bad.slice(0, 3).map(r => `${r.identifier} (${r.error})`).join(", "), "error");
+            }
+            const deleted = data.results.reduce((sum, r) => sum + (r.deleted || 0), 0);
+            showNotification(`Applied to ${data.applied} targets, ${data.changed} changed` + (deleted ? `, ${deleted} messages deleted` : ""));
+        })
+        .catch(err => showNotification("Error: " + err, "error"));
+    }
+
     function unbanUser() {
         const banType = document.getElementById("ban-type").value;
         const identifier = document.getElementById("ban-identifier").value.trim();
@@ -1624,10 +3672,39 @@ HTML_PAGE = """
         });
     }
 
+    const USERS_PAGE = 50;
+    let usersOffset = 0;
+    let usersFilterTimer = null;
+
+    function filterUsers() {
+        usersOffset = 0;
+        clearTimeout(usersFilterTimer);
+        usersFilterTimer = setTimeout(refreshUsers, 250);
+    }
+
+    function pageUsers(step) {
+        usersOffset = Math.max(usersOffset + step * USERS_PAGE, 0);
+        refreshUsers();
+    }
+
     function refreshUsers() {
-        fetch("/admin/active-users")
+        const params = new URLSearchParams({
+            sort: document.getElementById("users-sort").value,
+            offset: usersOffset,
+            limit: USERS_PAGE
+        });
+        const filter = document.getElementById("users-filter").value.trim();
+        if (filter) params.set(/^[0-9a-f.:]+$/i.test(filter) && /[.:]/.test(filter) ? "ip" : "username", filter);
+        fetch("/admin/active-users?" + params)
             .then(res => res.json())
             .then(data => {
+                if (data.total && usersOffset >= data.total) {
+                    usersOffset = Math.floor((data.total - 1) / USERS_PAGE) * USERS_PAGE;
+                    return refreshUsers();
+                }
+                document.getElementById("users-page-info").textContent = data.total
+                    ? `${data.offset + 1}-${data.offset + data.users.length} of ${data.total}`
+                    : 'No users';
                 const div = document.getElementById("active-users");
                 div.innerHTML = data.users.map(u => `
                     <div class="user-item">
@@ -1701,7 +3778,7 @@ HTML_PAGE = """
             if (res.ok) {
                 showNotification(`Action "${action}" completed`);
                 if (action === 'delete' || action === 'clear') {
-                    fetchMessages();
+                    pollNow();
                 } else if (action === 'export') {
                     res.blob().then(blob => {
                         const url = window.URL.createObjectURL(blob);
@@ -1725,10 +3802,23 @@ HTML_PAGE = """
         });
     }
 
+    function setPollInterval() {
+        const interval = parseFloat(document.getElementById('poll-interval').value);
+        if (!interval) return;
+        
+        fetch("/admin/poll-interval", {
+            method: "POST",
+            headers: {"Content-Type": "application/json"},
+            body: JSON.stringify({interval: interval})
+        })
+        .then(res => res.json())
+        .then(data => showNotification(`Clients now poll at most every ${data.interval}s`));
+    }
+
     function refreshAll() {
         refreshUsers();
         loadRooms();
-        fetchMessages();
+        pollNow();
         showNotification('All data refreshed');
     }
 
@@ -1743,41 +3833,312 @@ HTML_PAGE = """
                 a.click();
             });
     }
+"""
+
+HTML_PAGE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>{% if is_admin %}🛡️ Admin {% endif %}Enhanced Chat</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    
+    <!-- Anti-copy/capture meta tags -->
+    <meta name="robots" content="noindex, nofollow">
+    <meta http-equiv="Cache-Control" content="no-store, no-cache, must-revalidate">
+    <meta http-equiv="Pragma" content="no-cache">
+    <meta http-equiv="Expires" content="0">
+    
+    <link rel="stylesheet" href="{{ asset_urls['app.css'] }}">
+    <!--USER-STYLE-->
+</head>
+<body>
+    <div class="print-protection" id="printProtection">
+        <div style="text-align: center;">
+            <h1 style="color: red;">⚠️ PRINTING BLOCKED ⚠️</h1>
+            <p>This page is protected against printing.</p>
+            <p>Please close this dialog and refresh the page.</p>
+            <button onclick="closePrintProtection()" style="margin-top: 20px; padding: 10px 20px; background: red; color: white; border: none; border-radius: 5px; cursor: pointer;">
+                Close & Refresh
+            </button>
+        </div>
+    </div>
+    
+    <div class="capture-protection" id="captureProtection"></div>
+    
+    {% if logged_in and not is_admin %}
+    <div class="theme-selector" id="themeSelector">
+        {% for theme_id, theme in themes.items() %}
+        <div class="theme-dot" data-theme="{{ theme_id }}"
+             style="background: {{ theme.bg }};"
+             onclick="switchTheme('{{ theme_id }}')"
+             title="{{ theme_id|title }}"></div>
+        {% endfor %}
+    </div>
     {% endif %}
+    
+    {% if logged_in and not is_admin %}
+    <div class="settings-panel" id="settingsPanel">
+        <h3 style="margin-bottom: 15px;">Settings</h3>
+        <div class="form-group">
+            <label>Chat Layout:</label>
+            <select id="layoutSelect" onchange="switchLayout(this.value)">
+                {% for layout_id, layout in layouts.items() %}
+                <option value="{{ layout_id }}">
+                    {{ layout_id|title }}
+                </option>
+                {% endfor %}
+            </select>
+        </div>
+        <button onclick="toggleSettings()" class="btn-primary" style="width: 100%; margin-top: 10px;">
+            Close Settings
+        </button>
+    </div>
     {% endif %}
+    
+    <div class="container">
+        <div class="top-bar">
+            <h1>{% if is_admin %}🛡️ {% endif %}Enhanced Chat {% if is_admin %} - ADMIN MODE{% endif %}</h1>
+            {% if logged_in %}
+            <div class="user-info">
+                {% if is_admin %}
+                    <div class="ascii-art" id="admin-ascii-art" style="display: none;"></div>
+                    <span class="badge admin-badge">SUPER ADMIN</span>
+                    <span class="badge" id="undercover-badge" style="background: #ff9800; display: none;">UNDERCOVER</span>
+                {% endif %}
+                <span class="geo-badge" id="geo-badge" style="display: none;"></span>
+                <span id="username-label"></span>
+                {% if is_admin %}
+                <button onclick="toggleUndercover()" class="btn-warning" id="undercover-toggle">Go Undercover</button>
+                {% endif %}
+                <button onclick="toggleSettings()" class="btn-primary">
+                    ⚙️ Settings
+                </button>
+                <form method="POST" action="{{ url_for('logout') }}" style="display:inline;">
+                    <button type="submit" class="btn-danger">Logout</button>
+                </form>
+            </div>
+            {% endif %}
+        </div>
 
-    // Prevent right-click
-    document.addEventListener('contextmenu', (e) => {
-        if (isAdmin && !adminUndercover) return;
-        e.preventDefault();
-        showNotification('Right-click is disabled', 'warning');
-        return false;
-    });
-
-    // Prevent drag-and-drop of images
-    document.addEventListener('dragstart', (e) => {
-        if (e.target.tagName === 'IMG') {
-            e.preventDefault();
-            return false;
-        }
-    });
+        {% if not logged_in %}
+        <div class="login-box">
+            <h2 style="color: var(--accent-color); margin-bottom: 25px; text-align: center;">Join Enhanced Chat</h2>
+            <form method="POST" action="{{ url_for('set_username') }}">
+                <div class="form-group">
+                    <label>Username:</label>
+                    <input type="text" name="username" required maxlength="20" autocomplete="off" placeholder="Enter your username">
+                </div>
+                <div class="form-group">
+                    <label>Avatar URL (optional):</label>
+                    <input type="text" name="avatar" placeholder="https://example.com/avatar.png">
+                </div>
+                <button type="submit" class="btn-primary" style="width: 100%; padding: 15px; font-size: 16px;">
+                    🚀 Enter Chat
+                </button>
+            </form>
+        </div>
+        {% else %}
+        
+        {% if is_admin %}
+        <div class="admin-panel">
+            <div style="display: flex; justify-content: space-between; align-items: center; margin-bottom: 25px;">
+                <h3 style="color: var(--accent-color);">🛡️ Admin Control Panel</h3>
+                <div style="display: flex; gap: 10px;">
+                    <button onclick="refreshAll()" class="btn-primary">🔄 Refresh All</button>
+                    <button onclick="exportData()" class="btn-success">📊 Export Data</button>
+                </div>
+            </div>
+            
+            <div class="stats-grid">
+                <div class="stat-box">
+                    <div class="stat-value" id="stat-active-users"></div>
+                    <div class="stat-label">Active Users</div>
+                </div>
+                <div class="stat-box">
+                    <div class="stat-value" id="stat-total-messages"></div>
+                    <div class="stat-label">Total Messages</div>
+                </div>
+                <div class="stat-box">
+                    <div class="stat-value" id="stat-banned-count"></div>
+                    <div class="stat-label">Banned Users</div>
+                </div>
+                <div class="stat-box">
+                    <div class="stat-value" id="stat-rooms-count"></div>
+                    <div class="stat-label">Rooms</div>
+                </div>
+            </div>
+            
+            <div class="admin-controls">
+                <div class="control-box">
+                    <h4>Room Management</h4>
+                    <input type="text" id="new-room-name" placeholder="Room name" maxlength="30" style="margin-bottom: 10px;">
+                    <select id="room-privacy">
+                        <option value="public">Public</option>
+                        <option value="private">Private</option>
+                        <option value="hidden">Hidden</option>
+                    </select>
+                    <button onclick="createRoom()" class="btn-success" style="width: 100%; margin-top: 10px;">Create Room</button>
+                    
+                    <div style="margin-top: 15px;">
+                        <h5 style="color: #aaa; margin-bottom: 10px;">Existing Rooms</h5>
+                        <div id="rooms-list" class="user-list"></div>
+                    </div>
+                </div>
+                
+                <div class="control-box">
+                    <h4>User Control</h4>
+                    <select id="screen-target-type">
+                        <option value="ip">By IP</option>
+                        <option value="user">By Username</option>
+                    </select>
+                    <select id="screen-action">
+                        <option value="black">Black Screen</option>
+                        <option value="color">Custom Color</option>
+                        <option value="blink">Blinking Screen</option>
+                        <option value="invert">Invert Colors</option>
+                    </select>
+                    <input type="color" id="screen-color" value="#000000" style="margin-bottom: 10px;">
+                    <input type="text" id="target-identifier" placeholder="Target IP or Username" style="margin-bottom: 10px;">
+                    <button onclick="applyScreenEffect()" class="btn-primary" style="width: 100%; margin-bottom: 5px;">Apply Effect</button>
+                    <button onclick="clearScreenEffect()" class="btn-warning" style="width: 100%;">Clear Effect</button>
+                </div>
+                
+                <div class="control-box">
+                    <h4>Ban Management</h4>
+                    <select id="ban-type">
+                        <option value="ip">Ban IP (Tab Close)</option>
+                        <option value="user">Ban Username</option>
+                    </select>
+                    <input type="text" id="ban-identifier" placeholder="IP or Username">
+                    <textarea id="ban-reason" placeholder="Reason for ban" rows="2" style="width: 100%; margin: 10px 0; padding: 8px; border-radius: 4px; background: var(--primary-color); color: #eee; border: 1px solid #444;"></textarea>
+                    <button onclick="banUser()" class="btn-danger" style="width: 100%; margin-top: 5px;">Ban User</button>
+                    <button onclick="unbanUser()" class="btn-success" style="width: 100%; margin-top: 5px;">Unban User</button>
+                    <button onclick="massUnban()" class="btn-warning" style="width: 100%; margin-top: 5px;">Mass Unban All</button>
+                    <textarea id="bulk-targets" placeholder="Bulk: one IP or username per line (uses the type above)" rows="3" style="width: 100%; margin: 10px 0 5px; padding: 8px; border-radius: 4px; background: var(--primary-color); color: #eee; border: 1px solid #444;"></textarea>
+                    <div style="display: flex; gap: 5px;">
+                        <select id="bulk-action" style="flex: 1;">
+                            <option value="ban">Ban all</option>
+                            <option value="unban">Unban all</option>
+                            <option value="effect">Black screen all</option>
+                            <option value="clear-effect">Clear effects</option>
+                            <option value="delete-messages">Delete their messages</option>
+                        </select>
+                        <button onclick="bulkModerate()" class="btn-danger">Apply</button>
+                    </div>
+                </div>
+                
+                <div class="control-box">
+                    <h4>Active Users & Monitoring</h4>
+                    <div style="display: flex; gap: 5px; margin-bottom: 5px;">
+                        <input type="text" id="users-filter" placeholder="Username or IP prefix" oninput="filterUsers()" style="flex: 1;">
+                        <select id="users-sort" onchange="filterUsers()">
+                            <option value="last_seen">Last seen</option>
+                            <option value="room">Room</option>
+                            <option value="country">Country</option>
+                            <option value="username">Username</option>
+                        </select>
+                    </div>
+                    <div id="active-users" class="user-list"></div>
+                    <div style="margin-top: 5px; display: flex; gap: 5px; align-items: center; font-size: 12px;">
+                        <button onclick="pageUsers(-1)" style="padding: 3px 8px;">&lt;</button>
+                        <span id="users-page-info" style="flex: 1; text-align: center;"></span>
+                        <button onclick="pageUsers(1)" style="padding: 3px 8px;">&gt;</button>
+                    </div>
+                    <div style="margin-top: 10px; display: flex; gap: 10px;">
+                        <button onclick="refreshUsers()" class="btn-primary" style="flex: 1;">Refresh Users</button>
+                        <button onclick="sendGlobalMessage()" class="btn-success" style="flex: 1;">Global Message</button>
+                    </div>
+                    
+                    <div style="margin-top: 15px; padding: 15px; background: var(--primary-color); border-radius: 8px; font-size: 12px;">
+                        <strong style="color: var(--accent-color);">System Status:</strong>
+                        <div id="debug-info" style="margin-top: 8px; line-height: 1.6;"></div>
+                    </div>
+                </div>
+                
+                <div class="control-box">
+                    <h4>Message Management</h4>
+                    <select id="message-action">
+                        <option value="delete">Delete User Messages</option>
+                        <option value="clear">Clear Room Messages</option>
+                        <option value="export">Export Messages</option>
+                    </select>
+                    <input type="text" id="message-target" placeholder="Username or Room ID">
+                    <button onclick="manageMessages()" class="btn-primary" style="width: 100%; margin-top: 10px;">Execute</button>
+                    
+                    <div style="margin-top: 15px;">
+                        <h5 style="color: #aaa; margin-bottom: 10px;">Recent Messages</h5>
+                        <div id="recent-messages" class="user-list" style="max-height: 150px;"></div>
+                    </div>
+                </div>
+                
+                <div class="control-box">
+                    <h4>Security Tools</h4>
+                    <button onclick="enableCaptureProtection()" class="btn-primary" style="width: 100%; margin-bottom: 5px;">
+                        🔒 Enable Screen Protection
+                    </button>
+                    <button onclick="disableCaptureProtection()" class="btn-warning" style="width: 100%; margin-bottom: 5px;">
+                        🔓 Disable Screen Protection
+                    </button>
+                    <button onclick="forceReconnectAll()" class="btn-danger" style="width: 100%;">
+                        🔄 Force All Users Reconnect
+                    </button>
+                    <div style="display: flex; gap: 5px; margin-top: 5px;">
+                        <input type="number" id="poll-interval" min="0.5" max="60" step="0.5" placeholder="Poll interval (s)" style="flex: 1;">
+                        <button onclick="setPollInterval()" class="btn-warning">⏱ Set</button>
+                    </div>
+                    <div style="margin-top: 15px; padding: 10px; background: rgba(255,0,0,0.1); border-radius: 4px;">
+                        <small style="color: #ff6b6b;">⚠️ These actions affect all users immediately</small>
+                    </div>
+                </div>
+            </div>
+        </div>
+        {% endif %}
+        
+        <div class="main-content">
+            <div class="sidebar">
+                <h3>Rooms</h3>
+                <ul class="room-list" id="room-list"></ul>
+                <div style="margin-top: 20px; padding-top: 15px; border-top: 1px solid #444;">
+                    <h4 style="color: #aaa; font-size: 14px; margin-bottom: 10px;">Online Users</h4>
+                    <div id="online-users" class="user-list" style="max-height: 200px;"></div>
+                </div>
+            </div>
+            
+            <div class="chat-area">
+                <div style="display: flex; justify-content: space-between; align-items: center; margin-bottom: 15px;">
+                    <h3 style="color: var(--accent-color);" id="room-title">Select a room</h3>
+                    <div id="room-info" style="color: #aaa; font-size: 12px;"></div>
+                </div>
+                
+                <div id="messages"></div>
+                <div id="typing-indicator" class="message-typing"></div>
+                
+                <div class="chat-input">
+                    <input type="text" id="message-text" placeholder="Type a message or paste GIF URL..." autocomplete="off" required maxlength="500" onkeyup="checkForGif(this.value)" onkeypress="handleTyping(event)">
+                    <button type="button" onclick="toggleGifInput()" class="btn-primary" style="padding: 12px 15px;">GIF</button>
+                    <button type="submit" onclick="sendMessage(event)" class="btn-primary">Send</button>
+                </div>
+                
+                <div class="gif-input" id="gifInput">
+                    <input type="text" id="gif-url" placeholder="Paste GIF URL here..." style="flex: 1;">
+                    <button onclick="sendGif()" class="btn-success">Send GIF</button>
+                    <input type="file" id="gif-file" accept="image/gif,image/png,image/jpeg,image/webp" style="max-width: 200px;">
+                    <button onclick="uploadGif()" class="btn-primary">Upload</button>
+                    <button onclick="toggleGifInput()" class="btn-danger">Cancel</button>
+                </div>
+            </div>
+        </div>
+        {% endif %}
+    </div>
+</body>
+</html>
 
-    // Prevent F12, Ctrl+Shift+I, Ctrl+Shift+J, Ctrl+Shift+C
-    document.addEventListener('keydown', (e) => {
-        if (e.key === 'F12' || 
-            (e.ctrlKey && e.shiftKey && ['I', 'J', 'C'].includes(e.key)) ||
-            (e.metaKey && e.altKey && e.key === 'I')) {
-            e.preventDefault();
-            showNotification('Developer tools are disabled', 'warning');
-            // Apply screen effect
-            document.body.style.filter = 'invert(1)';
-            setTimeout(() => {
-                document.body.style.filter = '';
-            }, 1000);
-            return false;
-        }
-    });
-</script>
+<script id="bootstrap" type="application/json">__BOOTSTRAP_JSON__</script>
+<script src="{{ asset_urls['app.js'] }}"></script>
+{% if is_admin %}
+<script src="{{ asset_urls['admin.js'] }}"></script>
+{% endif %}
 </html>
 """
 
@@ -1908,6 +4269,102 @@ ADMIN_LOGIN_PAGE = """
 </html>
 """
 
+# Per-user theme/layout variables, injected into the shared page shell
+THEME_STYLE = """<style>
+        :root {
+            --bg-color: {{ theme_colors.bg }};
+            --primary-color: {{ theme_colors.primary }};
+            --secondary-color: {{ theme_colors.secondary }};
+            --accent-color: {{ theme_colors.accent }};
+            --message-spacing: {{ layout_settings.message_spacing }};
+            --font-size: {{ layout_settings.font_size }};
+            --padding: {{ layout_settings.padding }};
+            --message-radius: {{ '20px' if layout_settings.get('bubbles') else '8px' }};
+        }
+        {% if layout_settings.get('bubbles') %}
+        .msg {
+            margin-bottom: var(--message-spacing);
+            padding: 12px 18px;
+            background: var(--accent-color);
+            color: #000;
+            border-left: none;
+            border-radius: 20px 20px 20px 5px;
+            max-width: 80%;
+            position: relative;
+            animation: fadeIn 0.3s ease;
+        }
+        
+        .msg.own {
+            background: #2ecc71;
+            color: white;
+            border-radius: 20px 20px 5px 20px;
+            margin-left: auto;
+        }
+        {% endif %}
+    </style>"""
+
+# CSS and JS are served as fingerprinted static files. Every encoding is built
+# once at startup, so requests only pick the best variant the client accepts.
+STATIC_ASSETS = {}  # fingerprinted name -> {"mimetype", "etag", "variants": {encoding: bytes}}
+ASSET_URLS = {}  # logical name -> /assets/<fingerprinted name>
+
+def build_static_asset(logical_name, source, mimetype):
+    """Register an asset under a content-hash filename with precompressed variants"""
+    body = source.encode()
+    digest = hashlib.sha256(body).hexdigest()[:16]
+    stem, ext = logical_name.rsplit(".", 1)
+    name = f"{stem}.{digest}.{ext}"
+    variants = {"identity": body, "gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=11)
+    STATIC_ASSETS[name] = {"mimetype": mimetype, "etag": digest, "variants": variants}
+    ASSET_URLS[logical_name] = f"/assets/{name}"
+
+build_static_asset("app.css", APP_CSS, "text/css")
+build_static_asset("app.js", APP_JS, "application/javascript")
+build_static_asset("admin.js", ADMIN_JS, "application/javascript")
+
+# Templates are compiled once at startup instead of on every page load
+INDEX_TEMPLATE = app.jinja_env.from_string(HTML_PAGE)
+THEME_STYLE_TEMPLATE = app.jinja_env.from_string(THEME_STYLE)
+ADMIN_LOGIN_TEMPLATE = app.jinja_env.from_string(ADMIN_LOGIN_PAGE)
+INDEX_SHELLS = {}  # (logged_in, is_admin) -> (head, middle, tail) of the rendered page
+
+def get_index_shell(logged_in, is_admin):
+    """Rendered page shell for a variant, split around the per-user slots.
+
+    Rendered lazily because url_for needs a request context.
+    """
+    key = (logged_in, is_admin)
+    shell = INDEX_SHELLS.get(key)
+    if shell is None:
+        page = INDEX_TEMPLATE.render(
+            logged_in=logged_in,
+            is_admin=is_admin,
+            themes=THEMES,
+            layouts=LAYOUTS,
+            asset_urls=ASSET_URLS
+        )
+        head, rest = page.split("<!--USER-STYLE-->", 1)
+        middle, tail = rest.split("__BOOTSTRAP_JSON__", 1)
+        shell = INDEX_SHELLS[key] = (head, middle, tail)
+    return shell
+
+@lru_cache(maxsize=None)
+def render_theme_style(theme, layout):
+    return THEME_STYLE_TEMPLATE.render(
+        theme_colors=THEMES.get(theme, THEMES["dark"]),
+        layout_settings=LAYOUTS.get(layout, LAYOUTS["modern"])
+    )
+
+@lru_cache(maxsize=None)
+def render_admin_login(error=None):
+    return ADMIN_LOGIN_TEMPLATE.render(error=error)
+
+def bootstrap_json(data):
+    """JSON that is safe to embed inside a <script> element"""
+    return json.dumps(data).replace("<", "\\u003c").replace(">", "\\u003e").replace("&", "\\u0026")
+
 # ====================
 # ENHANCED ROUTES
 # ====================
@@ -1935,34 +4392,58 @@ def index():
     user_layout = USER_PROFILES.get(username, {}).get("layout", "modern")
     
     # Get geo data
-    geo_data = {}
-    if username and username in ACTIVE_USERS:
-        geo_data = ACTIVE_USERS[username].get("geo", {})
+    geo_data = ACTIVE_USERS.get(username, {}).get("geo", {}) if username else {}
     
     # Prepare stats for admin
     stats = {}
     if is_admin:
         stats = {
             "active_users": len(ACTIVE_USERS),
-            "total_messages": sum(len(msgs) for msgs in MESSAGES.values()),
+            "total_messages": STATS["messages"],
             "banned_count": len(BANNED_USERS) + len(BANNED_IPS),
             "rooms_count": len(ROOMS)
         }
     
-    return render_template_string(HTML_PAGE,
-        username=username,
-        is_admin=is_admin,
-        admin_undercover=admin_undercover,
-        admin_ascii_art=generate_ascii_art() if is_admin and not admin_undercover else "",
-        user_theme=user_theme,
-        user_layout=user_layout,
-        theme_colors=THEMES.get(user_theme, THEMES["dark"]),
-        layout_settings=LAYOUTS.get(user_layout, LAYOUTS["modern"]),
-        themes=THEMES,
-        layouts=LAYOUTS,
-        geo_data=geo_data,
-        stats=stats
-    )
+    bootstrap = {
+        "username": username or "",
+        "is_admin": is_admin,
+        "admin_undercover": admin_undercover,
+        "ascii_art": generate_ascii_art() if is_admin and not admin_undercover else "",
+        "theme": user_theme,
+        "layout": user_layout,
+        "geo": geo_data,
+        "stats": stats
+    }
+    
+    head, middle, tail = get_index_shell(bool(username), is_admin)
+    page = head + render_theme_style(user_theme, user_layout) + middle + bootstrap_json(bootstrap) + tail
+    return Response(page, mimetype="text/html")
+
+
+@app.route("/assets/<name>")
+def static_asset(name):
+    asset = STATIC_ASSETS.get(name)
+    if asset is None:
+        abort(404)
+    
+    # Content negotiation over the prebuilt variants; nothing is compressed here
+    encoding = "identity"
+    for candidate in ("br", "gzip"):
+        if candidate in asset["variants"] and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    etag = f'{asset["etag"]}-{encoding}'
+    
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(asset["variants"][encoding], mimetype=asset["mimetype"])
+        if encoding != "identity":
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 
 @app.route("/admin", methods=["GET", "POST"])
@@ -1980,9 +4461,9 @@ def admin_login():
             # Log failed attempt
             client_ip = get_client_ip()
             print(f"[SECURITY] Failed admin login attempt from {client_ip}: {username}")
-            return render_template_string(ADMIN_LOGIN_PAGE, error="Invalid credentials")
+            return render_admin_login("Invalid credentials")
     
-    return render_template_string(ADMIN_LOGIN_PAGE)
+    return render_admin_login()
 
 
 @app.route("/set-username", methods=["POST"])
@@ -2003,24 +4484,25 @@ def set_username():
     
     # Initialize user profile
     if username not in USER_PROFILES:
-        USER_PROFILES[username] = {
+        init_user_profile(username, {
             "avatar": avatar if avatar else None,
             "theme": "dark",
             "layout": "modern",
             "joined": datetime.now()
-        }
+        })
     
     # Update active users
     client_ip = get_client_ip()
-    geo_data = get_geolocation(client_ip)
+    geo_data = resolve_geolocation(client_ip, username)
     
-    ACTIVE_USERS[username] = {
+    add_active_user(username, {
         "last_seen": datetime.now(),
         "ip": client_ip,
         "geo": geo_data,
         "room": "general",
         "user_agent": request.headers.get('User-Agent', '')
-    }
+    }, replace=True)
+    catch_up_user_geo(username, client_ip, geo_data)
     
     return redirect(url_for("index"))
 
@@ -2028,19 +4510,22 @@ def set_username():
 @app.route("/logout", methods=["POST"])
 def logout():
     username = session.get("username")
-    if username and username in ACTIVE_USERS:
-        del ACTIVE_USERS[username]
+    if username:
+        remove_active_user(username)
     session.clear()
     return redirect(url_for("index"))
 
 
 @app.route("/rooms")
 def get_rooms():
+    # Count users per room from one snapshot
+    room_counts = defaultdict(int)
+    for user_data in list(ACTIVE_USERS.values()):
+        room_counts[user_data.get("room")] += 1
+    
     rooms = []
-    for room_id, room_data in ROOMS.items():
-        # Count users in room
-        user_count = sum(1 for user_data in ACTIVE_USERS.values() 
-                        if user_data.get("room") == room_id)
+    for room_id, room_data in list(ROOMS.items()):
+        user_count = room_counts[room_id]
         
         rooms.append({
             "id": room_id,
@@ -2062,8 +4547,40 @@ def get_messages():
         after = 0
     
     messages_list = list(MESSAGES[room])
+    
+    # Time-range query, e.g. ?since=2024-05-01T14:00 or ?since=<epoch ms>
+    since_ms = None
+    if request.args.get("since"):
+        try:
+            since_ms = parse_since(request.args["since"])
+        except ValueError:
+            return "Invalid since", 400
+        after = messages_since(messages_list, since_ms)
+    
     new_messages = messages_list[after:]
     
+    # Merge in announcements and this user's admin messages. Each feed has
+    # its own cursor; without one, start where the room history returned
+    # here starts so a fresh page sees the same announcements it used to.
+    if since_ms is None:
+        if 0 < after <= len(messages_list):
+            since_ms = messages_list[after - 1]["ts"] + 1
+        else:
+            since_ms = messages_list[0]["ts"] if messages_list else 0
+    cursors = {}
+    feeds = [("broadcast", BROADCASTS), ("inbox", INBOXES.get(session.get("username", "")))]
+    for name, channel in feeds:
+        try:
+            cursor = int(request.args[name]) if request.args.get(name) else None
+        except ValueError:
+            cursor = None
+        if channel is None:
+            cursors[name] = cursor or 0
+            continue
+        extra, cursors[name] = channel.read(cursor, since_ms)
+        if extra:
+            new_messages = sorted(new_messages + extra, key=lambda msg: msg.get("ts", 0))
+    
     # Filter out deleted messages
     filtered_messages = []
     for msg in new_messages:
@@ -2074,10 +4591,27 @@ def get_messages():
             msg["text"] = "[Message deleted]"
         filtered_messages.append(msg)
     
-    return jsonify({"messages": filtered_messages, "last_index": len(messages_list)})
+    # Report on GIFs the client is still showing as pending
+    gif_status = {}
+    gif_urls = {}
+    for message_id in request.args.get("pending", "").split(",")[:50]:
+        metadata = MESSAGE_METADATA.get(message_id)
+        if metadata and metadata.get("gif_status"):
+            gif_status[message_id] = metadata["gif_status"]
+            gif_urls[message_id] = metadata.get("gif_url")
+    
+    return jsonify({
+        "messages": filtered_messages,
+        "last_index": len(messages_list),
+        "broadcast_cursor": cursors["broadcast"],
+        "inbox_cursor": cursors["inbox"],
+        "gif_status": gif_status,
+        "gif_urls": gif_urls
+    })
 
 
 @app.route("/send", methods=["POST"])
+@rate_limited("send")
 def send_message():
     username = session.get("username")
     if not username:
@@ -2085,30 +4619,22 @@ def send_message():
     
     data = request.get_json(silent=True) or {}
     text = (data.get("text") or "").strip()
-    room = data.get("room", "general")
+    room = request_room(data)
     
     if not text or not room:
         return "Invalid data", 400
     
     # Update user's active status
-    if username in ACTIVE_USERS:
-        ACTIVE_USERS[username]["last_seen"] = datetime.now()
-        ACTIVE_USERS[username]["room"] = room
-    
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    message_id = generate_message_id()
-    
-    MESSAGES[room].append({
-        "id": message_id,
-        "time": timestamp,
-        "user": username,
-        "text": sanitize_html(text)
-    })
+    touch_active_user(username, last_seen=datetime.now(), room=room)
+    
+    message = new_message(username, sanitize_html(text))
+    append_message(room, message)
     
-    return jsonify({"status": "OK", "message_id": message_id}), 200
+    return jsonify({"status": "OK", "message_id": message["id"]}), 200
 
 
 @app.route("/send-gif", methods=["POST"])
+@rate_limited("send-gif")
 def send_gif():
     username = session.get("username")
     if not username:
@@ -2116,41 +4642,150 @@ def send_gif():
     
     data = request.get_json(silent=True) or {}
     gif_url = (data.get("url") or "").strip()
-    room = data.get("room", "general")
+    room = request_room(data)
     
     if not gif_url or not room:
         return "Invalid data", 400
     
-    # Validate GIF URL
-    if not validate_gif_url(gif_url):
+    # Validate GIF URL: syntax now, remote check in the background
+    gif_url = normalize_gif_url(gif_url)
+    if not gif_url:
+        return "Invalid GIF URL", 400
+    cached = cached_gif_display_url(gif_url)
+    if cached is False:
         return "Invalid GIF URL", 400
+    if not cached and request_gif_validation(gif_url) == "busy":
+        return "Too many GIFs waiting to be checked, please retry", 503, {"Retry-After": "5"}
     
     # Store GIF metadata
     gif_id = hashlib.md5(gif_url.encode()).hexdigest()[:16]
-    UPLOADED_GIFS[gif_id] = {
+    record_uploaded_gif(gif_id, {
         "url": gif_url,
         "uploader": username,
         "timestamp": datetime.now()
-    }
+    })
     
     # Send message with GIF
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    message_id = generate_message_id()
-    
-    MESSAGES[room].append({
-        "id": message_id,
-        "time": timestamp,
-        "user": username,
-        "text": f"[GIF shared by {username}]",
-        "gif_url": gif_url
-    })
+    message = new_message(
+        username,
+        f"[GIF shared by {username}]",
+        gif_url=cached or gif_url,
+        gif_origin=gif_url,  # where a proxied copy came from, should it be evicted
+        gif_status="valid" if cached else "pending"
+    )
+    message_id = message["id"]
     
-    MESSAGE_METADATA[message_id] = {
-        "gif_url": gif_url,
+    append_message(room, message, {
+        "gif_url": message["gif_url"],
+        "gif_origin": gif_url,
+        "gif_status": message["gif_status"],
         "deleted": False
-    }
+    })
+    
+    if not cached:
+        status = request_gif_validation(gif_url, (room, message_id))
+        if status != "pending":
+            # The check finished before the message was posted
+            resolve_gif_messages([(room, message_id)], status, cached_gif_display_url(gif_url))
+    
+    return jsonify({"status": "OK", "message_id": message_id, "gif_status": message["gif_status"]}), 200
+
+
+@app.route("/upload-media", methods=["POST"])
+@rate_limited("upload")
+def upload_media():
+    """Accept a raw image body (not multipart) and queue it for transcoding"""
+    username = session.get("username")
+    if not username:
+        return "No username", 401
+    if _media_pending_by_user.get(username, 0) >= MEDIA_MAX_PENDING_PER_USER:
+        return "Your earlier uploads are still processing", 429, {"Retry-After": "5"}
+    
+    room = request.args.get("room", "general")
+    try:
+        path, digest = stream_upload_to_file(request.stream, request.content_length)
+    except UploadRejected as e:
+        return str(e), e.status
+    
+    # Same bytes uploaded before: post the existing transcode straight away
+    previous = UPLOAD_SOURCES.get(digest)
+    if previous and all(media_store_has(url[len("/media/"):]) for url in previous.values()):
+        _remove_quietly(path)
+        message_id = post_uploaded_gif(username, room, previous)
+        return jsonify({"status": "done", "message_id": message_id}), 200
+    
+    # Reject obviously oversized images from the header before using the pool
+    try:
+        with Image.open(path) as header:
+            check_image_budget(*header.size)
+    except ValueError as e:
+        _remove_quietly(path)
+        return str(e), 400
+    except Exception:
+        _remove_quietly(path)
+        return "Unsupported image", 400
+    
+    upload_id = submit_media_upload(path, digest, username, room)
+    if upload_id is None:
+        _remove_quietly(path)
+        return "Upload queue is full, try again shortly", 503
+    return jsonify({"status": "processing", "upload_id": upload_id}), 202
+
+
+@app.route("/upload-status/<upload_id>")
+def upload_status(upload_id):
+    job = UPLOAD_JOBS.get(upload_id)
+    if job is None:
+        return "Unknown upload", 404
+    return jsonify(job)
+
+
+def media_cache_miss(name):
+    """Response for a media name that is not on disk"""
+    global MEDIA_CACHE_BYTES
+    with MEDIA_LOCK:
+        size = MEDIA_INDEX.pop(name, None)
+        if size is not None:
+            MEDIA_CACHE_BYTES -= size
+    # An evicted proxy copy: send the viewer to the origin meanwhile and
+    # fetch it again (same bytes, so the same name) in the background
+    origin = MEDIA_ORIGINS.get(name)
+    if origin is None:
+        abort(404)
+    request_gif_validation(origin)
+    response = redirect(origin)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@app.route("/media/<name>")
+def cached_media(name):
+    """Serve an upload from the media store or a proxied GIF from the media cache"""
+    if not MEDIA_NAME_RE.match(name):
+        abort(404)
+    path = os.path.join(MEDIA_STORE_DIR, name)
+    if not os.path.isfile(path):
+        if not media_cache_has(name):
+            return media_cache_miss(name)
+        with MEDIA_LOCK:
+            if name in MEDIA_INDEX:
+                MEDIA_INDEX.move_to_end(name)
+        path = os.path.join(MEDIA_CACHE_DIR, name)
     
-    return jsonify({"status": "OK", "message_id": message_id}), 200
+    digest, ext = name.split(".")
+    try:
+        response = send_file(
+            os.path.abspath(path),
+            mimetype=MEDIA_MIMETYPES[ext],
+            conditional=True,  # honours If-None-Match and Range requests
+            etag=digest,
+            max_age=365 * 24 * 3600
+        )
+    except FileNotFoundError:
+        return media_cache_miss(name)  # another worker evicted it
+    # The name is the content hash, so the bytes behind it can never change
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 
 @app.route("/delete-message", methods=["POST"])
@@ -2161,17 +4796,17 @@ def delete_message():
     
     data = request.get_json(silent=True) or {}
     message_id = data.get("message_id")
-    room = data.get("room", "general")
+    room = request_room(data)
     
     if not message_id:
         return "No message ID", 400
     
     # Find and mark message as deleted
-    for msg in list(MESSAGES[room]):
+    for msg in list(MESSAGES.get(room, ())):
         if msg.get("id") == message_id:
             # Check if user owns the message or is admin
             if msg.get("user") == username or session.get("is_admin"):
-                MESSAGE_METADATA[message_id] = {"deleted": True}
+                mark_messages_deleted([message_id])
                 return "OK", 200
     
     return "Message not found or unauthorized", 403
@@ -2192,10 +4827,10 @@ def check_effects():
         return jsonify({"banned": True, "username": username})
     
     # Check IP-based effects
-    if client_ip in BLACKLIST:
-        effect_data = BLACKLIST[client_ip]
+    effect_data = BLACKLIST.get(client_ip)
+    if effect_data:
         if effect_data.get("expires") and datetime.now() > effect_data["expires"]:
-            del BLACKLIST[client_ip]
+            expire_effect("ip", client_ip, effect_data)
         else:
             return jsonify({
                 "banned": False,
@@ -2205,10 +4840,10 @@ def check_effects():
             })
     
     # Check username-based effects
-    if username and username in USER_EFFECTS:
-        effect_data = USER_EFFECTS[username]
+    effect_data = USER_EFFECTS.get(username) if username else None
+    if effect_data:
         if effect_data.get("expires") and datetime.now() > effect_data["expires"]:
-            del USER_EFFECTS[username]
+            expire_effect("user", username, effect_data)
         else:
             return jsonify({
                 "banned": False,
@@ -2233,8 +4868,7 @@ def switch_theme():
     if theme not in THEMES:
         theme = "dark"
     
-    if username in USER_PROFILES:
-        USER_PROFILES[username]["theme"] = theme
+    update_user_profile(username, theme=theme)
     
     return "OK", 200
 
@@ -2251,8 +4885,7 @@ def switch_layout():
     if layout not in LAYOUTS:
         layout = "modern"
     
-    if username in USER_PROFILES:
-        USER_PROFILES[username]["layout"] = layout
+    update_user_profile(username, layout=layout)
     
     return "OK", 200
 
@@ -2264,32 +4897,30 @@ def update_active():
         return "Unauthorized", 401
     
     data = request.get_json(silent=True) or {}
-    room = data.get("room", "general")
+    room = request_room(data)
+    if room is None:
+        return "Invalid room", 400
     
     client_ip = get_client_ip()
     
-    if username in ACTIVE_USERS:
-        ACTIVE_USERS[username]["last_seen"] = datetime.now()
-        ACTIVE_USERS[username]["room"] = room
-    else:
-        geo_data = get_geolocation(client_ip)
-        ACTIVE_USERS[username] = {
+    if not touch_active_user(username, last_seen=datetime.now(), room=room):
+        geo_data = resolve_geolocation(client_ip, username)
+        add_active_user(username, {
             "last_seen": datetime.now(),
             "ip": client_ip,
             "geo": geo_data,
             "room": room,
             "user_agent": request.headers.get('User-Agent', '')
-        }
-    
-    # Clean up inactive users (5 minutes)
-    inactive_threshold = datetime.now() - timedelta(minutes=5)
-    users_to_remove = [
-        user for user, data in ACTIVE_USERS.items() 
-        if data["last_seen"] < inactive_threshold and user != username
-    ]
+        })
+        catch_up_user_geo(username, client_ip, geo_data)
     
-    for user in users_to_remove:
-        del ACTIVE_USERS[user]
+    # Clean up inactive users (5 minutes). Most polls find nobody to evict, so
+    # check locally before logging a shared op
+    threshold = datetime.now() - timedelta(minutes=5)
+    with ACTIVE_USERS_LOCK:
+        stale = ACTIVE_USER_INDEX.any_seen_before(threshold, keep=username)
+    if stale:
+        evict_inactive_users(threshold, keep=username)
     
     return "OK", 200
 
@@ -2301,7 +4932,7 @@ def online_users():
     # Get users in the specified room
     room_users = [
         {"username": user, "geo": data.get("geo", {})}
-        for user, data in ACTIVE_USERS.items()
+        for user, data in list(ACTIVE_USERS.items())
         if data.get("room") == room
     ]
     
@@ -2309,23 +4940,23 @@ def online_users():
 
 
 @app.route("/typing", methods=["POST"])
+@rate_limited("typing")
 def typing():
     username = session.get("username")
     if not username:
         return "Unauthorized", 401
     
     data = request.get_json(silent=True) or {}
-    room = data.get("room", "general")
+    room = request_room(data)
     is_typing = data.get("typing", False)
+    if room is None:
+        return "Invalid room", 400
     
     # Store typing status with expiration
     if is_typing:
-        if username in ACTIVE_USERS:
-            ACTIVE_USERS[username]["typing"] = datetime.now()
-            ACTIVE_USERS[username]["typing_room"] = room
+        touch_active_user(username, typing=datetime.now(), typing_room=room)
     else:
-        if username in ACTIVE_USERS and "typing" in ACTIVE_USERS[username]:
-            del ACTIVE_USERS[username]["typing"]
+        clear_typing(username)
     
     return "OK", 200
 
@@ -2337,7 +4968,7 @@ def typing_status():
     # Get users typing in the room (within last 3 seconds)
     typing_threshold = datetime.now() - timedelta(seconds=3)
     typing_users = [
-        user for user, data in ACTIVE_USERS.items()
+        user for user, data in list(ACTIVE_USERS.items())
         if data.get("typing", typing_threshold) > typing_threshold
         and data.get("typing_room") == room
     ]
@@ -2362,12 +4993,12 @@ def create_room():
     room_id = name.lower().replace(" ", "-").replace("_", "-")
     room_id = re.sub(r'[^a-z0-9\-]', '', room_id)
     
-    ROOMS[room_id] = {
+    add_room(room_id, {
         "name": name,
         "privacy": privacy,
         "created_by": session.get("username"),
         "created_at": datetime.now()
-    }
+    })
     
     return "OK", 200
 
@@ -2395,11 +5026,9 @@ def screen_effect():
     if duration > 0:
         effect_data["expires"] = datetime.now() + timedelta(seconds=duration)
     
-    if target_type == "ip":
-        BLACKLIST[identifier] = effect_data
-    else:  # username
-        USER_EFFECTS[identifier] = effect_data
+    set_effect(target_type, identifier, effect_data)
     
+    bump_moderation_epoch()
     return "OK", 200
 
 
@@ -2413,11 +5042,9 @@ def clear_effect():
     if not identifier:
         return "Invalid identifier", 400
     
-    if target_type == "ip":
-        BLACKLIST.pop(identifier, None)
-    else:
-        USER_EFFECTS.pop(identifier, None)
+    remove_effect(target_type, identifier)
     
+    bump_moderation_epoch()
     return "OK", 200
 
 
@@ -2436,42 +5063,135 @@ def ban():
     admin_user = session.get("username")
     timestamp = datetime.now()
     
-    if ban_type == "ip":
-        if should_ban:
-            BANNED_IPS.add(identifier)
-            print(f"[ADMIN] IP {identifier} banned by {admin_user} for: {reason}")
-        else:
-            BANNED_IPS.discard(identifier)
-            BLACKLIST.pop(identifier, None)
-    else:  # username
-        if should_ban:
-            BANNED_USERS.add(identifier)
-            USER_EFFECTS.pop(identifier, None)
-            print(f"[ADMIN] User {identifier} banned by {admin_user} for: {reason}")
-        else:
-            BANNED_USERS.discard(identifier)
-            USER_EFFECTS.pop(identifier, None)
+    set_ban(ban_type, identifier, bool(should_ban))
+    if should_ban:
+        print(f"[ADMIN] {'IP' if ban_type == 'ip' else 'User'} {identifier} banned by {admin_user} for: {reason}")
     
+    bump_moderation_epoch()
     return "OK", 200
 
 
 @app.route("/admin/mass-unban", methods=["POST"])
 @admin_required
 def mass_unban():
-    BANNED_IPS.clear()
-    BANNED_USERS.clear()
-    BLACKLIST.clear()
-    USER_EFFECTS.clear()
+    clear_moderation()
+    bump_moderation_epoch()
     
     print(f"[ADMIN] Mass unban by {session.get('username')}")
     return "OK", 200
 
 
+# Body: {"items": [...], ...defaults}. An item is an identifier or an object
+# with identifier, action (ban|unban|effect|clear-effect|delete-messages),
+# type (ip|user) and, for effects, effect/color/duration; anything it leaves
+# out comes from the top-level fields. Either every item applies or none does.
+@app.route("/admin/bulk-moderation", methods=["POST"])
+@admin_required
+def bulk_moderation():
+    data = request.get_json(silent=True) or {}
+    raw_items = data.get("items")
+    if not isinstance(raw_items, list) or not raw_items:
+        return "items must be a non-empty list", 400
+    if len(raw_items) > BULK_MODERATION_MAX_ITEMS:
+        return f"At most {BULK_MODERATION_MAX_ITEMS} items per request", 400
+    defaults = {key: value for key, value in data.items() if key != "items"}
+    admin_user = session.get("username")
+    now = datetime.now()
+    
+    items, results = [], []
+    for raw in raw_items:
+        item = dict(defaults, **(raw if isinstance(raw, dict) else {"identifier": raw}))
+        identifier = str(item.get("identifier") or "").strip()
+        action = item.get("action", "ban")
+        target_type = item.get("type", "ip")
+        result = {"identifier": identifier, "action": action, "type": target_type}
+        results.append(result)
+        error = None
+        if not identifier:
+            error = "Invalid identifier"
+        elif action not in BULK_MODERATION_ACTIONS:
+            error = f"action must be one of {', '.join(BULK_MODERATION_ACTIONS)}"
+        elif target_type not in ("ip", "user"):
+            error = "type must be ip or user"
+        elif action == "delete-messages" and target_type != "user":
+            error = "delete-messages needs type user"
+        elif target_type == "ip":
+            try:
+                ipaddress.ip_address(identifier)
+            except ValueError:
+                error = "Invalid IP address"
+        validated = {"action": action, "type": target_type, "identifier": identifier}
+        if error is None and action == "effect":
+            try:
+                duration = int(item.get("duration", 0))
+            except (TypeError, ValueError):
+                error = "duration must be an integer"
+            else:
+                validated["effect"] = {
+                    "action": item.get("effect", "black"),
+                    "value": item.get("color", "#000000"),
+                    "applied_by": admin_user,
+                    "applied_at": now
+                }
+                if duration > 0:
+                    try:
+                        validated["effect"]["expires"] = now + timedelta(seconds=duration)
+                    except OverflowError:
+                        error = "duration is too long"
+        if error is not None:
+            result.update(status="rejected", error=error)
+        items.append(validated)
+    
+    rejected = sum(result.get("status") == "rejected" for result in results)
+    if rejected:
+        for result in results:
+            result.setdefault("status", "skipped")
+        return jsonify({"applied": 0, "rejected": rejected, "results": results}), 400
+    
+    epoch, outcomes = apply_moderation_batch(items)
+    for result, outcome in zip(results, outcomes):
+        result.update(outcome, status="applied")
+    
+    counts = defaultdict(int)
+    for item in items:
+        counts[item["action"]] += 1
+    print(f"[ADMIN] Bulk moderation by {admin_user}: {dict(counts)} for: {data.get('reason', 'No reason provided')}")
+    return jsonify({
+        "applied": len(items),
+        "changed": sum(result["changed"] for result in results),
+        "epoch": epoch,
+        "results": results
+    })
+
+
 @app.route("/admin/active-users")
 @admin_required
 def admin_active_users():
+    sort = request.args.get("sort", "last_seen")
+    if sort not in ActiveUserIndex.SORTS:
+        return f"sort must be one of {', '.join(ActiveUserIndex.SORTS)}", 400
+    descending = request.args.get("order", "desc" if sort == "last_seen" else "asc") == "desc"
+    try:
+        offset = max(int(request.args.get("offset", 0)), 0)
+        limit = min(max(int(request.args.get("limit", ACTIVE_USERS_PAGE)), 1), ACTIVE_USERS_PAGE_MAX)
+    except ValueError:
+        return "offset and limit must be integers", 400
+    
+    with ACTIVE_USERS_LOCK:
+        # Prefix filters are a slice of the username/ip index; with both,
+        # keep the users in both slices
+        only = None
+        for field in ("username", "ip"):
+            prefix = request.args.get(field, "")
+            if prefix:
+                matches = set(ACTIVE_USER_INDEX.prefix_match(field, prefix))
+                only = matches if only is None else only & matches
+        total = len(ACTIVE_USERS) if only is None else len(only)
+        page = ACTIVE_USER_INDEX.page(sort, descending, offset, limit, only)
+        entries = [(username, ACTIVE_USERS[username]) for username in page]
+    
     users = []
-    for username, data in ACTIVE_USERS.items():
+    for username, data in entries:
         users.append({
             "username": username,
             "ip": data.get("ip", "Unknown"),
@@ -2481,21 +5201,49 @@ def admin_active_users():
             "user_agent": data.get("user_agent", "")[:50]
         })
     
-    return jsonify({"users": users})
+    return jsonify({
+        "users": users,
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+        "sort": sort,
+        "order": "desc" if descending else "asc"
+    })
 
 
 @app.route("/admin/debug-info")
 @admin_required
 def admin_debug_info():
+    now = time.time()
     system_stats = {
         "total_users": len(ACTIVE_USERS),
-        "total_messages": sum(len(msgs) for msgs in MESSAGES.values()),
+        "total_messages": STATS["messages"],
+        "messages_sent": STATS["messages_sent"],
+        "gifs_sent": STATS["gifs_sent"],
         "total_gifs": len(UPLOADED_GIFS),
-        "total_rooms": len(ROOMS)
+        "total_rooms": len(ROOMS),
+        "banned_users": len(BANNED_USERS),
+        "banned_ips": len(BANNED_IPS),
+        "broadcasts": len(BROADCASTS.entries),
+        "inboxes": len(INBOXES),
+        "sends_per_second": {
+            "10s": round(SEND_RATE.rate(10, now), 2),
+            "1m": round(SEND_RATE.rate(60, now), 2),
+            "5m": round(SEND_RATE.rate(300, now), 2)
+        },
+        "rooms": {
+            room: {"messages": len(MESSAGES.get(room, ())), "sent": ROOM_SENDS.get(room, 0)}
+            for room in list(ROOMS)
+        }
     }
     
     return jsonify({
         "system_stats": system_stats,
+        "outbound": OUTBOUND.metrics(),
+        "scheduler": SCHEDULER.metrics(),
+        "rate_limits": RATE_LIMITER.metrics(),
+        "admission": ADMISSION.metrics(),
+        "compression": compression_report(),
         "banned_users": list(BANNED_USERS),
         "banned_ips": list(BANNED_IPS),
         "active_effects": [
@@ -2514,19 +5262,10 @@ def admin_message_user():
     if not target_user or not message:
         return "Invalid data", 400
     
-    # Send admin message to user
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    admin_message = f"[ADMIN MESSAGE] {message}"
-    
-    # Add to all rooms for visibility
-    for room_id in ROOMS:
-        MESSAGES[room_id].append({
-            "id": generate_message_id(),
-            "time": timestamp,
-            "user": "SYSTEM",
-            "text": f"📢 To {target_user}: {admin_message}"
-        })
+    # Only that user's sessions see it, in whichever room they are in
+    post_to_inbox(target_user, new_message("SYSTEM", f"📢 [ADMIN MESSAGE] {message}"))
     
+    print(f"[ADMIN] Message to {target_user} by {session.get('username')}: {message}")
     return "OK", 200
 
 
@@ -2539,16 +5278,8 @@ def global_message():
     if not message:
         return "Invalid message", 400
     
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    
-    # Add to all rooms
-    for room_id in ROOMS:
-        MESSAGES[room_id].append({
-            "id": generate_message_id(),
-            "time": timestamp,
-            "user": "SYSTEM",
-            "text": f"📢 GLOBAL ANNOUNCEMENT: {message}"
-        })
+    # Every room's readers merge the broadcast channel in
+    post_broadcast(new_message("SYSTEM", f"📢 GLOBAL ANNOUNCEMENT: {message}"))
     
     print(f"[ADMIN] Global message by {session.get('username')}: {message}")
     return "OK", 200
@@ -2564,25 +5295,20 @@ def manage_messages():
     
     if action == "delete":
         # Delete all messages by user
-        deleted_count = 0
-        for msg in list(MESSAGES[room]):
-            if msg.get("user") == target:
-                message_id = msg.get("id")
-                if message_id:
-                    MESSAGE_METADATA[message_id] = {"deleted": True}
-                    deleted_count += 1
+        message_ids = user_message_ids(target, room)
+        mark_messages_deleted(message_ids)
         
-        return jsonify({"deleted": deleted_count}), 200
+        return jsonify({"deleted": len(message_ids)}), 200
     
     elif action == "clear":
         # Clear all messages in room
-        MESSAGES[room].clear()
+        clear_room(room)
         return "OK", 200
     
     elif action == "export":
         # Export all messages
         all_messages = []
-        for room_id, messages in MESSAGES.items():
+        for room_id, messages in list(MESSAGES.items()):
             room_data = {
                 "room": room_id,
                 "room_name": ROOMS.get(room_id, {}).get("name", room_id),
@@ -2599,18 +5325,34 @@ def manage_messages():
 @admin_required
 def force_reconnect():
     # Apply blinking effect to all users
-    for username in list(ACTIVE_USERS.keys()):
-        USER_EFFECTS[username] = {
-            "action": "blink",
-            "value": "#ff0000",
-            "applied_by": session.get("username"),
-            "applied_at": datetime.now(),
-            "duration": 5
-        }
+    set_user_effects(list(ACTIVE_USERS), {
+        "action": "blink",
+        "value": "#ff0000",
+        "applied_by": session.get("username"),
+        "applied_at": datetime.now(),
+        "duration": 5
+    })
     
+    bump_moderation_epoch()
     return "OK", 200
 
 
+@app.route("/admin/poll-interval", methods=["POST"])
+@admin_required
+def set_poll_interval():
+    data = request.get_json(silent=True) or {}
+    try:
+        interval = float(data.get("interval"))
+    except (AttributeError, TypeError, ValueError):
+        return "Invalid interval", 400
+    if not math.isfinite(interval):
+        return "Invalid interval", 400
+    
+    update_poll_interval(min(max(interval, POLL_INTERVAL_MIN), POLL_INTERVAL_MAX))
+    print(f"[ADMIN] Poll interval set to {POLL_INTERVAL}s by {session.get('username')}")
+    return jsonify({"interval": POLL_INTERVAL}), 200
+
+
 @app.route("/admin/export-data")
 @admin_required
 def export_data():
@@ -2623,19 +5365,26 @@ def export_data():
             "banned_users": len(BANNED_USERS),
             "banned_ips": len(BANNED_IPS),
             "total_rooms": len(ROOMS),
-            "total_messages": sum(len(msgs) for msgs in MESSAGES.values())
+            "total_messages": STATS["messages"],
+            "messages_sent": STATS["messages_sent"]
         },
-        "rooms": {rid: dict(data) for rid, data in ROOMS.items()},
-        "active_users": {user: dict(data) for user, data in ACTIVE_USERS.items()},
+        "rooms": {rid: dict(data) for rid, data in list(ROOMS.items())},
+        "active_users": {user: dict(data) for user, data in list(ACTIVE_USERS.items())},
         "banned_users": list(BANNED_USERS),
-        "banned_ips": list(BANNED_IPS),
-        "messages_by_room": {
-            room_id: list(messages) 
-            for room_id, messages in MESSAGES.items()
-        }
+        "banned_ips": list(BANNED_IPS)
     }
+    rooms = list(MESSAGES.items())
+    
+    # Stream the message history one room at a time instead of building the
+    # whole document in memory; the envelope's closing brace is reopened to
+    # append "messages_by_room".
+    def generate():
+        yield app.json.dumps(export_data)[:-1] + ', "messages_by_room": {'
+        for i, (room_id, messages) in enumerate(rooms):
+            yield ("," if i else "") + app.json.dumps(room_id) + ": " + app.json.dumps(list(messages))
+        yield "}}"
     
-    return jsonify(export_data)
+    return Response(generate(), mimetype="application/json")
 
 
 @app.route("/admin/toggle-undercover", methods=["POST"])
@@ -2657,6 +5406,11 @@ def add_security_headers(response):
     response.headers['X-XSS-Protection'] = '1; mode=block'
     response.headers['Referrer-Policy'] = 'strict-origin-when-cross-origin'
     
+    # Cheap change marker for bans/effects; clients re-check only when it moves
+    response.headers['X-Moderation-Epoch'] = str(MODERATION_EPOCH)
+    # Server-side floor for the client poll scheduler
+    response.headers['X-Poll-Interval'] = str(POLL_INTERVAL)
+    
     # Cache control for sensitive pages
     if request.path in ['/', '/admin', '/check-effects']:
         response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate'
@@ -2666,51 +5420,714 @@ def add_security_headers(response):
     return response
 
 
+# Response compression for large JSON/HTML bodies. Small poll responses are
+# left alone: below COMPRESSION_MIN_SIZE gzip costs more CPU than it saves.
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_LEVEL = int(os.environ.get("COMPRESSION_LEVEL", 6))
+COMPRESSIBLE_MIMETYPES = {"application/json", "text/html", "text/plain", "text/css", "application/javascript"}
+COMPRESSION_STATS = defaultdict(lambda: {"responses": 0, "bytes_in": 0, "bytes_out": 0})  # endpoint -> totals
+COMPRESSION_LOCK = threading.Lock()
+
+def record_compression(endpoint, bytes_in, bytes_out):
+    with COMPRESSION_LOCK:
+        stats = COMPRESSION_STATS[endpoint or "unknown"]
+        stats["responses"] += 1
+        stats["bytes_in"] += bytes_in
+        stats["bytes_out"] += bytes_out
+
+def compression_report():
+    """Bytes saved per endpoint since startup"""
+    with COMPRESSION_LOCK:
+        return {
+            endpoint: dict(stats, bytes_saved=stats["bytes_in"] - stats["bytes_out"])
+            for endpoint, stats in COMPRESSION_STATS.items()
+        }
+
+def _gzip_stream(chunks, endpoint):
+    """Compress a streamed body chunk by chunk, flushing so clients see progress"""
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    bytes_in = bytes_out = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            bytes_in += len(chunk)
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            bytes_out += len(data)
+            yield data
+        data = compressor.flush()
+        bytes_out += len(data)
+        yield data
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+        record_compression(endpoint, bytes_in, bytes_out)
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip']:
+        return response
+    
+    if response.is_streamed:
+        response.response = _gzip_stream(response.response, request.endpoint)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers.pop('Content-Length', None)
+        return response
+    
+    body = response.get_data()
+    if len(body) < COMPRESSION_MIN_SIZE:
+        return response
+    compressed = gzip.compress(body, compresslevel=COMPRESSION_LEVEL)
+    if len(compressed) >= len(body):
+        return response
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = 'gzip'
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(f"{etag}-gzip")
+    record_compression(request.endpoint, len(body), len(compressed))
+    return response
+
+
 # ====================
-# CLEANUP TASK
+# BACKGROUND TASKS
 # ====================
 
+# Periodic maintenance runs on one Scheduler per serving process, started by
+# the entry points at the bottom of the file, never on import, so tools that
+# import app.py don't get background threads. In prefork mode only the slot 0
+# worker runs the tasks that mutate shared state; the ops it logs reach the
+# other workers anyway.
+SCHEDULER_LEADER = os.environ.get("PREFORK_SLOT", "0") == "0"
+
+class _ScheduledTask:
+    def __init__(self, name, fn, interval, jitter, leader_only):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.jitter = jitter
+        self.leader_only = leader_only
+        self.next_run = 0.0
+        self.thread = None  # the run in progress, if any
+        self.runs = 0
+        self.failures = 0
+        self.overruns = 0
+        self.last_duration = None
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.last_run = None
+        self.last_error = None
+
+    def delay(self):
+        """The interval +/- jitter, so processes don't all fire at once"""
+        return self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+
+class Scheduler:
+    """Runs named periodic tasks, each in its own thread, with overrun protection"""
+
+    def __init__(self):
+        self.tasks = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def every(self, interval, name=None, jitter=0.1, leader_only=False):
+        """Register the decorated function to run every `interval` seconds"""
+        def register(fn):
+            task_name = name or fn.__name__
+            self.tasks[task_name] = _ScheduledTask(task_name, fn, interval, jitter, leader_only)
+            return fn
+        return register
+
+    def start(self, leader=True):
+        if self.thread is not None:
+            return
+        now = time.monotonic()
+        for name, task in list(self.tasks.items()):
+            if task.leader_only and not leader:
+                del self.tasks[name]
+            else:
+                task.next_run = now + task.delay()
+        self.thread = threading.Thread(target=self._loop, name="scheduler", daemon=True)
+        self.thread.start()
+        print(f"[SCHEDULER] Started: {', '.join(self.tasks) or 'no tasks'}")
+
+    def stop(self, timeout=5.0):
+        """Stop scheduling and give running tasks up to `timeout` seconds to finish"""
+        self.stopping.set()
+        deadline = time.monotonic() + timeout
+        if self.thread is not None:
+            self.thread.join(timeout)
+        for task in list(self.tasks.values()):
+            thread = task.thread
+            if thread is not None:
+                thread.join(max(0.0, deadline - time.monotonic()))
+                if thread.is_alive():
+                    print(f"[SCHEDULER] {task.name} still running at shutdown")
+
+    def _loop(self):
+        while not self.stopping.is_set():
+            now = time.monotonic()
+            for task in list(self.tasks.values()):
+                if now < task.next_run:
+                    continue
+                task.next_run = now + task.delay()
+                with self.lock:
+                    if task.thread is not None:
+                        # Still busy from last time: skip this run rather than stack another
+                        task.overruns += 1
+                        print(f"[SCHEDULER] {task.name} overran its {task.interval}s interval, skipping")
+                        continue
+                    task.thread = threading.Thread(target=self._run, args=(task,), name=f"task-{task.name}", daemon=True)
+                task.thread.start()
+            next_run = min((task.next_run for task in list(self.tasks.values())), default=now + 60)
+            self.stopping.wait(max(0.0, next_run - time.monotonic()))
+
+    def _run(self, task):
+        started = time.monotonic()
+        error = None
+        try:
+            task.fn()
+        except Exception as e:
+            error = str(e)
+            print(f"[SCHEDULER] {task.name} failed: {e}")
+        elapsed = time.monotonic() - started
+        with self.lock:
+            task.runs += 1
+            task.failures += error is not None
+            task.last_error = error or task.last_error
+            task.last_duration = elapsed
+            task.max_duration = max(task.max_duration, elapsed)
+            task.total_duration += elapsed
+            task.last_run = datetime.now()
+            task.thread = None
+
+    def metrics(self):
+        """Per-task counters and run times (milliseconds)"""
+        now = time.monotonic()
+        stats = {}
+        with self.lock:
+            for name, task in self.tasks.items():
+                stats[name] = {
+                    "interval_s": task.interval,
+                    "runs": task.runs,
+                    "failures": task.failures,
+                    "overruns": task.overruns,
+                    "running": task.thread is not None,
+                    "last_ms": round(task.last_duration * 1000, 1) if task.last_duration is not None else None,
+                    "avg_ms": round(task.total_duration / task.runs * 1000, 1) if task.runs else None,
+                    "max_ms": round(task.max_duration * 1000, 1),
+                    "last_run": task.last_run.isoformat() if task.last_run else None,
+                    "next_in_s": round(max(0.0, task.next_run - now), 1) if self.thread else None,
+                    "last_error": task.last_error
+                }
+        return stats
+
+
+SCHEDULER = Scheduler()
+
+@SCHEDULER.every(60, name="expiry", leader_only=True)
 def cleanup_old_data():
-    """Clean up old data periodically"""
-    # Clean up expired effects
+    """Drop expired effects, users not seen for 15 minutes and stale inboxes"""
     now = datetime.now()
-    expired_ips = [
-        ip for ip, data in BLACKLIST.items()
-        if data.get("expires") and data["expires"] < now
-    ]
-    for ip in expired_ips:
-        del BLACKLIST[ip]
-    
-    expired_users = [
-        user for user, data in USER_EFFECTS.items()
-        if data.get("expires") and data["expires"] < now
-    ]
-    for user in expired_users:
-        del USER_EFFECTS[user]
-    
-    # Clean up old active users (15 minutes)
-    inactive_threshold = now - timedelta(minutes=15)
-    inactive_users = [
-        user for user, data in ACTIVE_USERS.items()
-        if data["last_seen"] < inactive_threshold
-    ]
-    for user in inactive_users:
-        del ACTIVE_USERS[user]
+    expire_effects(now)
+    with ACTIVE_USERS_LOCK:
+        stale = ACTIVE_USER_INDEX.any_seen_before(now - timedelta(minutes=15))
+    if stale:
+        evict_inactive_users(now - timedelta(minutes=15))
+    expire_inboxes(int((now - INBOX_TTL).timestamp() * 1000))
+
+@SCHEDULER.every(600, name="metadata-gc", leader_only=True)
+def collect_message_metadata():
+    removed = gc_message_metadata()
+    if removed:
+        print(f"[SCHEDULER] Dropped metadata for {removed} expired messages")
+
+@SCHEDULER.every(300, name="snapshot", leader_only=True)
+def snapshot_shared_state():
+    """Compact the op log on a timer too, so a quiet server restarts from a fresh snapshot"""
+    if SHARED_STORE is not None:
+        SHARED_STORE.compact()
+
+@SCHEDULER.every(60, name="rate-limit-gc")
+def collect_rate_limit_buckets():
+    RATE_LIMITER.gc()
+
+@SCHEDULER.every(300, name="cache-trim")
+def trim_caches():
+    """Free expired entries that nobody has looked up since they expired, and stale temp files"""
+    for cache in (GEO_CACHE, GIF_VALIDATION_CACHE, UPLOAD_JOBS, UPLOAD_SOURCES):
+        cache.trim()
+    removed = sweep_media_temp_files()
+    if removed:
+        print(f"[MEDIA] Removed {removed} abandoned temporary files")
 
 
-# Run cleanup every 5 minutes
-import threading
-def schedule_cleanup():
-    cleanup_old_data()
-    threading.Timer(300, schedule_cleanup).start()
+# ====================
+# ADMISSION CONTROL
+# ====================
+
+# Overload shows up as queueing before a request ever reaches Flask: in the
+# kernel's accept queue (threaded server) or behind other greenlets on the
+# event loop (gevent). A sampler estimates that queue time from how late a
+# sleeping thread wakes up plus the accept backlog divided by throughput.
+# Each route class is shed with a cheap 503 + Retry-After once the estimate
+# passes its max_queue, low-priority polls first, which drains the queue for
+# sends, moderation and the admin panel. Independently, every request takes
+# one of ADMISSION_MAX_IN_FLIGHT slots, and a class may only fill its share
+# of them, waiting up to max_wait for one, so slow handlers can't tie up
+# every thread either.
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", 64))  # 0 = no admission control
+ADMISSION_TARGET_QUEUE = float(os.environ.get("ADMISSION_TARGET_QUEUE_MS", 50)) / 1000
+ADMISSION_CLASSES = {  # share of the slots, seconds to wait for one, queue time it is shed past, Retry-After
+    "critical": {"share": 1.0, "max_wait": 5.0, "max_queue": None, "retry_after": 1},
+    "normal": {"share": 0.8, "max_wait": 1.0, "max_queue": 8 * ADMISSION_TARGET_QUEUE, "retry_after": 2},
+    "low": {"share": 0.5, "max_wait": 0.0, "max_queue": ADMISSION_TARGET_QUEUE, "retry_after": 5}
+}
+ADMISSION_SAMPLE = 0.05  # seconds between queue-time samples
+ADMISSION_LOW_PRIORITY = ("/typing-status", "/online-users", "/typing")
+ADMISSION_CRITICAL = ("/admin", "/send", "/send-gif", "/delete-message", "/check-effects", "/set-username", "/logout")
+
+def admission_class(path):
+    if path in ADMISSION_LOW_PRIORITY:
+        return "low"
+    if path in ADMISSION_CRITICAL or path.startswith("/admin/"):
+        return "critical"
+    return "normal"
+
+def accept_queue_length(sock):
+    """Connections waiting in a listening socket's accept queue (Linux only, else 0)"""
+    if sock is None or not hasattr(socket, "TCP_INFO"):
+        return 0
+    try:
+        # tcp_info.tcpi_unacked, which a listening socket uses for its backlog
+        return struct.unpack_from("I", sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104), 24)[0]
+    except OSError:
+        return 0
+
+class AdmissionController:
+    """Sheds requests by route priority when queue time or in-flight count runs high"""
+
+    def __init__(self, wsgi_app, capacity, classes):
+        self.wsgi_app = wsgi_app
+        self.capacity = capacity
+        self.limits = {name: max(1, int(capacity * cls["share"])) for name, cls in classes.items()}
+        self.classes = classes
+        self.in_flight = 0
+        self.handled = 0  # requests answered, admitted or not
+        self.queue_time = 0.0  # smoothed estimate, seconds
+        self.slots = threading.Condition()
+        self.stats = {name: {"in_flight": 0, "admitted": 0, "shed": 0, "queued": 0,
+                             "queue_ms": deque(maxlen=256)} for name in classes}
+        self.sampler = None
+
+    def start(self, server):
+        """Begin estimating queue time for `server`'s listening socket"""
+        if self.capacity and self.sampler is None:
+            self.sampler = threading.Thread(target=self._sample, args=(server,), name="admission", daemon=True)
+            self.sampler.start()
+
+    def _sample(self, server):
+        handled = self.handled
+        while True:
+            started = time.monotonic()
+            time.sleep(ADMISSION_SAMPLE)
+            elapsed = time.monotonic() - started
+            lag = max(0.0, elapsed - ADMISSION_SAMPLE)
+            handled, rate = self.handled, (self.handled - handled) / elapsed
+            backlog = accept_queue_length(getattr(server, "socket", None))
+            # Little's law: a backlog drains at the rate we answer requests
+            waiting = backlog / rate if rate else (elapsed if backlog else 0.0)
+            self.queue_time += (lag + waiting - self.queue_time) / 4
+
+    def __call__(self, environ, start_response):
+        if not self.capacity:
+            return self.wsgi_app(environ, start_response)
+        name = admission_class(environ.get("PATH_INFO", ""))
+        cls = self.classes[name]
+        stats = self.stats[name]
+        limit = self.limits[name]
+        started = time.monotonic()
+        with self.slots:
+            self.handled += 1
+            if cls["max_queue"] is not None and self.queue_time > cls["max_queue"]:
+                stats["shed"] += 1
+                return self.reject(start_response, cls["retry_after"])
+            if self.in_flight >= limit:
+                stats["queued"] += 1
+                if not cls["max_wait"] or not self.slots.wait_for(lambda: self.in_flight < limit, cls["max_wait"]):
+                    stats["shed"] += 1
+                    return self.reject(start_response, cls["retry_after"])
+            self.in_flight += 1
+            stats["in_flight"] += 1
+            stats["admitted"] += 1
+            stats["queue_ms"].append((time.monotonic() - started) * 1000)
+        try:
+            return ClosingIterator(self.wsgi_app(environ, start_response), lambda: self._release(stats))
+        except BaseException:
+            self._release(stats)
+            raise
+
+    def _release(self, stats):
+        with self.slots:
+            self.in_flight -= 1
+            stats["in_flight"] -= 1
+            self.slots.notify_all()
+
+    def reject(self, start_response, retry_after):
+        body = b"Server busy, please retry"
+        start_response("503 Service Unavailable", [
+            ("Content-Type", "text/plain"),
+            ("Content-Length", str(len(body))),
+            ("Retry-After", str(retry_after))
+        ])
+        return [body]
+
+    def metrics(self):
+        """Queue-time estimate, and per class counters and slot-wait percentiles (milliseconds)"""
+        report = {"capacity": self.capacity, "in_flight": self.in_flight,
+                  "queue_time_ms": round(self.queue_time * 1000, 1)}
+        with self.slots:
+            for name, stats in self.stats.items():
+                waits = sorted(stats["queue_ms"])
+                report[name] = {
+                    "limit": self.limits[name],
+                    "in_flight": stats["in_flight"],
+                    "admitted": stats["admitted"],
+                    "queued": stats["queued"],
+                    "shed": stats["shed"],
+                    "wait_p50_ms": round(waits[len(waits) // 2], 1) if waits else None,
+                    "wait_p95_ms": round(waits[int(len(waits) * 0.95)], 1) if waits else None
+                }
+        return report
+
+ADMISSION = AdmissionController(app.wsgi_app, ADMISSION_MAX_IN_FLIGHT, ADMISSION_CLASSES)
+app.wsgi_app = ADMISSION
+
+
+# ====================
+# GRACEFUL SHUTDOWN
+# ====================
+
+# On SIGTERM (and Ctrl-C outside prefork) a server stops accepting, answers
+# anything that still arrives with 503 + Retry-After + Connection: close so
+# clients reconnect, which in prefork lands them on another worker, waits
+# for in-flight requests and background jobs up to SHUTDOWN_GRACE, then
+# flushes the shared store before the process exits.
+SHUTDOWN_GRACE = float(os.environ.get("SHUTDOWN_GRACE", 10))  # seconds to drain before giving up
+SHUTDOWN_RETRY_AFTER = 2  # seconds clients are told to wait before reconnecting
+
+class DrainMiddleware:
+    """Counts in-flight requests and turns new ones away once draining starts"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.draining = False
+        self.in_flight = 0
+        self.idle = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self.idle:
+            if self.draining:
+                body = b"Server restarting, please retry"
+                start_response("503 Service Unavailable", [
+                    ("Content-Type", "text/plain"),
+                    ("Content-Length", str(len(body))),
+                    ("Retry-After", str(SHUTDOWN_RETRY_AFTER)),
+                    ("Connection", "close")
+                ])
+                return [body]
+            self.in_flight += 1
+        try:
+            # Released when the server closes the response, so streamed
+            # bodies (send_file) count until the last byte is written
+            return ClosingIterator(self.wsgi_app(environ, start_response), self._finished)
+        except BaseException:
+            self._finished()
+            raise
+
+    def _finished(self):
+        with self.idle:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self.idle.notify_all()
+
+    def start_draining(self):
+        with self.idle:
+            self.draining = True
+
+    def wait_idle(self, timeout):
+        """Wait for in-flight requests; False if some are still running"""
+        with self.idle:
+            return self.idle.wait_for(lambda: not self.in_flight, timeout)
+
+DRAIN = DrainMiddleware(app.wsgi_app)
+app.wsgi_app = DRAIN
+
+def background_work_pending():
+    """Jobs whose results haven't been written to shared state yet"""
+    return {
+        "uploads": _media_pending_jobs,
+        "gif_checks": len(GIF_VALIDATION_PENDING),
+        "geo_lookups": len(GEO_PENDING)
+    }
+
+def graceful_shutdown(stop_accepting):
+    """Stop accepting, drain requests and background jobs, then flush shared state"""
+    deadline = time.monotonic() + SHUTDOWN_GRACE
+    DRAIN.start_draining()
+    print(f"[SHUTDOWN] Draining {DRAIN.in_flight} in-flight requests (grace {SHUTDOWN_GRACE}s)")
+    stop_accepting()
+    if not DRAIN.wait_idle(max(0.0, deadline - time.monotonic())):
+        print(f"[SHUTDOWN] {DRAIN.in_flight} requests still running at the deadline")
+    SCHEDULER.stop(timeout=max(0.0, deadline - time.monotonic()))
+    
+    # Uploads, GIF checks and geo lookups finish by committing a shared op;
+    # let them land so other workers (or the next one) see the result
+    while any(background_work_pending().values()) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    pending = {name: count for name, count in background_work_pending().items() if count}
+    if pending:
+        print(f"[SHUTDOWN] Abandoning background work: {pending}")
+    GIF_VALIDATION_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    if _media_pool is not None:
+        _media_pool.shutdown(wait=False, cancel_futures=True)
+    
+    if SHARED_STORE is not None:
+        SHARED_STORE.close()
+    print("[SHUTDOWN] Done")
+
+def repeated_signal(signum):
+    """A signal while already draining: a second Ctrl-C forces exit, SIGTERM is ignored"""
+    # systemd (KillMode=control-group) and the prefork supervisor may both
+    # SIGTERM a worker; exiting on the second would skip the drain and flush
+    if signum == signal.SIGINT:
+        print("[SHUTDOWN] Second interrupt, exiting now")
+        os._exit(1)
+    print("[SHUTDOWN] Already draining, ignoring repeated SIGTERM")
+
+def serve(server, signals=(signal.SIGTERM, signal.SIGINT)):
+    """Run a server until one of `signals` arrives, then shut it down gracefully"""
+    if SERVER_MODE == "gevent":
+        import gevent
+        from gevent.event import Event
+        finished = Event()
+        
+        def shutdown():
+            graceful_shutdown(server.close)
+            server.stop(timeout=0)  # drop idle keep-alive connections
+            finished.set()
+        
+        def on_signal(signum):
+            if DRAIN.draining:
+                return repeated_signal(signum)
+            gevent.spawn(shutdown)
+        
+        for signum in signals:
+            gevent.signal_handler(signum, on_signal, signum)
+        # close() also wakes serve_forever, which then kills whatever is still
+        # running after stop_timeout (1s by default) unless given the full grace
+        server.serve_forever(stop_timeout=SHUTDOWN_GRACE)
+        finished.wait()
+    else:
+        finished = threading.Event()
+        
+        def shutdown():
+            # serve_forever closes the listening socket once its loop exits
+            graceful_shutdown(server.shutdown)
+            finished.set()
+        
+        def on_signal(signum, frame):
+            if DRAIN.draining:
+                return repeated_signal(signum)
+            threading.Thread(target=shutdown, name="shutdown").start()
+        
+        for signum in signals:
+            signal.signal(signum, on_signal)
+        server.serve_forever()
+        finished.wait()
 
-schedule_cleanup()
 
 # ====================
 # RUN APPLICATION
 # ====================
 
-if __name__ == "__main__":
+SERVER_HOST = os.environ.get("HOST", "0.0.0.0")
+SERVER_PORT = int(os.environ.get("PORT", 5000))
+
+# gevent serve mode (SERVER=gevent)
+GEVENT_POOL_SIZE = int(os.environ.get("GEVENT_POOL_SIZE", 1000))  # max concurrent connections
+GEVENT_BACKLOG = int(os.environ.get("GEVENT_BACKLOG", 2048))  # pending connections queued by the kernel
+GEVENT_KEEPALIVE = float(os.environ.get("GEVENT_KEEPALIVE", 15))  # idle/slow socket timeout, seconds
+GEVENT_REQUEST_TIMEOUT = float(os.environ.get("GEVENT_REQUEST_TIMEOUT", 60))  # per-request deadline, seconds
+
+def make_gevent_server(listener):
+    """Build a pooled gevent WSGIServer with keep-alive and request timeouts"""
+    import gevent
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer, WSGIHandler
+
+    class ChatWSGIHandler(WSGIHandler):
+        def handle(self):
+            # Bounds every socket read/write, so idle keep-alive connections
+            # and clients that stall mid-request don't hold a pool slot forever
+            self.socket.settimeout(GEVENT_KEEPALIVE)
+            super().handle()
+
+        def start_response(self, status, headers, exc_info=None):
+            # pywsgi closes HTTP/1.1 connections the client asked to close
+            # without saying so; without the header, pooled clients reuse
+            # the dead socket
+            if self.close_connection and not any(name.lower() == "connection" for name, _ in headers):
+                headers = list(headers) + [("Connection", "close")]
+            return super().start_response(status, headers, exc_info)
+
+        def run_application(self):
+            timeout = gevent.Timeout(GEVENT_REQUEST_TIMEOUT)
+            timeout.start()
+            try:
+                super().run_application()
+            except gevent.Timeout as t:
+                if t is not timeout:
+                    raise
+                print(f"[SERVER] {self.environ.get('PATH_INFO')} timed out after {GEVENT_REQUEST_TIMEOUT}s")
+                self.close_connection = True
+                if not self.headers_sent:
+                    body = b"Request timed out"
+                    self.start_response("504 Gateway Timeout", [
+                        ("Content-Type", "text/plain"),
+                        ("Content-Length", str(len(body))),
+                        ("Connection", "close")
+                    ])
+                    self.write(body)
+            finally:
+                timeout.close()
+
+    return WSGIServer(
+        listener,
+        app,
+        backlog=GEVENT_BACKLOG if isinstance(listener, tuple) else None,  # a socket is already listening
+        spawn=Pool(GEVENT_POOL_SIZE),
+        handler_class=ChatWSGIHandler
+    )
+
+# Prefork mode (WORKERS=N): the supervisor binds N listening sockets to the
+# same port with SO_REUSEPORT, so the kernel spreads connections across them,
+# and runs one worker process per socket. The sockets stay open in the
+# supervisor, so a crashed or reloaded worker is replaced on the same socket
+# and connections queued on it wait for the replacement instead of being
+# reset. Workers share chat state through the SharedStore log.
+PREFORK_WORKERS = int(os.environ.get("WORKERS", 0))  # 0 = single process, no supervisor
+PREFORK_LISTEN_FD = os.environ.get("PREFORK_LISTEN_FD")  # only set inside worker processes
+
+def make_mode_server(listener):
+    """The SERVER mode's server on a (host, port) tuple or a listening socket"""
+    if SERVER_MODE == "gevent":
+        return make_gevent_server(listener)
+    from werkzeug.serving import make_server
+    if isinstance(listener, tuple):
+        return make_server(*listener, app, threaded=True)
+    return make_server(SERVER_HOST, SERVER_PORT, app, threaded=True, fd=listener.fileno())
+
+def bind_reuseport_socket(host, port, backlog):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+def run_worker():
+    """Serve on the socket inherited from the supervisor until SIGTERM"""
+    global SHARED_STORE
+    SHARED_STORE = SharedStore(SHARED_STORE_PATH)
+    SHARED_STORE.sync()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C is the supervisor's to handle
+    
+    server = make_mode_server(socket.socket(fileno=int(PREFORK_LISTEN_FD)))
+    SCHEDULER.start(leader=SCHEDULER_LEADER)
+    ADMISSION.start(server)
+    ready_fd = int(os.environ["PREFORK_READY_FD"])
+    os.write(ready_fd, b"1")
+    os.close(ready_fd)
+    # Closing our copy of the socket stops this worker accepting; the
+    # supervisor's copy keeps it open for the replacement
+    serve(server, signals=(signal.SIGTERM,))
+
+def run_prefork(workers):
+    """Supervise worker processes: restart crashes, rolling reload on SIGHUP"""
+    store = SharedStore.reset(SHARED_STORE_PATH)
+    store.append("seed_moderation_epoch", MODERATION_EPOCH)
+    sockets = [bind_reuseport_socket(SERVER_HOST, SERVER_PORT, GEVENT_BACKLOG) for _ in range(workers)]
+    node_ids = itertools.count()
+    flags = {"reload": False, "stop": False}
+    
+    def spawn(slot):
+        fd = sockets[slot].fileno()
+        ready_r, ready_w = os.pipe()
+        env = dict(os.environ, PREFORK_LISTEN_FD=str(fd), PREFORK_READY_FD=str(ready_w),
+                   PREFORK_SLOT=str(slot), NODE_ID=str(next(node_ids) % 1024))
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env, pass_fds=(fd, ready_w))
+        os.close(ready_w)
+        ready = select.select([ready_r], [], [], 60)[0] and os.read(ready_r, 1)
+        os.close(ready_r)
+        if not ready:
+            print(f"[PREFORK] Worker {proc.pid} did not come up")
+        proc.started = time.monotonic()
+        return proc
+    
+    def stop(proc):
+        proc.terminate()
+        try:
+            proc.wait(SHUTDOWN_GRACE + 5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+    
+    signal.signal(signal.SIGHUP, lambda *_: flags.update(reload=True))
+    signal.signal(signal.SIGTERM, lambda *_: flags.update(stop=True))
+    signal.signal(signal.SIGINT, lambda *_: flags.update(stop=True))
+    
+    procs = [spawn(slot) for slot in range(workers)]
+    print(f"[PREFORK] {workers} workers up: {[proc.pid for proc in procs]}")
+    while not flags["stop"]:
+        time.sleep(0.5)
+        if flags["reload"]:
+            flags["reload"] = False
+            # One slot at a time: the replacement is accepting before the old
+            # worker stops, and both share the slot's socket meanwhile
+            for slot in range(workers):
+                old = procs[slot]
+                procs[slot] = spawn(slot)
+                stop(old)
+            print(f"[PREFORK] Reloaded: {[proc.pid for proc in procs]}")
+        for slot, proc in enumerate(procs):
+            if proc.poll() is not None and not flags["stop"]:
+                print(f"[PREFORK] Worker {proc.pid} exited with {proc.returncode}, restarting")
+                if time.monotonic() - proc.started < 1:
+                    time.sleep(1)  # don't spin if it dies on startup
+                procs[slot] = spawn(slot)
+    
+    print("[PREFORK] Shutting down")
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        try:
+            proc.wait(SHUTDOWN_GRACE + 5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+if __name__ == "__main__" and PREFORK_LISTEN_FD:
+    run_worker()
+elif __name__ == "__main__":
     print("🚀 Enhanced Chat Server Starting...")
     print("📊 Features loaded:")
     print("   • 8 Themes + 4 Layouts")
@@ -2723,6 +6140,15 @@ if __name__ == "__main__":
     print("   • Real-time Effects")
     print("🔒 Security features active")
     print(f"👑 Admin: {ADMIN_USER}")
-    print("🌐 Server running on http://0.0.0.0:5000")
+    print(f"🌐 Server running on http://{SERVER_HOST}:{SERVER_PORT} ({SERVER_MODE})")
     
-    app.run(debug=False, host="0.0.0.0", port=5000, threaded=True)
+    if PREFORK_WORKERS > 0:
+        print(f"   • prefork: {PREFORK_WORKERS} workers, shared state in {SHARED_STORE_PATH}")
+        run_prefork(PREFORK_WORKERS)
+    else:
+        if SERVER_MODE == "gevent":
+            print(f"   • pool={GEVENT_POOL_SIZE} backlog={GEVENT_BACKLOG} keepalive={GEVENT_KEEPALIVE}s timeout={GEVENT_REQUEST_TIMEOUT}s")
+        server = make_mode_server((SERVER_HOST, SERVER_PORT))
+        SCHEDULER.start()
+        ADMISSION.start(server)
+        serve(server)
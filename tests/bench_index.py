@@ -0,0 +1,63 @@
+"""Benchmark of GET / through Flask's test client.
+
+Times sequential index-page requests for an anonymous visitor, a logged-in
+user and an admin.
+
+    python tests/bench_index.py                   # the working tree
+    python tests/bench_index.py --ref e10b690~1   # also benchmark app.py from a git revision, for before/after
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(app_dir, requests):
+    sys.path.insert(0, app_dir)
+    import app as chat
+    chat.app.logger.disabled = True
+    client = chat.app.test_client()
+
+    def bench(variant):
+        client.get("/").close()  # warm up any per-variant cache
+        started = time.perf_counter()
+        for _ in range(requests):
+            r = client.get("/")
+            r.close()  # as a WSGI server would, releasing the admission slot
+        elapsed = time.perf_counter() - started
+        print(f"  {variant:6s} {requests / elapsed:8.1f} req/s  {elapsed / requests * 1000:6.2f} ms/req  {len(r.data)} bytes")
+
+    bench("anon")
+    client.post("/set-username", data={"username": "bench"}).close()
+    bench("user")
+    with client.session_transaction() as s:
+        s["username"] = "Admin"
+        s["is_admin"] = True
+    bench("admin")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300, help="requests per variant")
+    parser.add_argument("--ref", help="git revision whose app.py to benchmark as well")
+    parser.add_argument("--app-dir", default=ROOT, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.ref:
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "app.py"), "wb") as f:
+                f.write(subprocess.check_output(["git", "show", f"{args.ref}:app.py"], cwd=ROOT))
+            print(f"== {args.ref}", flush=True)
+            subprocess.run([sys.executable, __file__, "--requests", str(args.requests), "--app-dir", tmp], cwd=tmp)
+        print("== working tree", flush=True)
+    os.chdir(args.app_dir)  # the app keeps its state files next to it
+    run(args.app_dir, args.requests)
+    sys.stdout.flush()
+    os._exit(0)  # skip joining the app's background threads and pools
+
+
+if __name__ == "__main__":
+    main()
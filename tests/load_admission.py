@@ -0,0 +1,154 @@
+"""Load test for admission control (load shedding).
+
+Floods the low-priority polls (/online-users, /typing-status) from many raw
+HTTP connections while a prober times critical (/send, /admin/debug-info)
+and normal (/messages) requests every 100ms. Under overload the probes should
+stay fast and keep returning 200 while the flood is shed with 503s.
+
+    python tests/load_admission.py                         # start the server for each mode, admission off/on, and compare
+    python tests/load_admission.py --port 5000 [--polite]   # load an already running server
+
+--polite makes the flood honour Retry-After the way the browser poller does.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+FORM = "Content-Type: application/x-www-form-urlencoded"
+
+
+def raw(method, path, body=b"", headers=()):
+    head = (f"{method} {path} HTTP/1.1\r\nHost: x\r\nConnection: close\r\nContent-Length: {len(body)}\r\n"
+            + "".join(f"{h}\r\n" for h in headers) + "\r\n")
+    return head.encode() + body
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else float("nan")
+
+
+def run_load(port, duration, connections, users, polite):
+    """Flood and probe a server on localhost:port, printing one line per request class"""
+    from gevent import monkey
+    monkey.patch_all()
+    import gevent
+    import socket
+
+    def send(data):
+        started = time.perf_counter()
+        try:
+            s = socket.create_connection(("127.0.0.1", port), timeout=30)
+            s.sendall(data)
+            chunks = []
+            while True:
+                chunk = s.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            s.close()
+            response = b"".join(chunks)
+            status = int(response[9:12])
+        except Exception:
+            return "err", time.perf_counter() - started, b""
+        return status, time.perf_counter() - started, response
+
+    def cookie(response):
+        for line in response.split(b"\r\n"):
+            if line.lower().startswith(b"set-cookie:"):
+                return "Cookie: " + line.split(b":", 1)[1].split(b";")[0].strip().decode()
+
+    for i in range(users):  # online users for the polls to list
+        send(raw("POST", "/set-username", f"username=user{i}".encode(), [FORM]))
+    user = cookie(send(raw("POST", "/set-username", b"username=prober", [FORM]))[2])
+    admin = cookie(send(raw("POST", "/admin", b"username=adminof67&password=adminof67", [FORM]))[2])
+
+    flood_requests = [raw("GET", "/online-users?room=general", headers=[user]),
+                      raw("GET", "/typing-status?room=general", headers=[user])]
+    flood = {"ok": 0, "shed": 0, "other": 0, "latency": []}
+
+    def flooder(n):
+        end = time.time() + duration
+        while time.time() < end:
+            status, elapsed, response = send(flood_requests[n % 2])
+            n += 1
+            flood["ok" if status == 200 else "shed" if status == 503 else "other"] += 1
+            if status == 200:
+                flood["latency"].append(elapsed)
+            if status == 503 and polite:
+                retry_after = int(response.split(b"Retry-After: ")[1].split(b"\r")[0])
+                gevent.sleep(retry_after * random.uniform(0.8, 1.2))
+
+    probe_requests = {
+        "critical /send": raw("POST", "/send", json.dumps({"text": "ping", "room": "general"}).encode(),
+                              [user, "Content-Type: application/json"]),
+        "critical /admin/debug-info": raw("GET", "/admin/debug-info", headers=[admin]),
+        "normal /messages": raw("GET", "/messages?room=general&after=0", headers=[user])
+    }
+    probes = {name: [] for name in probe_requests}
+
+    def prober():
+        end = time.time() + duration
+        gevent.sleep(2)  # let the flood build up
+        while time.time() < end:
+            for name, data in probe_requests.items():
+                status, elapsed, _ = send(data)
+                probes[name].append((status, elapsed))
+            gevent.sleep(0.1)
+
+    gevent.joinall([gevent.spawn(flooder, n) for n in range(connections)] + [gevent.spawn(prober)])
+
+    print(f"  flood (low{', honouring Retry-After' if polite else ''}): {flood['ok'] / duration:.0f} ok/s, "
+          f"{flood['shed'] / duration:.0f} shed/s, other={flood['other']}, "
+          f"ok p50={percentile(flood['latency'], .5):.0f}ms p95={percentile(flood['latency'], .95):.0f}ms")
+    for name, results in probes.items():
+        latency = [elapsed for _, elapsed in results]
+        codes = {}
+        for status, _ in results:
+            codes[status] = codes.get(status, 0) + 1
+        print(f"  {name}: n={len(results)} p50={percentile(latency, .5):.0f}ms p95={percentile(latency, .95):.0f}ms "
+              f"max={max(latency, default=0) * 1000:.0f}ms codes={codes}")
+
+
+def run_matrix(args):
+    """Start app.py per configuration and run the load against it in a child process"""
+    runs = [(mode, cap, False) for mode in ("threaded", "gevent") for cap in (0, 64)]
+    runs += [(mode, 64, True) for mode in ("threaded", "gevent")]
+    for mode, cap, polite in runs:
+        env = dict(os.environ, SERVER=mode, PORT=str(args.server_port), ADMISSION_MAX_IN_FLIGHT=str(cap),
+                   RATE_LIMITS='{"send": {"user": null, "ip": null}}')  # the prober sends 10/s
+        with open(os.devnull, "w") as devnull:
+            server = subprocess.Popen([sys.executable, APP], env=env, stdout=devnull, stderr=subprocess.STDOUT)
+        try:
+            time.sleep(3)
+            print(f"== {mode} ADMISSION_MAX_IN_FLIGHT={cap}{' (polite clients)' if polite else ''}", flush=True)
+            subprocess.run([sys.executable, __file__, "--port", str(args.server_port), "--duration", str(args.duration),
+                            "--connections", str(args.connections), "--users", str(args.users)]
+                           + (["--polite"] if polite else []), timeout=args.duration + 120)
+        finally:
+            server.terminate()
+            server.wait(30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, help="load this running server instead of starting one")
+    parser.add_argument("--server-port", type=int, default=5116, help="port for the servers the matrix starts")
+    parser.add_argument("--duration", type=float, default=15, help="seconds")
+    parser.add_argument("--connections", type=int, default=150, help="flooding connections")
+    parser.add_argument("--users", type=int, default=1500, help="online users to register first")
+    parser.add_argument("--polite", action="store_true", help="flood honours Retry-After")
+    args = parser.parse_args()
+    if args.port:
+        run_load(args.port, args.duration, args.connections, args.users, args.polite)
+    else:
+        run_matrix(args)
+
+
+if __name__ == "__main__":
+    main()
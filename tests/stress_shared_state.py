@@ -0,0 +1,130 @@
+"""Multi-threaded stress test for the shared chat state.
+
+Hammers the app through Flask's test client from many threads with a mix of
+requests that read and mutate ACTIVE_USERS, the moderation tables and the
+room histories, and reports throughput plus any 5xx / unhandled exceptions.
+
+    python tests/stress_shared_state.py                  # per-structure locks
+    python tests/stress_shared_state.py --global-lock    # one lock around every request, for comparison
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+# Rate limiting and load shedding would turn part of the load into 429/503s
+os.environ.setdefault("RATE_LIMITS", '{"send": {"user": null, "ip": null}, "typing": {"user": null, "ip": null}}')
+os.environ.setdefault("ADMISSION_MAX_IN_FLIGHT", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as chat  # noqa: E402
+
+
+def run(threads, duration, global_lock):
+    chat.app.logger.disabled = True
+    chat.resolve_geolocation = lambda ip, username=None: chat.UNKNOWN_GEO  # no network
+    errors = []
+    handle_exception = chat.app.handle_exception
+
+    def record(e):
+        errors.append(repr(e))
+        return handle_exception(e)
+    chat.app.handle_exception = record
+
+    if global_lock:
+        big_lock = threading.Lock()
+        inner = chat.app.wsgi_app
+
+        def locked(environ, start_response):
+            with big_lock:
+                return list(inner(environ, start_response))
+        chat.app.wsgi_app = locked
+
+    stop = time.time() + duration
+    counts = [0] * threads
+    failures = [0] * threads
+
+    def worker(n):
+        client = chat.app.test_client()
+        with client.session_transaction() as s:
+            s["username"] = f"user{n}"
+            s["is_admin"] = True
+        rnd = random.Random(n)
+        while time.time() < stop:
+            k = rnd.random()
+            other = f"churn{rnd.randrange(200)}"
+            room = rnd.choice(["general", "random", "tech"])
+            if k < 0.15:
+                # Churn ACTIVE_USERS: add a stale user for update-active to evict
+                chat.add_active_user(other, {"last_seen": chat.datetime(2000, 1, 1), "ip": "1.2.3.4",
+                                             "geo": {}, "room": room}, replace=True)
+                r = client.post("/update-active", json={"room": room})
+            elif k < 0.30:
+                r = client.get("/rooms")
+            elif k < 0.45:
+                r = client.get(f"/online-users?room={room}")
+            elif k < 0.55:
+                r = client.get(f"/typing-status?room={room}")
+            elif k < 0.62:
+                r = client.post("/typing", json={"room": room, "typing": rnd.random() < 0.5})
+            elif k < 0.70:
+                r = client.post("/admin/screen-effect", json={"type": rnd.choice(["ip", "user"]), "identifier": other, "duration": 1})
+            elif k < 0.76:
+                r = client.post("/admin/clear-effect", json={"type": rnd.choice(["ip", "user"]), "identifier": other})
+            elif k < 0.84:
+                r = client.post("/check-effects", json={"username": other})
+            elif k < 0.88:
+                r = client.get("/admin/debug-info")
+            elif k < 0.92:
+                r = client.post("/send", json={"text": "x", "room": f"r{rnd.randrange(50)}"})
+            elif k < 0.95:
+                r = client.get("/admin/active-users?sort=room")
+            elif k < 0.97:
+                chat.cleanup_old_data()
+                counts[n] += 1
+                continue
+            else:
+                r = client.get(f"/messages?room={room}")
+            counts[n] += 1
+            if r.status_code >= 500:
+                failures[n] += 1
+
+    def guarded(n):
+        try:
+            worker(n)
+        except Exception as e:
+            errors.append("thread: " + repr(e))
+
+    workers = [threading.Thread(target=guarded, args=(n,)) for n in range(threads)]
+    started = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.time() - started
+
+    mode = "global-lock" if global_lock else "per-structure"
+    print(f"mode={mode} threads={threads} requests={sum(counts)} req/s={sum(counts) / elapsed:.0f} "
+          f"5xx={sum(failures)} exceptions={len(errors)}")
+    for error, n in Counter(errors).most_common(5):
+        print("  ", n, error[:120])
+    return sum(failures) + len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=8, help="seconds")
+    parser.add_argument("--global-lock", action="store_true", help="serialise every request behind one lock")
+    args = parser.parse_args()
+    sys.setswitchinterval(1e-5)  # switch threads often to surface races
+    failed = run(args.threads, args.duration, args.global_lock)
+    sys.stdout.flush()
+    os._exit(1 if failed else 0)  # skip joining the app's background threads and pools
+
+
+if __name__ == "__main__":
+    main()